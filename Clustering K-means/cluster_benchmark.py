@@ -0,0 +1,103 @@
+"""
+Recall and latency report for cluster-pruned retrieval.
+
+Clusters the documents of a file with kmeans, then runs random queries taken
+from its lines with process_query_vsm, which scores all documents, and with
+process_query_clusters for an increasing number of probed clusters. Prints
+the recall of the top-k of each n_probe with respect to the exhaustive
+top-k, the fraction of the documents scored and the time per query.
+"""
+
+import random
+import re
+import sys
+import time
+
+import numpy as np
+
+from inverted_index import InvertedIndex
+
+
+def random_queries(file_name, num_queries):
+    """ Returns num_queries queries of 2 to 4 words from random lines of the
+    given file. """
+    with open(file_name) as file:
+        lines = [[w.lower() for w in re.split(r"\W+", line) if len(w) > 2]
+                 for line in file]
+    lines = [words for words in lines if len(words) >= 2]
+    queries = []
+    for _ in range(num_queries):
+        words = random.choice(lines)
+        queries.append(random.sample(words, min(len(words),
+                                                random.randint(2, 4))))
+    return queries
+
+
+def recall(expected, result):
+    """ Returns the fraction of the doc ids of expected that are in result.
+
+    >>> recall([(1, 0.9), (4, 0.5)], [(1, 0.9), (2, 0.3)])
+    0.5
+    >>> recall([], [])
+    1.0
+    """
+    if len(expected) == 0:
+        return 1.0
+    doc_ids = set(doc_id for doc_id, _ in result)
+    return sum(doc_id in doc_ids for doc_id, _ in expected) / len(expected)
+
+
+def time_queries(method, queries):
+    """ Returns the results of method for each query and the average time
+    in ms of one query. """
+    start = time.perf_counter()
+    results = [method(query) for query in queries]
+    return results, (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def run_benchmark(ii, queries, topk, n_probes):
+    """ Print the recall, the fraction of documents scored and the time per
+    query of process_query_clusters for each n_probe in n_probes. """
+    num_docs = ii.doc_matrix.shape[0]
+    sizes = np.array([len(cluster) for cluster in ii.cluster_lists])
+    expected, exhaustive_time = time_queries(
+        lambda query: ii.process_query_vsm(query, topk), queries)
+    print("Top-%d, %d queries, %d clusters" % (topk, len(queries),
+                                               len(sizes)))
+    print("%12s%10s%10s%12s" % ("n_probe", "recall", "scored", "ms/query"))
+    print("%12s%10.3f%10.3f%12.3f" % ("exhaustive", 1, 1, exhaustive_time))
+    for n_probe in n_probes:
+        results, query_time = time_queries(
+            lambda query: ii.process_query_clusters(query, topk, n_probe),
+            queries)
+        mean_recall = np.mean([recall(e, r)
+                               for e, r in zip(expected, results)])
+        scored = np.mean([sizes[np.argpartition(
+            -(ii.centroids @ ii.query_vector(query)), n_probe - 1)[:n_probe]]
+            .sum() for query in queries]) / num_docs
+        print("%12d%10.3f%10.3f%12.3f" % (n_probe, mean_recall, scored,
+                                          query_time))
+
+
+if __name__ == "__main__":
+    """ Cluster the given file and print the report. """
+    if len(sys.argv) not in [2, 3, 4]:
+        print("Usage: python3 cluster_benchmark.py <file> [<num clusters>] "
+              "[<num queries>]")
+        sys.exit()
+    num_clusters = 100
+    num_queries = 200
+    if len(sys.argv) > 2:
+        num_clusters = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        num_queries = int(sys.argv[3])
+    random.seed(42)
+    ii = InvertedIndex()
+    ii.read_from_file(sys.argv[1])
+    ii.preprocess_vsm(True)
+    start = time.perf_counter()
+    ii.kmeans(num_clusters)
+    print("%d clusters in %.1fs, %d iterations" % (
+        num_clusters, time.perf_counter() - start, ii.iterations))
+    n_probes = [n for n in [1, 2, 4, 8, 16, 32, 64] if n <= num_clusters]
+    run_benchmark(ii, random_queries(sys.argv[1], num_queries), 10, n_probes)
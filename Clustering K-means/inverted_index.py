@@ -10,11 +10,42 @@ Patrick Brosi <brosi@informatik.uni-freiburg.de>
 import re
 import sys
 import math
+import multiprocessing
+import os
 import numpy as np
 import random
-from math import exp
+import time
 from scipy.sparse import csr_matrix
 
+# The index of a worker process of InvertedIndex.kmeans, set by init_worker.
+worker_index = None
+
+# Margin of the squared distances for the bounds of accelerated k-means. It
+# is larger than the rounding errors of the float32 similarities and bounds,
+# so that a document only keeps its centroid without computing similarities
+# if the plain iterations keep it too.
+BOUND_MARGIN = 1e-4
+
+# Number of decimals of the scores compared by InvertedIndex.top_k.
+SCORE_DECIMALS = 6
+
+
+def init_worker(index):
+    """
+    Initializer of the worker processes of InvertedIndex.kmeans, which gets
+    the index from the forking process.
+    """
+    global worker_index
+    worker_index = index
+
+
+def kmeans_restart(args):
+    """
+    Run one restart of kmeans on worker_index with the given arguments of
+    InvertedIndex.kmeans_restart.
+    """
+    return worker_index.kmeans_restart(*args)
+
 
 class InvertedIndex:
     """ A simple inverted index, as explained in the lecture.
@@ -31,8 +62,27 @@ class InvertedIndex:
         self.iterations = 0
         # term document matrix
         self.td_matrix = None
+        # document term matrix (the transpose of td_matrix as CSR matrix),
+        # the k x terms centroids and the cluster of each document
+        self.doc_matrix = None
+        self.centroids = None
+        self.labels = None
+        # document frequency of each term row and number of documents, set
+        # by read_vocabulary
+        self.document_frequencies = []
+        self.num_docs = 0
+        # exponentially smoothed RSS per document of minibatch_kmeans
+        self.smoothed_rss = None
+        # (RSS, iterations, seconds) of each restart of kmeans
+        self.restarts = []
+        # number of document-centroid distances not computed by the last
+        # accelerated kmeans
+        self.skipped_distances = 0
         # maps a term to the row index of the document matrix
         self.term_matrix_indices = dict()
+        # the sorted document rows of each cluster, set by
+        # build_cluster_lists
+        self.cluster_lists = []
 
     def read_from_file(self, file_name, bm25_k=1.75, bm25_b=0.75):
         """
@@ -181,43 +231,721 @@ class InvertedIndex:
                 il[i] = (docs[0], tf_star * idf)
                 # il[i] = (docs[0], tf * idf)
 
-    def initialize_centroids(self, k):
-        self.centroids = np.zeros([k, len(self.inverted_lists)])
-        centroids_indices = random.sample(
-                                range(0, len(self.document_lengths)), k)
-        for i, index in enumerate(centroids_indices):
-            self.centroids[i] = np.array(self.td_matrix.toarray()[:, index])
-        self.centroids = csr_matrix(self.centroids.T)
+    def read_vocabulary(self, file_name):
+        """
+        Compute the row of each term in the term-document matrix (in the
+        same order as preprocess_vsm), the document frequency of each term,
+        the number of documents and the average document length of the given
+        file in one pass, without building the inverted lists. Needed for
+        stream_batches.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_vocabulary("example.txt")
+        >>> ii.term_matrix_indices
+        {'first': 0, 'docum': 1, 'second': 2, 'third': 3}
+        >>> ii.document_frequencies, ii.num_docs, ii.avg_doc_length
+        ([1, 3, 1, 1], 3, 3.0)
+        """
+        self.term_matrix_indices = dict()
+        self.document_frequencies = []
+        num_words = 0
+        self.num_docs = 0
+        with open(file_name) as file:
+            for line in file:
+                self.num_docs += 1
+                words = [word.lower() for word in re.split(r"\W+", line)
+                         if len(word) > 0]
+                num_words += len(words)
+                for word in dict.fromkeys(words):
+                    if word not in self.term_matrix_indices:
+                        self.term_matrix_indices[word] = \
+                            len(self.document_frequencies)
+                        self.document_frequencies.append(0)
+                    self.document_frequencies[
+                                self.term_matrix_indices[word]] += 1
+        self.avg_doc_length = num_words / self.num_docs
+
+    def stream_batches(self, file_name, batch_size, bm25_k=1.75,
+                       bm25_b=0.75):
+        """
+        Read the given file line by line and yield its documents in batches
+        of batch_size, each as a sparse batch x terms float32 matrix of
+        L2-normalized BM25 scores, like the rows of doc_matrix. Only one batch
+        is in memory at a time. read_vocabulary must have been called with
+        the same file before, words not in its vocabulary are ignored.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example.txt")
+        >>> ii.preprocess_vsm(True)
+        >>> ii.read_vocabulary("example.txt")
+        >>> batches = list(ii.stream_batches("example.txt", 2))
+        >>> [batch.shape for batch in batches]
+        [(2, 4), (1, 4)]
+        >>> print(np.round(batches[0].toarray(), 3))
+        [[1.000 0.000 0.000 0.000]
+         [0.000 0.000 1.000 0.000]]
+        >>> float(abs(batches[1] - ii.td_matrix.T.tocsr()[2:]).max()) < 1e-6
+        True
+        """
+        k = bm25_k
+        b = bm25_b
+        num_terms = len(self.document_frequencies)
+        idf = np.array([math.log(self.num_docs / df, 2)
+                        for df in self.document_frequencies])
+        with open(file_name) as file:
+            while True:
+                # The row, column, tf and document length of each entry.
+                rows = []
+                cols = []
+                tfs = []
+                dls = []
+                num_rows = 0
+                for line in file:
+                    words = [word.lower() for word in re.split(r"\W+", line)
+                             if len(word) > 0]
+                    counts = dict()
+                    for word in words:
+                        counts[word] = counts.get(word, 0) + 1
+                    for word, tf in counts.items():
+                        if word in self.term_matrix_indices:
+                            rows.append(num_rows)
+                            cols.append(self.term_matrix_indices[word])
+                            tfs.append(tf)
+                            dls.append(len(words))
+                    num_rows += 1
+                    if num_rows == batch_size:
+                        break
+                if num_rows == 0:
+                    return
+                tfs = np.array(tfs, dtype=float)
+                dls = np.array(dls, dtype=float)
+                cols = np.array(cols, dtype=np.int64)
+                scores = tfs * (k + 1) / (k * (1 - b + b * (
+                            dls / self.avg_doc_length)) + tfs) * idf[cols]
+                batch = csr_matrix((scores, (rows, cols)),
+                                   shape=(num_rows, num_terms))
+                norms = np.sqrt(np.asarray(
+                                batch.multiply(batch).sum(1)).ravel())
+                norms[norms == 0] = 1
+                batch.data /= np.repeat(norms, np.diff(batch.indptr))
+                yield batch.astype(np.float32)
+
+    def initialize_centroids(self, k, seeding="k-means++", rng=random):
+        """
+        Pick k documents of doc_matrix as the initial centroids, stored as a
+        dense k x terms float32 array. With seeding "random", they are
+        chosen uniformly at random, with "k-means++" each next one is chosen
+        with a probability proportional to its distance to the closest
+        centroid so far, using one sparse-dense product per centroid. The
+        random numbers come from rng.
+
+        >>> ii = InvertedIndex()
+        >>> ii.doc_matrix = csr_matrix([[1.0, 0.0], [1.0, 0.0], [0.0, 1.0]])
+        >>> ii.initialize_centroids(2, rng=random.Random(1))
+        >>> print(ii.centroids)
+        [[1.000 0.000]
+         [0.000 1.000]]
+        """
+        num_docs = self.doc_matrix.shape[0]
+        if seeding == "random":
+            indices = rng.sample(range(num_docs), k)
+        else:
+            indices = [rng.randrange(num_docs)]
+            distances = np.ones(num_docs)
+            while len(indices) < k:
+                centroid = self.doc_matrix[indices[-1]].toarray().ravel()
+                np.minimum(distances, 1 - self.doc_matrix @ centroid,
+                           out=distances)
+                np.maximum(distances, 0, out=distances)
+                cumulative = np.cumsum(distances)
+                if cumulative[-1] > 0:
+                    index = int(np.searchsorted(
+                        cumulative, rng.random() * cumulative[-1], "right"))
+                    indices.append(min(index, num_docs - 1))
+                else:
+                    indices.append(rng.randrange(num_docs))
+        self.centroids = self.doc_matrix[indices].toarray().astype(np.float32)
 
     def compute_distances(self):
-        self.centroids = self.l2normalize_cols(self.centroids)
-        self.distances = csr_matrix(1 - np.dot(
-                    self.centroids.T.todense(), self.td_matrix.todense()))
-        self.rss = np.sum(self.distances.toarray())
+        """
+        Compute the similarities of all documents to all centroids (a dense
+        docs x k array) with one sparse-dense product. For documents and
+        centroids of unit length, this is the cosine similarity, and the
+        distance is 1 - similarity.
+        """
+        self.similarities = self.doc_matrix @ self.centroids.T
 
     def compute_assignment(self):
-        rows = np.argmin(self.distances.todense(), axis=0).tolist()[0]
-        cols = list(range(self.distances.shape[1]))
-        values = [1] * self.distances.shape[1]
-        self.distances = csr_matrix((values, (
-                            rows, cols)), shape=self.distances.shape).todense()
+        """
+        Assign each document to its most similar centroid, as an int array
+        of labels, and compute the RSS, the sum of the distances of the
+        documents to their centroids.
+        """
+        self.labels = np.argmax(self.similarities, axis=1)
+        best = self.similarities[np.arange(len(self.labels)), self.labels]
+        self.rss = float(np.sum(1 - best))
 
     def compute_centroids(self, k):
-        self.centroids = csr_matrix(np.dot(self.td_matrix.todense(),
-                                    self.distances.T) /
-                                    self.distances.sum(1).reshape(k,))
-
-    def kmeans(self, k):
-        self.initialize_centroids(k)
-        oldRss = 10000
-        while oldRss - self.rss > exp(10e-3):
-            oldRss = self.rss
-            self.compute_distances()
-            self.compute_assignment()
-            self.compute_centroids(k)
+        """
+        Compute each centroid as the L2-normalized sum of its documents,
+        with one product of a sparse k x docs indicator matrix and the
+        document matrix. Centroids without documents are kept. The RSS is
+        computed again from the sums (see update_centroids).
+        """
+        self.update_centroids(self.sum_clusters(self.labels, self.doc_matrix,
+                                                k))
+
+    def update_centroids(self, sums):
+        """
+        Compute the RSS of the current assignment, the sum of 1 - x * c over
+        all documents x with centroid c, from the k x terms sums of the
+        documents of each cluster, and replace each centroid by its
+        L2-normalized sum. Centroids without documents are kept.
+
+        >>> ii = InvertedIndex()
+        >>> ii.doc_matrix = csr_matrix([[1.0, 0.0], [0.6, 0.8], [0.0, 0.0]])
+        >>> ii.centroids = np.array([[1.0, 0.0], [0.0, 1.0]])
+        >>> ii.update_centroids(np.array([[1.6, 0.8], [0.0, 0.0]]))
+        >>> '%.3f' % ii.rss
+        '1.400'
+        >>> print(ii.centroids)
+        [[0.894 0.447]
+         [0.000 1.000]]
+        """
+        self.rss = float(self.doc_matrix.shape[0] - np.sum(np.einsum(
+            "ij,ij->i", sums, self.centroids, dtype=np.float64)))
+        norms = np.linalg.norm(sums, axis=1)
+        nonempty = norms > 0
+        self.centroids[nonempty] = sums[nonempty] / norms[nonempty, None]
+
+    def sum_clusters(self, labels, docs, k, rows=None):
+        """
+        Returns the dense k x terms sums of the rows of the sparse matrix
+        docs with the same label, as the product of a sparse k x docs
+        indicator matrix with docs. With rows, only the given rows are
+        summed, labels are their labels.
+
+        >>> ii = InvertedIndex()
+        >>> docs = csr_matrix([[1.0, 0.0], [0.0, 2.0], [3.0, 0.0]])
+        >>> print(ii.sum_clusters(np.array([1, 0, 1]), docs, 3))
+        [[0.000 2.000]
+         [4.000 0.000]
+         [0.000 0.000]]
+        >>> print(ii.sum_clusters(np.array([0, 0]), docs, 1, np.array([1, 2])))
+        [[3.000 2.000]]
+        """
+        if rows is None:
+            rows = np.arange(len(labels))
+        indicator = csr_matrix((np.ones(len(rows), dtype=docs.dtype),
+                                (labels, rows)), shape=(k, docs.shape[0]))
+        return (indicator @ docs).toarray()
+
+    def kmeans(self, k, max_iterations=100, tolerance=1e-4,
+               seeding="k-means++", n_init=1, num_processes=1,
+               accelerated=False):
+        """
+        Spherical k-means on the L2-normalized columns of the td matrix
+        (see preprocess_vsm), without densifying it. Runs n_init restarts
+        with different initial centroids (see initialize_centroids) and keeps
+        the one with the lowest RSS. With num_processes > 1, the restarts
+        run in a pool of forked processes, which share the document matrix
+        with this process. The RSS, iterations and seconds of each restart
+        are stored in restarts. With accelerated, the iterations are done
+        by accelerated_iterations, and skipped_distances is the number of
+        distances it skipped in the kept restart.
+
+        >>> random.seed(0)
+        >>> ii = InvertedIndex()
+        >>> ii.inverted_lists = {"surf": [(1, 0.9), (2, 0.8), (3, 0.7)],
+        ... "web": [(1, 0.3), (2, 0.2), (4, 0.1)],
+        ... "beach": [(4, 0.9), (5, 0.7), (6, 0.8)],
+        ... "sand": [(5, 0.4), (6, 0.3), (3, 0.1)]}
+        >>> ii.preprocess_vsm(True)
+        >>> ii.kmeans(2)
+        >>> ii.labels.tolist() in [[0, 0, 0, 1, 1, 1], [1, 1, 1, 0, 0, 0]]
+        True
+        >>> ii.centroids.shape, ii.centroids.dtype
+        ((2, 4), dtype('float32'))
+        >>> '%.3f' % ii.rss
+        '0.109'
+        >>> ii.kmeans(3, n_init=4, num_processes=2)
+        >>> len(ii.restarts), ii.rss == min(r[0] for r in ii.restarts)
+        (4, True)
+        >>> random.seed(0)
+        >>> ii.kmeans(2, accelerated=True)
+        >>> ii.labels.tolist() in [[0, 0, 0, 1, 1, 1], [1, 1, 1, 0, 0, 0]]
+        True
+        >>> '%.3f' % ii.rss, ii.skipped_distances
+        ('0.109', 12)
+        >>> sorted(cluster.tolist() for cluster in ii.cluster_lists)
+        [[0, 1, 2], [3, 4, 5]]
+        """
+        self.doc_matrix = self.td_matrix.T.tocsr().astype(np.float32)
+        args = [(random.randrange(2 ** 32), k, max_iterations, tolerance,
+                 seeding, accelerated) for _ in range(n_init)]
+        if num_processes > 1 and n_init > 1:
+            with multiprocessing.get_context("fork").Pool(
+                    min(num_processes, n_init), init_worker,
+                    (self,)) as pool:
+                results = pool.map(kmeans_restart, args)
+        else:
+            results = [self.kmeans_restart(*arg) for arg in args]
+        self.restarts = [result[:3] for result in results]
+        self.rss, self.iterations, _, self.centroids, self.labels, \
+            self.skipped_distances = min(results, key=lambda r: r[0])
+        self.build_cluster_lists()
+
+    def kmeans_restart(self, seed, k, max_iterations, tolerance, seeding,
+                       accelerated=False):
+        """
+        One run of kmeans on doc_matrix, with initial centroids chosen with
+        the random seed. Returns the RSS, the number of iterations, the
+        seconds taken, the centroids, the labels and the number of skipped
+        distances.
+        """
+        start = time.perf_counter()
+        self.initialize_centroids(k, seeding, random.Random(seed))
+        self.skipped_distances = 0
+        if accelerated:
+            self.accelerated_iterations(k, max_iterations, tolerance)
+        else:
+            self.iterations = 0
+            old_rss = math.inf
+            old_labels = None
+            while self.iterations < max_iterations:
+                self.compute_distances()
+                self.compute_assignment()
+                self.compute_centroids(k)
+                self.iterations += 1
+                if (old_labels is not None and
+                        np.array_equal(old_labels, self.labels)) or \
+                        old_rss - self.rss < tolerance * self.rss:
+                    break
+                old_rss = self.rss
+                old_labels = self.labels
+        return (self.rss, self.iterations, time.perf_counter() - start,
+                self.centroids, self.labels, self.skipped_distances)
+
+    def accelerated_iterations(self, k, max_iterations, tolerance):
+        """
+        The iterations of kmeans with Elkan's algorithm: keep for each
+        document an upper bound of the (Euclidean) distance to its centroid
+        and a lower bound of the distance to each other centroid. Only the
+        sums of the clusters whose documents changed are computed again, and
+        only the bounds of their centroids are moved. A document keeps its
+        centroid c if all its lower bounds, or half the distance s(c) of c
+        to its closest other centroid, are above the upper bound (squared,
+        plus BOUND_MARGIN). Otherwise the upper bound is first made exact,
+        with the distance to c only, and the documents that still fail the
+        test get the similarities to their centroids and to the centroids c'
+        that can be closer for at least one of them (lower bound below the
+        limit) and for at least one of their centroids c (half the distance
+        of c and c' below the largest limit), with one sparse-dense product.
+        They are assigned by the largest similarity, ties to the lowest
+        centroid, and the centroids and the RSS are computed like in the
+        plain iterations, so the clustering is the same. The number of
+        distances not computed is stored in skipped_distances. Keeping the
+        bounds costs about as much per iteration as the product of the plain
+        iterations until most documents keep their centroid, so this only
+        pays off for runs with many iterations (a small tolerance).
+
+        >>> rng = np.random.default_rng(0)
+        >>> td = rng.random((40, 300)) * (rng.random((40, 300)) < 0.05)
+        >>> ii = InvertedIndex()
+        >>> ii.td_matrix = csr_matrix(td / np.maximum(
+        ...     np.linalg.norm(td, axis=0), 1e-12))
+        >>> int(np.count_nonzero(ii.td_matrix.getnnz(axis=0) == 0))
+        42
+        >>> runs = []
+        >>> for accelerated in [False, True]:
+        ...     random.seed(1)
+        ...     ii.kmeans(12, accelerated=accelerated)
+        ...     runs.append((ii.labels.tolist(), ii.iterations, ii.rss))
+        >>> runs[0] == runs[1], ii.skipped_distances > 0
+        (True, True)
+        """
+        docs = self.doc_matrix
+        num_docs = docs.shape[0]
+        all_docs = np.arange(num_docs)
+        squared_norms = np.asarray(docs.multiply(docs).sum(1),
+                                   dtype=np.float64).ravel()
+        centroid_norms = np.einsum("ij,ij->i", self.centroids,
+                                   self.centroids, dtype=np.float64)
+        # Lower bounds of half the distances between the centroids, exact
+        # at first.
+        half_distances = self.half_centroid_distances(
+            self.centroids, centroid_norms[:, None], centroid_norms)
+        np.fill_diagonal(half_distances, np.inf)
+        # First assignment like in the plain iterations. The lower bound of
+        # the own centroid is inf, so that the minimum is over the others.
+        similarities = docs @ self.centroids.T
+        self.labels = np.argmax(similarities, axis=1)
+        lower = self.centroid_distances(similarities, squared_norms,
+                                        centroid_norms)
+        upper = lower[all_docs, self.labels].astype(np.float64)
+        lower[all_docs, self.labels] = np.inf
+        sums = None
+        changed = np.arange(k)
+        self.iterations = 0
+        old_rss = math.inf
+        old_labels = None
+        while True:
+            # Update the sums of the changed clusters, the others have the
+            # same documents.
+            if len(changed) == k:
+                sums = self.sum_clusters(self.labels, docs, k)
+            elif len(changed) > 0:
+                cluster_index = np.full(k, -1)
+                cluster_index[changed] = np.arange(len(changed))
+                members = np.flatnonzero(cluster_index[self.labels] >= 0)
+                sums[changed] = self.sum_clusters(
+                    cluster_index[self.labels[members]], docs, len(changed),
+                    members)
+            old_centroids = self.centroids[changed]
+            self.update_centroids(sums)
+            self.iterations += 1
+            if self.iterations >= max_iterations or \
+                    (old_labels is not None and
+                     np.array_equal(old_labels, self.labels)) or \
+                    old_rss - self.rss < tolerance * self.rss:
+                break
+            old_rss = self.rss
+            old_labels = self.labels.copy()
+            self.skipped_distances += num_docs * k
+            # Move the bounds by how far the centroids moved. The other
+            # centroids are computed from the same sums, so they didn't.
+            moved = np.zeros(k)
+            moved[changed] = np.linalg.norm(
+                self.centroids[changed] - old_centroids, axis=1)
+            upper += moved[self.labels]
+            lower -= moved.astype(np.float32)
+            centroid_norms[changed] = np.einsum(
+                "ij,ij->i", self.centroids[changed], self.centroids[changed],
+                dtype=np.float64)
+            # Move the bounds of the distances between the centroids, and
+            # make those of the changed centroids exact if there are few.
+            half_distances -= (moved[:, None] + moved[None, :]) / 2
+            if len(changed) <= k // 4:
+                half_distances[changed] = self.half_centroid_distances(
+                    self.centroids[changed], centroid_norms[changed, None],
+                    centroid_norms)
+                half_distances[:, changed] = half_distances[changed].T
+                np.fill_diagonal(half_distances, np.inf)
+            bounds = np.maximum(lower.min(axis=1),
+                                half_distances.min(axis=1)[self.labels])
+            # Make the upper bounds of the failing documents exact.
+            limits = np.sqrt(upper ** 2 + BOUND_MARGIN)
+            rows = np.flatnonzero(bounds < limits)
+            upper[rows] = self.own_centroid_distances(rows, squared_norms,
+                                                      centroid_norms)
+            limits[rows] = np.sqrt(upper[rows] ** 2 + BOUND_MARGIN)
+            self.skipped_distances -= len(rows)
+            rows = rows[bounds[rows] < limits[rows]]
+            changed = np.empty(0, dtype=np.intp)
+            if len(rows) == 0:
+                continue
+            limits = limits[rows]
+            cluster_limits = np.zeros(k)
+            np.maximum.at(cluster_limits, self.labels[rows], limits)
+            candidates = np.any(half_distances < cluster_limits[:, None],
+                                axis=0)
+            # The lower bounds rarely exclude a centroid for all documents
+            # if many failed, then it is not worth reading them.
+            if len(rows) <= num_docs // 4:
+                candidates &= np.any(lower[rows] < limits[:, None], axis=0)
+            candidates[self.labels[rows]] = True
+            candidates = np.flatnonzero(candidates)
+            similarities = (docs if len(rows) == num_docs else docs[rows]) @ \
+                (self.centroids if len(candidates) == k
+                 else self.centroids[candidates]).T
+            # The candidates are sorted, so argmax breaks ties like in the
+            # plain iterations.
+            new_labels = candidates[np.argmax(similarities, axis=1)]
+            distances = self.centroid_distances(
+                similarities, squared_norms[rows], centroid_norms[candidates])
+            self.skipped_distances -= distances.size - len(rows)
+            if len(candidates) == k:
+                lower[rows] = distances
+            else:
+                lower[rows[:, None], candidates] = distances
+            moving = new_labels != self.labels[rows]
+            changed = np.union1d(self.labels[rows[moving]],
+                                 new_labels[moving])
+            self.labels[rows] = new_labels
+            upper[rows] = lower[rows, new_labels]
+            lower[rows, new_labels] = np.inf
+
+    def half_centroid_distances(self, centroids, squared_norms,
+                                centroid_norms):
+        """
+        Returns half the Euclidean distances of the given centroids, with
+        the given squared norms (as a column), to all centroids, with the
+        given squared norms.
+
+        >>> ii = InvertedIndex()
+        >>> ii.centroids = np.array([[1.0, 0.0], [0.0, 1.0]])
+        >>> print(ii.half_centroid_distances(
+        ...     ii.centroids[:1], np.array([[1.0]]), np.array([1.0, 1.0])))
+        [[0.000 0.707]]
+        """
+        products = centroids @ self.centroids.T
+        return np.sqrt(np.maximum(squared_norms + centroid_norms -
+                                  2 * products, 0)) / 2
+
+    def centroid_distances(self, similarities, squared_norms,
+                           centroid_norms):
+        """
+        Returns the Euclidean distances of documents to centroids, with the
+        given squared norms, from their (float32) similarities, the dot
+        products.
+
+        >>> ii = InvertedIndex()
+        >>> print(ii.centroid_distances(np.array([[1.0, 0.0]]),
+        ...                             np.array([1.0]), np.array([1.0, 1.0])))
+        [[0.000 1.414]]
+        """
+        distances = similarities * -2
+        distances += squared_norms.astype(distances.dtype)[:, None]
+        distances += centroid_norms.astype(distances.dtype)
+        np.maximum(distances, 0, out=distances)
+        return np.sqrt(distances, out=distances)
+
+    def own_centroid_distances(self, rows, squared_norms, centroid_norms):
+        """
+        Returns the Euclidean distances of the documents in the given rows
+        of doc_matrix (with the given squared norms) to their centroids
+        (see labels, with the given squared norms). Only the entries of the
+        centroids at the nonzero entries of the documents are read.
+
+        >>> ii = InvertedIndex()
+        >>> ii.doc_matrix = csr_matrix([[1.0, 0.0], [0.6, 0.8], [0.0, 0.0]])
+        >>> ii.centroids = np.array([[1.0, 0.0], [0.0, 1.0]])
+        >>> ii.labels = np.array([1, 0, 0])
+        >>> print(ii.own_centroid_distances(
+        ...     np.array([0, 1, 2]), np.array([1.0, 1.0, 0.0]),
+        ...     np.array([1.0, 1.0])))
+        [1.414 0.894 1.000]
+        """
+        docs = self.doc_matrix if len(rows) == self.doc_matrix.shape[0] \
+            else self.doc_matrix[rows]
+        labels = self.labels[rows]
+        lengths = np.diff(docs.indptr)
+        # The entries of the centroids at the flat indices of the nonzero
+        # entries, with a trailing 0 for the empty documents at the end.
+        indices = np.repeat(labels * docs.shape[1], lengths)
+        indices += docs.indices
+        entries = np.append(self.centroids.ravel().take(indices), 0)
+        entries[:-1] *= docs.data
+        products = np.add.reduceat(entries, docs.indptr[:-1],
+                                   dtype=np.float64)
+        products[lengths == 0] = 0
+        return np.sqrt(np.maximum(squared_norms[rows] +
+                                  centroid_norms[labels] - 2 * products, 0))
+
+    def build_cluster_lists(self):
+        """
+        Store the sorted rows of doc_matrix of each cluster in
+        cluster_lists, so that process_query_clusters only scores the
+        documents of the probed clusters. The rows are views of one sorted
+        array, the documents are not copied.
+
+        >>> ii = InvertedIndex()
+        >>> ii.doc_matrix = csr_matrix([[1.0, 0.0], [0.0, 1.0], [1.0, 0.0]])
+        >>> ii.centroids = np.array([[1.0, 0.0], [0.0, 1.0], [0.5, 0.5]])
+        >>> ii.labels = np.array([0, 1, 0])
+        >>> ii.build_cluster_lists()
+        >>> [cluster.tolist() for cluster in ii.cluster_lists]
+        [[0, 2], [1], []]
+        """
+        order = np.argsort(self.labels, kind="stable")
+        starts = np.searchsorted(self.labels[order],
+                                 np.arange(len(self.centroids) + 1))
+        self.cluster_lists = [order[start:end] for start, end
+                              in zip(starts[:-1], starts[1:])]
+
+    def query_vector(self, keywords):
+        """
+        Returns the query as a dense float32 vector over the terms, with the
+        number of occurrences of each keyword. Unknown keywords are ignored.
+
+        >>> ii = InvertedIndex()
+        >>> ii.term_matrix_indices = {"surf": 0, "web": 1, "beach": 2}
+        >>> print(ii.query_vector(["web", "surf", "web", "sea"]))
+        [1.000 2.000 0.000]
+        """
+        query_vector = np.zeros(len(self.term_matrix_indices),
+                                dtype=np.float32)
+        for keyword in keywords:
+            if keyword in self.term_matrix_indices:
+                query_vector[self.term_matrix_indices[keyword]] += 1
+        return query_vector
+
+    def top_k(self, rows, scores, k):
+        """
+        Returns the k best (doc id, score) pairs of the documents with the
+        given rows of doc_matrix and scores, sorted by score, with ties
+        broken by doc id. Scores that are equal when rounded to
+        SCORE_DECIMALS decimals are ties, so that rounding errors don't
+        decide their order. Documents with score 0 are left out.
+
+        >>> ii = InvertedIndex()
+        >>> ii.top_k(np.array([4, 0, 2, 3]), np.array([0.5, 0.9, 0.5, 0]), 3)
+        [(1, 0.9), (3, 0.5), (5, 0.5)]
+        >>> [doc_id for doc_id, _ in ii.top_k(
+        ...     np.array([4, 0, 2]), np.array([0.5 + 1e-12, 0.9, 0.5]), 3)]
+        [1, 3, 5]
+        >>> ii.top_k(np.array([4, 0]), np.array([0.5, 0.9]), 0)
+        []
+        """
+        if k <= 0:
+            return []
+        matches = scores > 0
+        rows = rows[matches]
+        scores = scores[matches]
+        rounded = np.round(scores, SCORE_DECIMALS)
+        if len(rows) > k:
+            best = np.argpartition(-rounded, k - 1)[:k]
+            # Keep all documents with the (rounded) score of the k-th one,
+            # so that the ties are broken by doc id.
+            best = np.flatnonzero(rounded >= rounded[best].min())
+            rows = rows[best]
+            scores = scores[best]
+            rounded = rounded[best]
+        order = np.lexsort((rows, -rounded))[:k]
+        return [(int(rows[i]) + 1, float(scores[i])) for i in order]
+
+    def process_query_vsm(self, keywords, k=10):
+        """
+        Returns the k best (doc id, score) pairs for the query from all
+        documents of doc_matrix, with the cosine similarity of the
+        L2-normalized documents as score.
+
+        >>> random.seed(0)
+        >>> ii = InvertedIndex()
+        >>> ii.inverted_lists = {"surf": [(1, 0.9), (2, 0.8), (3, 0.7)],
+        ... "web": [(1, 0.3), (2, 0.2), (4, 0.1)],
+        ... "beach": [(4, 0.9), (5, 0.7), (6, 0.8)],
+        ... "sand": [(5, 0.4), (6, 0.3), (3, 0.1)]}
+        >>> ii.preprocess_vsm(True)
+        >>> ii.kmeans(2)
+        >>> [(doc_id, '%.3f' % score)
+        ...  for doc_id, score in ii.process_query_vsm(["web"], 3)]
+        [(1, '0.316'), (2, '0.243'), (4, '0.110')]
+        """
+        return self.top_k(np.arange(self.doc_matrix.shape[0]),
+                          self.doc_matrix @ self.query_vector(keywords), k)
+
+    def process_query_clusters(self, keywords, k=10, n_probe=1):
+        """
+        Returns the k best (doc id, score) pairs for the query like
+        process_query_vsm, but only from the documents of the n_probe
+        clusters whose centroids are most similar to the query. More probed
+        clusters give results closer to process_query_vsm, but score more
+        documents. kmeans must have been called before.
+
+        >>> random.seed(0)
+        >>> ii = InvertedIndex()
+        >>> ii.inverted_lists = {"surf": [(1, 0.9), (2, 0.8), (3, 0.7)],
+        ... "web": [(1, 0.3), (2, 0.2), (4, 0.1)],
+        ... "beach": [(4, 0.9), (5, 0.7), (6, 0.8)],
+        ... "sand": [(5, 0.4), (6, 0.3), (3, 0.1)]}
+        >>> ii.preprocess_vsm(True)
+        >>> ii.kmeans(2)
+        >>> [doc_id for doc_id, _ in ii.process_query_clusters(["web"], 3)]
+        [1, 2]
+        >>> result = ii.process_query_clusters(["web"], 3, n_probe=2)
+        >>> result == ii.process_query_vsm(["web"], 3)
+        True
+        """
+        query_vector = self.query_vector(keywords)
+        # Only the columns of the query terms contribute to the similarities.
+        terms = np.flatnonzero(query_vector)
+        similarities = self.centroids[:, terms] @ query_vector[terms]
+        n_probe = min(n_probe, len(similarities))
+        probes = np.argpartition(-similarities, n_probe - 1)[:n_probe]
+        rows = np.concatenate([self.cluster_lists[c] for c in probes])
+        scores = self.doc_matrix[rows] @ query_vector
+        return self.top_k(rows, scores, k)
+
+    def minibatch_kmeans(self, k, batch_size=1000, batches=None,
+                         max_batches=1000, smoothing=0.1, patience=10):
+        """
+        Mini-batch spherical k-means. Each iteration assigns a batch of
+        documents to their most similar centroids and moves each centroid
+        towards its documents, with a per-centroid learning rate of one over
+        the number of documents assigned to it so far, and normalizes it
+        again. The batches are random samples of batch_size rows of
+        doc_matrix, or the sparse matrices of the iterable batches (for
+        example from stream_batches), and the centroids are k random
+        documents of the first batch. Stops after max_batches batches, at
+        the end of batches, or when the exponentially smoothed RSS per
+        document (with factor smoothing) didn't improve for patience
+        batches. The number of batches is stored in iterations.
+
+        >>> random.seed(0)
+        >>> ii = InvertedIndex()
+        >>> ii.inverted_lists = {"surf": [(1, 0.9), (2, 0.8), (3, 0.7)],
+        ... "web": [(1, 0.3), (2, 0.2), (4, 0.1)],
+        ... "beach": [(4, 0.9), (5, 0.7), (6, 0.8)],
+        ... "sand": [(5, 0.4), (6, 0.3), (3, 0.1)]}
+        >>> ii.preprocess_vsm(True)
+        >>> ii.minibatch_kmeans(2, batch_size=4, max_batches=20)
+        >>> ii.compute_distances()
+        >>> ii.compute_assignment()
+        >>> ii.labels.tolist() in [[0, 0, 0, 1, 1, 1], [1, 1, 1, 0, 0, 0]]
+        True
+        >>> 0 < ii.iterations <= 20, ii.smoothed_rss < 0.1
+        (True, True)
+        """
+        if batches is None:
+            self.doc_matrix = self.td_matrix.T.tocsr().astype(np.float32)
+            num_docs = self.doc_matrix.shape[0]
+            batches = (self.doc_matrix[random.sample(
+                                range(num_docs), min(batch_size, num_docs))]
+                       for _ in range(max_batches))
+        self.iterations = 0
+        self.smoothed_rss = None
+        counts = np.zeros(k)
+        best_rss = math.inf
+        no_improvement = 0
+        for batch in batches:
+            if self.iterations == 0:
+                self.centroids = batch[random.sample(
+                                    range(batch.shape[0]), k)].toarray()
+            similarities = batch @ self.centroids.T
+            labels = np.argmax(similarities, axis=1)
+            rss = float(np.sum(1 - similarities[np.arange(len(labels)),
+                                                labels])) / len(labels)
+            # The initial centroids are documents of the first batch, so its
+            # RSS is too low to start with.
+            if self.iterations == 1:
+                self.smoothed_rss = rss
+            elif self.iterations > 1:
+                self.smoothed_rss = (smoothing * rss +
+                                     (1 - smoothing) * self.smoothed_rss)
+            # Moving a centroid towards each of its n new documents with the
+            # learning rates 1 / (count + 1), ..., 1 / (count + n) is the
+            # same as taking the weighted mean with the sum of them.
+            sums = self.sum_clusters(labels, batch, k)
+            batch_counts = np.bincount(labels, minlength=k)
+            updated = batch_counts > 0
+            new_counts = counts + batch_counts
+            means = (counts[updated, None] * self.centroids[updated] +
+                     sums[updated]) / new_counts[updated, None]
+            norms = np.linalg.norm(means, axis=1)
+            norms[norms == 0] = 1
+            self.centroids[updated] = means / norms[:, None]
+            counts = new_counts
+            if self.smoothed_rss is not None:
+                if self.smoothed_rss < best_rss:
+                    best_rss = self.smoothed_rss
+                    no_improvement = 0
+                else:
+                    no_improvement += 1
             self.iterations += 1
+            if no_improvement >= patience or self.iterations >= max_batches:
+                break
 
-        print(self.iterations)
 
 if __name__ == "__main__":
 
@@ -229,7 +957,11 @@ if __name__ == "__main__":
     ii.read_from_file(file_name)
     print("Building sparse term-document matrix...")
     ii.preprocess_vsm(True)
-    print(ii.td_matrix.todense())
-    print("Done.")
-    ii.kmeans(2)
-    print(ii.centroids.todense())
+    print("Done, %d terms x %d documents." % ii.td_matrix.shape)
+    ii.kmeans(2, n_init=4, num_processes=os.cpu_count())
+    for rss, iterations, seconds in ii.restarts:
+        print("Restart: RSS %.3f, %d iterations, %.3fs"
+              % (rss, iterations, seconds))
+    print("%d iterations, RSS %.3f" % (ii.iterations, ii.rss))
+    print(ii.labels)
+    print(ii.centroids)
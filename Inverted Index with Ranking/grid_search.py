@@ -0,0 +1,43 @@
+"""
+Grid search for the BM25 parameters of the ranking index.
+
+Builds the index of a file once, then evaluates a benchmark file for every
+pair of the parameters k and b with EvaluateBenchmark.grid_search, which only
+recomputes the scores from the stored term frequencies. Prints MP@3, MP@R and
+MAP for each pair and the pair with the best MAP.
+"""
+
+import os
+import sys
+import time
+
+from inverted_index import InvertedIndex, EvaluateBenchmark
+
+
+if __name__ == "__main__":
+    """ Run the grid search with an optional number of processes. """
+    if len(sys.argv) not in [3, 4]:
+        print("Usage: python3 grid_search.py <file> <benchmark file> "
+              "[<num processes>]")
+        sys.exit()
+    num_processes = os.cpu_count()
+    if len(sys.argv) == 4:
+        num_processes = int(sys.argv[3])
+    ks = [0.25, 0.5, 0.75, 1.0, 1.25, 1.5, 1.75, 2.0]
+    bs = [0.0, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0]
+
+    start = time.perf_counter()
+    ii = InvertedIndex()
+    ii.read_from_file(sys.argv[1], ks[0], bs[0], num_processes)
+    print("Index built in %.1fs" % (time.perf_counter() - start))
+    start = time.perf_counter()
+    results = EvaluateBenchmark(ii).grid_search(sys.argv[2], ks, bs,
+                                                num_processes)
+    print("%d pairs evaluated in %.1fs" % (len(results),
+                                           time.perf_counter() - start))
+
+    print("%6s%6s%8s%8s%8s" % ("k", "b", "MP@3", "MP@R", "MAP"))
+    for k, b, mp3, mpr, map_ in results:
+        print("%6.2f%6.2f%8.3f%8.3f%8.3f" % (k, b, mp3, mpr, map_))
+    k, b, mp3, mpr, map_ = max(results, key=lambda result: result[4])
+    print("Best MAP %.3f with k=%.2f, b=%.2f" % (map_, k, b))
@@ -6,6 +6,427 @@ Hannah Bast <bast@cs.uni-freiburg.de>
 import re
 import sys
 import math
+import bisect
+import heapq
+import io
+import itertools
+import mmap
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+import time
+import numpy as np
+from array import array
+from collections.abc import Mapping
+
+# Header of an index file written by InvertedIndex.save: magic, format
+# version, number of words, number of documents and average document length.
+INDEX_FILE_HEADER = "<4sIIId"
+INDEX_FILE_MAGIC = b"IIRK"
+INDEX_FILE_VERSION = 2
+
+# Rough number of bytes used by a new word and by a posting [record_id, tf]
+# of the in-memory inverted lists, used to decide when to write a run in
+# build_index_file.
+WORD_MEMORY = 200
+POSTING_MEMORY = 80
+
+# Number of postings of an inverted list read from a run file at a time by
+# merge_runs.
+MERGE_CHUNK_SIZE = 65536
+
+# The benchmark evaluator of a worker process of EvaluateBenchmark.grid_search
+# or EvaluateBenchmark.run_queries, set by init_worker.
+worker_evaluator = None
+
+# Margin for comparing upper bounds of scores with the top-k threshold in
+# process_query_wand, to be safe from rounding differences in the sums.
+SCORE_EPSILON = 1e-9
+
+
+class Postings:
+    """ An inverted list with BM25 scores, stored as an array of record ids
+    (uint32) and an array of scores (float64) instead of a list of
+    [record_id, score] lists. Indexing and iteration still give
+    [record_id, score] lists, so it can be used in place of such a list.
+
+    >>> postings = Postings([[1, 0.5], [4, 1.25]])
+    >>> postings
+    [[1, 0.5], [4, 1.25]]
+    >>> len(postings), postings[1], postings[:1], list(postings.record_ids)
+    (2, [4, 1.25], [[1, 0.5]], [1, 4])
+    """
+
+    def __init__(self, pairs=()):
+        """ Create postings from the given [record_id, score] pairs. """
+        self.record_ids = array("I")
+        self.scores = array("d")
+        for record_id, score in pairs:
+            self.append(record_id, score)
+
+    def append(self, record_id, score):
+        """ Append a posting with a record id larger than all others. """
+        self.record_ids.append(record_id)
+        self.scores.append(score)
+
+    def __len__(self):
+        return len(self.record_ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [[record_id, score] for record_id, score in zip(
+                        self.record_ids[i], self.scores[i])]
+        return [self.record_ids[i], self.scores[i]]
+
+    def __iter__(self):
+        for record_id, score in zip(self.record_ids, self.scores):
+            yield [record_id, score]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class PackedInvertedLists(Mapping):
+    """ Read-only mapping from word to inverted list, with the postings of
+    all words packed into one array of record ids (uint32) and one array
+    of scores (float64), plus optionally the raw term frequencies (uint32).
+    An inverted list is returned as Postings whose arrays are memoryviews
+    into the packed arrays.
+
+    >>> packed = PackedInvertedLists()
+    >>> packed.append("b", Postings([[1, 0.5], [4, 1.25]]))
+    >>> packed.append("a", Postings([[2, 0.0]]))
+    >>> sorted(packed.items())
+    [('a', [[2, 0.0]]), ('b', [[1, 0.5], [4, 1.25]])]
+    >>> list(packed["b"].record_ids)
+    [1, 4]
+    """
+
+    def __init__(self):
+        """ Create an empty mapping. """
+        # The position of each word in offsets.
+        self.word_ids = {}
+        self.offsets = array("Q", [0])
+        self.record_ids = array("I")
+        self.scores = array("d")
+        self.tfs = array("I")
+
+    def append(self, word, postings, tfs=()):
+        """ Add the inverted list of a new word, and the term frequencies of
+        its postings. Must not be called after the first inverted list was
+        accessed. """
+        self.word_ids[word] = len(self.offsets) - 1
+        self.record_ids.extend(postings.record_ids)
+        self.scores.extend(postings.scores)
+        self.tfs.extend(tfs)
+        self.offsets.append(len(self.record_ids))
+
+    def __getitem__(self, word):
+        i = self.word_ids[word]
+        postings = Postings()
+        postings.record_ids = memoryview(self.record_ids)[
+                                self.offsets[i]:self.offsets[i + 1]]
+        postings.scores = memoryview(self.scores)[
+                            self.offsets[i]:self.offsets[i + 1]]
+        return postings
+
+    def __contains__(self, word):
+        return word in self.word_ids
+
+    def __iter__(self):
+        return iter(self.word_ids)
+
+    def __len__(self):
+        return len(self.word_ids)
+
+    def memory_size(self):
+        """ Returns the number of bytes used by the inverted lists, without
+        the words themselves. """
+        return (sys.getsizeof(self.word_ids) + sys.getsizeof(self.offsets) +
+                sys.getsizeof(self.record_ids) + sys.getsizeof(self.scores) +
+                sum(sys.getsizeof(i) for i in self.word_ids.values()))
+
+
+class ImpactOrderedLists:
+    """ The inverted lists of an index in impact order. The scores are
+    quantized to 8-bit impacts, where impact i stands for the score
+    i * scale, with the same scale for all words. The postings of each word
+    are sorted by descending impact and then by record id, and split into
+    tiers of postings with the same impact. The record ids of all words are
+    packed into one array, and each tier is stored as its start in that
+    array and its impact.
+
+    >>> impact = ImpactOrderedLists({"a": Postings([[1, 0.5], [4, 2.0]]),
+    ...                              "b": Postings([[2, 0.0], [3, 2.0]]),
+    ...                              "c": Postings([[1, 1.0], [2, 1.0]])})
+    >>> impact.scale
+    0.00784313725490196
+    >>> [(int(i), ids.tolist()) for i, ids in impact.tiers("a")]
+    [(255, [4]), (64, [1])]
+    >>> [(int(i), ids.tolist()) for i, ids in impact.tiers("c")]
+    [(128, [1, 2])]
+    >>> "b" in impact, "d" in impact
+    (True, False)
+    """
+
+    def __init__(self, inverted_lists):
+        """ Create the impact-ordered lists of the given mapping from word
+        to Postings. """
+        max_score = max((max(inverted_lists[word].scores)
+                         for word in inverted_lists), default=0)
+        self.scale = max_score / 255 if max_score > 0 else 1.0
+        # The tiers of word i are tier_offsets[i] to tier_offsets[i + 1],
+        # the postings of tier t are tier_starts[t] to tier_starts[t + 1].
+        self.word_ids = {}
+        record_ids = []
+        tier_starts = []
+        tier_impacts = []
+        tier_offsets = [0]
+        num_postings = 0
+        for word in inverted_lists:
+            postings = inverted_lists[word]
+            ids = np.frombuffer(postings.record_ids, dtype=np.uint32) \
+                if isinstance(postings, Postings) else \
+                np.array([p[0] for p in postings], dtype=np.uint32)
+            scores = np.frombuffer(postings.scores, dtype=np.float64) \
+                if isinstance(postings, Postings) else \
+                np.array([p[1] for p in postings], dtype=np.float64)
+            impacts = np.rint(scores / self.scale).astype(np.uint8)
+            order = np.lexsort((ids, -impacts.astype(np.int16)))
+            impacts = impacts[order]
+            starts = np.flatnonzero(np.diff(impacts, prepend=-1))
+            self.word_ids[word] = len(tier_offsets) - 1
+            record_ids.append(ids[order])
+            tier_starts.append(starts + num_postings)
+            tier_impacts.append(impacts[starts])
+            tier_offsets.append(tier_offsets[-1] + len(starts))
+            num_postings += len(ids)
+        self.record_ids = np.concatenate(record_ids or [[]]).astype(np.uint32)
+        self.tier_starts = np.append(np.concatenate(
+            tier_starts or [[]]).astype(np.int64), num_postings)
+        self.tier_impacts = np.concatenate(
+            tier_impacts or [[]]).astype(np.uint8)
+        self.tier_offsets = np.array(tier_offsets, dtype=np.int64)
+
+    def __contains__(self, word):
+        return word in self.word_ids
+
+    def tier_range(self, word):
+        """ Returns the range of the tier numbers of word. """
+        i = self.word_ids[word]
+        return range(self.tier_offsets[i], self.tier_offsets[i + 1])
+
+    def tier(self, t):
+        """ Returns the impact and the array of record ids of tier t. """
+        return self.tier_impacts[t], self.record_ids[
+                        self.tier_starts[t]:self.tier_starts[t + 1]]
+
+    def tiers(self, word):
+        """ Returns the (impact, record ids) of the tiers of word, by
+        descending impact. """
+        return [self.tier(t) for t in self.tier_range(word)]
+
+    def memory_size(self):
+        """ Returns the number of bytes used by the inverted lists, without
+        the words themselves. """
+        return (sys.getsizeof(self.word_ids) + self.record_ids.nbytes +
+                self.tier_starts.nbytes + self.tier_impacts.nbytes +
+                self.tier_offsets.nbytes +
+                sum(sys.getsizeof(i) for i in self.word_ids.values()))
+
+
+class MappedInvertedLists(Mapping):
+    """ Read-only mapping from word to inverted list, backed by a memory
+    mapped index file written by InvertedIndex.save. Words are found by
+    binary search in the sorted vocabulary. An inverted list is returned as
+    Postings whose arrays are memoryviews into the file, so nothing is
+    copied or kept in memory, and only the pages accessed are read. """
+
+    def __init__(self, file_name):
+        """ Memory map the given index file. """
+        with open(file_name, "rb") as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.num_words, self.N, self.AVDL = \
+            struct.unpack_from(INDEX_FILE_HEADER, self.mmap)
+        if magic != INDEX_FILE_MAGIC or version != INDEX_FILE_VERSION:
+            raise ValueError("Not an index file: %s" % file_name)
+        view = memoryview(self.mmap)
+        pos = struct.calcsize(INDEX_FILE_HEADER)
+        table_size = 8 * (self.num_words + 1)
+        self.word_offsets = view[pos:pos + table_size].cast("Q")
+        pos += table_size
+        self.list_offsets = view[pos:pos + table_size].cast("Q")
+        pos += table_size
+        # The document lengths, indexed by record id (DL[0] is unused).
+        self.DL = view[pos:pos + 4 * (self.N + 1)].cast("I")
+        pos += 4 * (self.N + 1)
+        self.words_start = pos
+        # The record ids and the scores start at a multiple of 8 bytes.
+        num_postings = self.list_offsets[self.num_words]
+        pos += self.word_offsets[self.num_words]
+        pos += -pos % 8
+        self.record_ids = view[pos:pos + 4 * num_postings].cast("I")
+        pos += 4 * num_postings
+        pos += -pos % 8
+        self.scores = view[pos:pos + 8 * num_postings].cast("d")
+
+    def word_at(self, i):
+        """ Returns the i-th word (as utf-8 bytes) of the vocabulary. """
+        return self.mmap[self.words_start + self.word_offsets[i]:
+                         self.words_start + self.word_offsets[i + 1]]
+
+    def find(self, word):
+        """ Returns the position of word in the vocabulary or -1. """
+        key = word.encode("utf8")
+        lo = 0
+        hi = self.num_words
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.word_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_words and self.word_at(lo) == key:
+            return lo
+        return -1
+
+    def __getitem__(self, word):
+        i = self.find(word)
+        if i < 0:
+            raise KeyError(word)
+        start = self.list_offsets[i]
+        end = self.list_offsets[i + 1]
+        postings = Postings()
+        postings.record_ids = self.record_ids[start:end]
+        postings.scores = self.scores[start:end]
+        return postings
+
+    def __contains__(self, word):
+        return self.find(word) >= 0
+
+    def __iter__(self):
+        for i in range(self.num_words):
+            yield self.word_at(i).decode("utf8")
+
+    def __len__(self):
+        return self.num_words
+
+
+def split_file(file_name, num_parts):
+    """
+    Split the file into at most num_parts byte ranges [start, end) of about
+    equal size, each starting at the beginning of a line.
+    >>> split_file("example.txt", 2)
+    [(0, 32), (32, 55)]
+    >>> split_file("example.txt", 10)[:3]
+    [(0, 12), (12, 32), (32, 55)]
+    """
+    size = os.path.getsize(file_name)
+    starts = [0]
+    with open(file_name, "rb") as file:
+        for i in range(1, num_parts):
+            file.seek(max(i * size // num_parts - 1, starts[-1]))
+            file.readline()
+            if file.tell() < size and file.tell() > starts[-1]:
+                starts.append(file.tell())
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def index_range(args):
+    """
+    Index the lines in the byte range [start, end) of the file, with record
+    ids starting at 1. Used by InvertedIndex.read_parallel. To keep the
+    transfer between processes cheap, the result is returned as flat arrays:
+    the words, the length of each inverted list, the concatenated record ids
+    and term frequencies of all lists, and the document lengths.
+    >>> words, lengths, record_ids, tfs, DL = index_range(
+    ...     ("example.txt", 12, 55))
+    >>> words, list(lengths), list(record_ids), list(tfs), list(DL)
+    (['second', 'docum', 'third'], [1, 2, 1], [1, 1, 2, 2], [2, 1, 1, 3], \
+[3, 4])
+    """
+    file_name, start, end = args
+    with open(file_name, "rb") as file:
+        file.seek(start)
+        data = file.read(end - start)
+    ii = InvertedIndex()
+    record_id = 0
+    for line in io.StringIO(data.decode("utf8"), newline=None):
+        record_id += 1
+        ii.add_record(record_id, line)
+    lengths = array("I")
+    record_ids = array("I")
+    tfs = array("I")
+    for postings in ii.inverted_lists.values():
+        lengths.append(len(postings))
+        for posting in postings:
+            record_ids.append(posting[0])
+            tfs.append(posting[1])
+    DL = array("I", (ii.DL[i] for i in range(1, record_id + 1)))
+    return list(ii.inverted_lists), lengths, record_ids, tfs, DL
+
+
+def write_run(file_name, inverted_lists):
+    """
+    Write the inverted lists (with term frequencies) sorted by word to a
+    temporary run file of build_index_file. Each word is stored as its
+    length and the length of its list (uint32), the utf-8 encoded word and
+    the record ids and term frequencies (uint32 each).
+    """
+    with open(file_name, "wb") as file:
+        for word in sorted(word.encode("utf8") for word in inverted_lists):
+            postings = inverted_lists[word.decode("utf8")]
+            file.write(struct.pack("<II", len(word), len(postings)))
+            file.write(word)
+            file.write(array("I", (p[0] for p in postings)).tobytes())
+            file.write(array("I", (p[1] for p in postings)).tobytes())
+
+
+def read_run(file, chunk_size=MERGE_CHUNK_SIZE):
+    """
+    Yield the (word, list length, chunks) of an open run file written by
+    write_run, with the word as utf-8 bytes. chunks is a generator of the
+    record ids and term frequencies of the inverted list, at most
+    chunk_size at a time. Only the word is read here, the postings are
+    read by chunks, which can be used after later words were read.
+    >>> file_name = os.path.join(tempfile.mkdtemp(), "run")
+    >>> write_run(file_name, {"b": [[1, 2], [4, 1]], "a": [[3, 1]]})
+    >>> with open(file_name, "rb") as file:
+    ...     runs = list(read_run(file, 1))
+    ...     [(w, n, [(list(r), list(t)) for r, t in c]) for w, n, c in runs]
+    [(b'a', 1, [([3], [1])]), (b'b', 2, [([1], [2]), ([4], [1])])]
+    """
+    while True:
+        header = file.read(8)
+        if len(header) == 0:
+            break
+        word_length, list_length = struct.unpack("<II", header)
+        word = file.read(word_length)
+        yield word, list_length, read_run_postings(
+                    file, file.tell(), list_length, chunk_size)
+        file.seek(8 * list_length, os.SEEK_CUR)
+
+
+def read_run_postings(file, offset, list_length, chunk_size):
+    """
+    Yield the record ids and term frequencies of the inverted list at the
+    given offset of a run file in chunks of at most chunk_size postings.
+    Uses os.pread, so the position of the file is not changed.
+    """
+    for start in range(0, list_length, chunk_size):
+        size = min(chunk_size, list_length - start)
+        record_ids = array("I")
+        record_ids.frombytes(os.pread(file.fileno(), 4 * size,
+                                      offset + 4 * start))
+        tfs = array("I")
+        tfs.frombytes(os.pread(file.fileno(), 4 * size,
+                               offset + 4 * (list_length + start)))
+        yield record_ids, tfs
 
 
 class InvertedIndex:
@@ -18,53 +439,371 @@ class InvertedIndex:
         self.DL = {}
         self.AVDL = 0
         self.N = 0
+        # The maximum score in the inverted list of each word.
+        self.max_scores = {}
+        # Number of postings scored by the last call of process_query_wand.
+        self.num_scored = 0
+        # The inverted list of each word as arrays of record ids and scores,
+        # and the score accumulator of process_query_taat.
+        self.posting_arrays = {}
+        self.accumulator = None
+        # The ImpactOrderedLists of process_query_impact and its impact
+        # accumulator.
+        self.impact_lists = None
+        self.impact_accumulator = None
 
-    def read_from_file(self, file_name, k, b):
+    def read_from_file(self, file_name, k, b, num_processes=1):
         """
         The method reads textfromthe file file_name and generates an
         inverted index, the variables k and b are for calculating the
-        BM25 scores.
+        BM25 scores. With num_processes > 1, the file is split into that
+        many parts which are indexed in parallel, see read_parallel.
         >>> ii=InvertedIndex()
         >>> ii.read_from_file("example.txt",1.75,0.75)
         >>> sorted(ii.inverted_lists.items())
         [('docum', [[1, 0.0], [2, 0.0], [3, 0.0]]), \
 ('first', [[1, 1.885]]), ('second', [[2, 2.325]]), ('third', [[3, 2.521]])]
         """
-        record_id = 0
-        with open(file_name, encoding='utf8') as file:
-            for line in file:
-                record_id += 1
-                self.DL[record_id] = 0
-                for word in re.split("\W+", line):
-                    word = word.lower()
-                    if len(word) > 2:
-                        self.DL[record_id] += 1
-                        # If word seen first time, create inverted list.
-                        if word not in self.inverted_lists:
-                            self.inverted_lists[word] = []
-                            self.inverted_lists[word].append([record_id, 1])
-                        elif record_id != self.inverted_lists[word][len(
-                                            self.inverted_lists[word]) - 1][0]:
-                            self.inverted_lists[word].append([record_id, 1])
-                        else:
-                            self.inverted_lists[word][len(
-                                        self.inverted_lists[word]) - 1][1] += 1
-                self.AVDL += self.DL[record_id]
-        self.AVDL /= record_id
-        self.N = record_id
+        if num_processes > 1:
+            self.read_parallel(file_name, num_processes)
+        else:
+            record_id = 0
+            with open(file_name, encoding='utf8') as file:
+                for line in file:
+                    record_id += 1
+                    self.add_record(record_id, line)
+            self.N = record_id
+        self.AVDL /= self.N
         self.BM25(k, b)
 
+    def add_record(self, record_id, line):
+        """
+        Add the words of line to the inverted lists as record record_id,
+        which must be larger than all record ids added before.
+        """
+        self.DL[record_id] = 0
+        for word in re.split("\W+", line):
+            word = word.lower()
+            if len(word) > 2:
+                self.DL[record_id] += 1
+                # If word seen first time, create inverted list.
+                if word not in self.inverted_lists:
+                    self.inverted_lists[word] = []
+                    self.inverted_lists[word].append([record_id, 1])
+                elif record_id != self.inverted_lists[word][len(
+                                    self.inverted_lists[word]) - 1][0]:
+                    self.inverted_lists[word].append([record_id, 1])
+                else:
+                    self.inverted_lists[word][len(
+                                self.inverted_lists[word]) - 1][1] += 1
+        self.AVDL += self.DL[record_id]
+
+    def read_parallel(self, file_name, num_processes):
+        """
+        Index the file in num_processes byte ranges in a process pool and
+        merge the partial indexes in order, shifting their record ids by
+        the number of records in the preceding ranges. The result is the
+        same as indexing the file line by line, before the BM25 scores.
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example.txt", 1.75, 0.75, num_processes=2)
+        >>> sorted(ii.inverted_lists.items())
+        [('docum', [[1, 0.0], [2, 0.0], [3, 0.0]]), \
+('first', [[1, 1.885]]), ('second', [[2, 2.325]]), ('third', [[3, 2.521]])]
+        >>> ii.N, ii.DL
+        (3, {1: 2, 2: 3, 3: 4})
+        """
+        ranges = split_file(file_name, num_processes)
+        with multiprocessing.Pool(num_processes) as pool:
+            for words, lengths, record_ids, tfs, DL in pool.imap(
+                    index_range, [(file_name, start, end)
+                                  for start, end in ranges]):
+                offset = self.N
+                pos = 0
+                for word, length in zip(words, lengths):
+                    if word not in self.inverted_lists:
+                        self.inverted_lists[word] = []
+                    self.inverted_lists[word].extend(
+                        [record_id + offset, tf] for record_id, tf in zip(
+                            record_ids[pos:pos + length],
+                            tfs[pos:pos + length]))
+                    pos += length
+                for record_id, length in enumerate(DL, offset + 1):
+                    self.DL[record_id] = length
+                    self.AVDL += length
+                self.N += len(DL)
+
     def BM25(self, k, b):
         """
         The method calcuates the BM25 scores of the wordes
-        in the inverted index.
+        in the inverted index. The inverted lists of [record_id, tf] lists
+        are replaced by PackedInvertedLists, which keep the term
+        frequencies for rescore.
         """
+        packed = PackedInvertedLists()
         for word in self.inverted_lists:
             df = len(self.inverted_lists[word])
+            postings = Postings()
             for element in self.inverted_lists[word]:
                 tfS = element[1] * (k + 1) / (k * (
                     1 - b + b * self.DL[element[0]] / self.AVDL) + element[1])
-                element[1] = round(tfS * math.log(self.N / df, 2), 3)
+                postings.append(element[0],
+                                round(tfS * math.log(self.N / df, 2), 3))
+            tfs = (element[1] for element in self.inverted_lists[word])
+            packed.append(word, postings, tfs)
+        self.inverted_lists = packed
+        self.max_scores = {}
+        self.posting_arrays = {}
+        self.impact_lists = None
+
+    def rescore(self, k, b):
+        """
+        Recompute all BM25 scores for the parameters k and b from the term
+        frequencies and document lengths, in one vectorized pass and
+        without reading the file again. Gives the same scores as BM25.
+        >>> ii=InvertedIndex()
+        >>> ii.read_from_file("example.txt", 0.5, 0.0)
+        >>> ii.process_query(["third"], 1)
+        [[3, 2.038]]
+        >>> ii.rescore(1.75, 0.75)
+        >>> sorted(ii.inverted_lists.items())
+        [('docum', [[1, 0.0], [2, 0.0], [3, 0.0]]), \
+('first', [[1, 1.885]]), ('second', [[2, 2.325]]), ('third', [[3, 2.521]])]
+        """
+        packed = self.inverted_lists
+        if not isinstance(packed, PackedInvertedLists) or \
+                len(packed.tfs) != len(packed.record_ids):
+            raise ValueError("rescore needs the term frequencies of an "
+                             "index built with read_from_file")
+        record_ids = np.frombuffer(packed.record_ids, dtype=np.uint32)
+        tfs = np.frombuffer(packed.tfs, dtype=np.uint32).astype(np.float64)
+        dfs = np.diff(np.frombuffer(packed.offsets, dtype=np.uint64))
+        DL = np.zeros(self.N + 1)
+        DL[1:] = [self.DL[record_id] for record_id in range(1, self.N + 1)]
+        # Same operations in the same order as in BM25, and the idf with
+        # math.log, so that the results are identical.
+        idfs = np.array([math.log(self.N / df, 2) for df in dfs.tolist()])
+        tfS = tfs * (k + 1) / (k * (1 - b + b * DL[record_ids] / self.AVDL) +
+                               tfs)
+        values = tfS * np.repeat(idfs, dfs.astype(np.intp))
+        scores = np.frombuffer(packed.scores, dtype=np.float64)
+        scores[:] = np.round(values, 3)
+        # np.round can differ from round only if the value is close to
+        # halfway between two multiples of 0.001, redo those with round.
+        scaled = values * 1000
+        for i in np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) <
+                                1e-6):
+            scores[i] = round(float(values[i]), 3)
+        self.max_scores = {}
+        self.posting_arrays = {}
+        self.impact_lists = None
+
+    def save(self, file_name):
+        """
+        Write the index with its BM25 scores to a binary file that can be
+        read with load. The file consists of a header, the offsets of the
+        words and of the inverted lists (num_words + 1 uint64 each), the
+        document lengths indexed by record id (N + 1 uint32, the first is
+        0), the sorted utf-8 encoded words, and the record ids (uint32) and
+        scores (float64) of all inverted lists, each padded to start at a
+        multiple of 8 bytes. All arrays are in native byte order.
+        >>> import tempfile
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example.txt", 1.75, 0.75)
+        >>> file_name = os.path.join(tempfile.mkdtemp(), "example.idx")
+        >>> ii.save(file_name)
+        >>> ii = InvertedIndex.load(file_name)
+        >>> ii.N, ii.AVDL, ii.DL[2]
+        (3, 3.0, 3)
+        >>> sorted(ii.inverted_lists.items())
+        [('docum', [[1, 0.0], [2, 0.0], [3, 0.0]]), \
+('first', [[1, 1.885]]), ('second', [[2, 2.325]]), ('third', [[3, 2.521]])]
+        >>> ii.process_query(["docum", "third"], 3)
+        [[3, 2.521], [1, 0.0], [2, 0.0]]
+        """
+        words = sorted(word.encode("utf8") for word in self.inverted_lists)
+        word_offsets = array("Q", [0])
+        list_offsets = array("Q", [0])
+        record_ids = array("I")
+        scores = array("d")
+        for word in words:
+            postings = self.get_postings(word.decode("utf8"))
+            record_ids.extend(postings.record_ids)
+            scores.extend(postings.scores)
+            word_offsets.append(word_offsets[-1] + len(word))
+            list_offsets.append(len(record_ids))
+        DL = array("I", [0])
+        DL.extend(self.DL[record_id] for record_id in range(1, self.N + 1))
+        with open(file_name, "wb") as file:
+            file.write(struct.pack(INDEX_FILE_HEADER, INDEX_FILE_MAGIC,
+                                   INDEX_FILE_VERSION, len(words), self.N,
+                                   self.AVDL))
+            file.write(word_offsets.tobytes())
+            file.write(list_offsets.tobytes())
+            file.write(DL.tobytes())
+            file.write(b"".join(words))
+            file.write(bytes(-file.tell() % 8))
+            file.write(record_ids.tobytes())
+            file.write(bytes(-file.tell() % 8))
+            file.write(scores.tobytes())
+
+    @classmethod
+    def load(cls, file_name):
+        """
+        Returns an index for the file written by save. The file is memory
+        mapped, so only the inverted lists accessed are read from disk, and
+        DL is an array view into the file instead of a dict.
+        """
+        ii = cls()
+        ii.open_index_file(file_name)
+        return ii
+
+    def open_index_file(self, file_name):
+        """ Use the index in the file written by save. """
+        self.inverted_lists = MappedInvertedLists(file_name)
+        self.N = self.inverted_lists.N
+        self.AVDL = self.inverted_lists.AVDL
+        self.DL = self.inverted_lists.DL
+
+    def build_index_file(self, file_name, index_file_name, k, b,
+                         memory_limit=2 ** 28):
+        """
+        Build the index of file_name in the format of save with bounded
+        memory and open it. Whenever the inverted lists in memory exceed
+        about memory_limit bytes, they are written to a sorted run file.
+        The runs are then merged word by word into the index file, with the
+        BM25 scores computed on the way. The merge reads the inverted lists
+        of the runs in chunks, so besides memory_limit it only needs
+        memory for one chunk of postings, whatever the length of the lists.
+        >>> index_file_name = os.path.join(tempfile.mkdtemp(), "example.idx")
+        >>> ii = InvertedIndex()
+        >>> ii.build_index_file("example.txt", index_file_name, 1.75, 0.75,
+        ...                     memory_limit=1000)
+        >>> ii.N, ii.AVDL
+        (3, 3.0)
+        >>> sorted(ii.inverted_lists.items())
+        [('docum', [[1, 0.0], [2, 0.0], [3, 0.0]]), \
+('first', [[1, 1.885]]), ('second', [[2, 2.325]]), ('third', [[3, 2.521]])]
+        """
+        temp_dir = tempfile.mkdtemp(
+                        dir=os.path.dirname(os.path.abspath(index_file_name)))
+        run_file_names = []
+        DL_file = open(os.path.join(temp_dir, "DL"), "wb")
+        DL_file.write(array("I", [0]).tobytes())
+        memory = 0
+        total_length = 0
+        record_id = 0
+        with open(file_name, encoding='utf8') as file:
+            for line in file:
+                record_id += 1
+                num_words = len(self.inverted_lists)
+                self.add_record(record_id, line)
+                memory += (WORD_MEMORY * (len(self.inverted_lists) -
+                                          num_words) +
+                           POSTING_MEMORY * self.DL[record_id])
+                if memory > memory_limit:
+                    run_file_names.append(self.write_run(temp_dir))
+                    DL_file.write(array("I", self.DL.values()).tobytes())
+                    total_length += self.AVDL
+                    self.inverted_lists = {}
+                    self.DL = {}
+                    self.AVDL = 0
+                    memory = 0
+        if len(self.DL) > 0:
+            run_file_names.append(self.write_run(temp_dir))
+            DL_file.write(array("I", self.DL.values()).tobytes())
+            total_length += self.AVDL
+        DL_file.close()
+        self.inverted_lists = {}
+        self.DL = {}
+        self.N = record_id
+        self.AVDL = total_length / record_id
+        self.merge_runs(run_file_names, os.path.join(temp_dir, "DL"),
+                        index_file_name, k, b)
+        shutil.rmtree(temp_dir)
+        self.open_index_file(index_file_name)
+
+    def write_run(self, temp_dir):
+        """ Write the inverted lists to a new run file in temp_dir. """
+        run_file_name = os.path.join(temp_dir, "run-%d" % len(
+                                                    os.listdir(temp_dir)))
+        write_run(run_file_name, self.inverted_lists)
+        return run_file_name
+
+    def merge_runs(self, run_file_names, DL_file_name, index_file_name, k,
+                   b):
+        """
+        Merge the run files with a k-way merge and write the index file
+        with BM25 scores (same format and scores as save after BM25). The
+        parts of the file are first written to separate temporary files and
+        concatenated at the end. The postings are streamed from the runs to
+        the parts in chunks of MERGE_CHUNK_SIZE.
+        """
+        temp_dir = os.path.dirname(DL_file_name)
+        parts = ["word_offsets", "list_offsets", "words", "ids", "scores"]
+        part_files = dict((part, open(os.path.join(temp_dir, part), "wb"))
+                          for part in parts)
+        runs = [open(run_file_name, "rb") for run_file_name in run_file_names]
+        with open(DL_file_name, "rb") as file:
+            DL_mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        DL = memoryview(DL_mmap).cast("I")
+        num_words = 0
+        word_offset = 0
+        list_offset = 0
+        part_files["word_offsets"].write(array("Q", [0]).tobytes())
+        part_files["list_offsets"].write(array("Q", [0]).tobytes())
+        # Runs are ordered by record id, and heapq.merge is stable, so the
+        # parts of an inverted list are merged in the right order.
+        merged = heapq.merge(*[read_run(run) for run in runs],
+                             key=lambda entry: entry[0])
+        for word, entries in itertools.groupby(merged,
+                                               key=lambda entry: entry[0]):
+            # Only the words and chunk generators of the runs are kept.
+            entries = list(entries)
+            list_length = sum(entry[1] for entry in entries)
+            self.write_merged_list(
+                part_files, word, list_length,
+                itertools.chain.from_iterable(entry[2] for entry in entries),
+                DL, k, b)
+            num_words += 1
+            word_offset += len(word)
+            list_offset += list_length
+            part_files["word_offsets"].write(
+                array("Q", [word_offset]).tobytes())
+            part_files["list_offsets"].write(
+                array("Q", [list_offset]).tobytes())
+        for file in list(part_files.values()) + runs:
+            file.close()
+        with open(index_file_name, "wb") as file:
+            file.write(struct.pack(INDEX_FILE_HEADER, INDEX_FILE_MAGIC,
+                                   INDEX_FILE_VERSION, num_words, self.N,
+                                   self.AVDL))
+            for part in parts:
+                if part == "words":
+                    file.write(DL_mmap)
+                elif part in ["ids", "scores"]:
+                    file.write(bytes(-file.tell() % 8))
+                with open(os.path.join(temp_dir, part), "rb") as part_file:
+                    shutil.copyfileobj(part_file, file)
+        DL.release()
+        DL_mmap.close()
+
+    def write_merged_list(self, part_files, word, list_length, chunks, DL, k,
+                          b):
+        """
+        Write the word and its merged inverted list of the given length,
+        given as chunks of record ids and term frequencies, with BM25 scores
+        (as computed by BM25) to the part files of merge_runs.
+        """
+        idf = math.log(self.N / list_length, 2)
+        part_files["words"].write(word)
+        for record_ids, tfs in chunks:
+            scores = array("d")
+            for record_id, tf in zip(record_ids, tfs):
+                tfS = tf * (k + 1) / (k * (
+                    1 - b + b * DL[record_id] / self.AVDL) + tf)
+                scores.append(round(tfS * idf, 3))
+            part_files["ids"].write(record_ids.tobytes())
+            part_files["scores"].write(scores.tobytes())
 
     def merge(self, list1, list2):
         """
@@ -141,11 +880,393 @@ class InvertedIndex:
         while i < len(words_list):
             if words_list[i] in self.inverted_lists:
                 intersected_list = self.merge(intersected_list,
-                                              self.inverted_lists[
-                                                words_list[i]])
+                                              list(self.inverted_lists[
+                                                words_list[i]]))
             i += 1
         return self.partialSort(intersected_list, topk)
 
+    def get_postings(self, word):
+        """
+        Returns the inverted list of word as Postings (converting it if it
+        is a list of [record_id, score] lists).
+        """
+        inverted_list = self.inverted_lists[word]
+        if not isinstance(inverted_list, Postings):
+            inverted_list = Postings(inverted_list)
+        return inverted_list
+
+    def max_score(self, word):
+        """
+        Returns the maximum score in the inverted list of word.
+        >>> ii=InvertedIndex()
+        >>> ii.read_from_file("example.txt", 1.75, 0.75)
+        >>> ii.max_score("second"), ii.max_score("docum")
+        (2.325, 0.0)
+        """
+        if word not in self.max_scores:
+            self.max_scores[word] = max(self.get_postings(word).scores)
+        return self.max_scores[word]
+
+    def process_query_wand(self, words_list, topk):
+        """
+        Returns the topk results of process_query, computed document at a
+        time with the WAND algorithm: the query lists are kept sorted by
+        their current record id, and a record is only scored if the sum of
+        the maximum scores of the lists up to it can beat the current k-th
+        best score. Other lists are moved forward to it by binary search.
+        Ties are broken by record id. The number of postings scored is
+        stored in num_scored.
+        >>> ii=InvertedIndex()
+        >>> ii.read_from_file("example.txt", 1.75, 0.75)
+        >>> ii.process_query_wand(["docum", "third"], 3)
+        [[3, 2.521], [1, 0.0], [2, 0.0]]
+        >>> ii.process_query_wand(["docum", "third", "second"], 1)
+        [[3, 2.521]]
+        >>> ii.num_scored
+        5
+        """
+        self.num_scored = 0
+        # One cursor [position, record ids, scores, max score, query
+        # position] per query word with an inverted list.
+        cursors = []
+        for i, word in enumerate(words_list):
+            if word in self.inverted_lists:
+                postings = self.get_postings(word)
+                cursors.append([0, postings.record_ids, postings.scores,
+                                self.max_score(word), i])
+        # Min-heap of the best [score, -record_id] so far.
+        heap = []
+        threshold = -math.inf
+        while len(cursors) > 0:
+            cursors.sort(key=lambda c: c[1][c[0]])
+            # Find the first cursor at which the upper bound beats the
+            # threshold (the pivot).
+            upper_bound = 0
+            pivot = None
+            for i, cursor in enumerate(cursors):
+                upper_bound += cursor[3]
+                if upper_bound > threshold + SCORE_EPSILON:
+                    pivot = i
+                    break
+            if pivot is None:
+                break
+            record_id = cursors[pivot][1][cursors[pivot][0]]
+            if cursors[0][1][cursors[0][0]] == record_id:
+                # All cursors up to the pivot are at record_id, score it in
+                # query order (like merge does) and move the cursors on.
+                matching = sorted((c for c in cursors
+                                   if c[1][c[0]] == record_id),
+                                  key=lambda c: c[4])
+                score = 0
+                for cursor in matching:
+                    score += cursor[2][cursor[0]]
+                    cursor[0] += 1
+                self.num_scored += len(matching)
+                if len(heap) < topk:
+                    heapq.heappush(heap, [score, -record_id])
+                elif [score, -record_id] > heap[0]:
+                    heapq.heapreplace(heap, [score, -record_id])
+                if len(heap) == topk:
+                    threshold = heap[0][0]
+            else:
+                # Move the cursors before the pivot to record_id.
+                for cursor in cursors[:pivot]:
+                    cursor[0] = bisect.bisect_left(cursor[1], record_id,
+                                                   cursor[0])
+            cursors = [c for c in cursors if c[0] < len(c[1])]
+        return [[-record_id, score] for score, record_id in sorted(
+                                                        heap, reverse=True)]
+
+    def get_posting_arrays(self, word):
+        """
+        Returns the inverted list of word as a pair of NumPy arrays of
+        record ids and scores.
+        >>> ii=InvertedIndex()
+        >>> ii.read_from_file("example.txt", 1.75, 0.75)
+        >>> ii.get_posting_arrays("docum")
+        (array([1, 2, 3]), array([0., 0., 0.]))
+        """
+        if word not in self.posting_arrays:
+            # The scores share the memory of the Postings. The record ids
+            # are converted to intp once, because NumPy converts uint32
+            # indices into a new array on every indexing operation.
+            postings = self.get_postings(word)
+            self.posting_arrays[word] = (
+                np.frombuffer(postings.record_ids,
+                              dtype=np.uint32).astype(np.intp),
+                np.frombuffer(postings.scores, dtype=np.float64))
+        return self.posting_arrays[word]
+
+    def process_query_taat(self, words_list, topk):
+        """
+        Returns the topk results of process_query, computed term at a time:
+        the scores of each query word are added into a dense accumulator
+        array (reused across queries) and the top k are selected with
+        select_candidates. Ties are broken by record id.
+        >>> ii=InvertedIndex()
+        >>> ii.read_from_file("example.txt", 1.75, 0.75)
+        >>> ii.process_query_taat(["docum", "third"], 3)
+        [[3, 2.521], [1, 0.0], [2, 0.0]]
+        >>> ii.process_query_taat(["third", "third", "first"], 1)
+        [[3, 5.042]]
+        >>> ii.process_query_taat(["docum", "third"], 2)
+        [[3, 2.521], [1, 0.0]]
+        >>> ii.process_query_taat(["fourth"], 3)
+        []
+        >>> ii.process_query_taat(["third"], 0)
+        []
+        """
+        if topk <= 0:
+            return []
+        topk = min(topk, self.N)
+        # Records not hit by the query have score -1 (BM25 scores are >= 0).
+        # The other arrays are scratch space, so that only arrays of the
+        # size of the result are allocated per query.
+        if self.accumulator is None or len(self.accumulator) != self.N + 1:
+            self.accumulator = np.full(self.N + 1, -1.0)
+            self.gathered = np.empty(self.N + 1)
+            # The candidates for the top k: the best so far, followed by
+            # the records of one inverted list.
+            self.candidate_ids = np.empty(2 * (self.N + 1), dtype=np.intp)
+            self.candidate_scores = np.empty(2 * (self.N + 1))
+            self.partitioned = np.empty(2 * (self.N + 1))
+            self.tied_ids = np.empty(2 * (self.N + 1), dtype=np.intp)
+            self.mask = np.empty(2 * (self.N + 1), dtype=bool)
+        accumulator = self.accumulator
+        words_list = [word for word in words_list
+                      if word in self.inverted_lists]
+        for word in words_list:
+            record_ids, scores = self.get_posting_arrays(word)
+            gathered = self.gathered[:len(record_ids)]
+            # mode="clip" avoids a buffered copy, the ids are in range.
+            np.take(accumulator, record_ids, out=gathered, mode="clip")
+            np.maximum(gathered, 0, out=gathered)
+            gathered += scores
+            # Record ids are unique within a list, so no np.add.at.
+            accumulator[record_ids] = gathered
+        # Collect the hits list by list and reset the accumulator. A record
+        # in several lists has score -1 after its first list.
+        num_candidates = 0
+        for word in words_list:
+            record_ids, _ = self.get_posting_arrays(word)
+            end = num_candidates + len(record_ids)
+            self.candidate_ids[num_candidates:end] = record_ids
+            np.take(accumulator, record_ids, mode="clip",
+                    out=self.candidate_scores[num_candidates:end])
+            accumulator[record_ids] = -1.0
+            num_candidates = self.select_candidates(end, topk)
+        hits = self.candidate_ids[:num_candidates]
+        hit_scores = self.candidate_scores[:num_candidates]
+        order = np.lexsort((hits, -hit_scores))
+        return [[int(record_id), float(score)] for record_id, score
+                in zip(hits[order], hit_scores[order])]
+
+    def select_candidates(self, num_candidates, topk):
+        """
+        Move the topk best of the first num_candidates candidates of
+        process_query_taat (by score, then by record id) to the front of the
+        candidate arrays, without the ones with score -1. Returns their
+        number. The k-th best score is found by partitioning a copy of the
+        scores in place, and the ties with the smallest record ids by
+        partitioning a copy of the record ids, so that only arrays of size
+        at most topk are allocated.
+        """
+        ids = self.candidate_ids[:num_candidates]
+        scores = self.candidate_scores[:num_candidates]
+        mask = self.mask[:num_candidates]
+        kth_score = -1.0
+        if num_candidates > topk:
+            kth = num_candidates - topk
+            partitioned = self.partitioned[:num_candidates]
+            partitioned[:] = scores
+            partitioned.partition(kth)
+            kth_score = partitioned[kth]
+        np.greater(scores, kth_score, out=mask)
+        num_above = np.count_nonzero(mask)
+        above_ids = ids[mask]
+        above_scores = scores[mask]
+        num_tied = 0
+        if kth_score >= 0:
+            # Move the record ids with another score to the end.
+            num_tied = topk - num_above
+            tied_ids = self.tied_ids[:num_candidates]
+            tied_ids[:] = ids
+            np.not_equal(scores, kth_score, out=mask)
+            np.copyto(tied_ids, np.iinfo(np.intp).max, where=mask)
+            tied_ids.partition(num_tied - 1)
+            ids[num_above:topk] = tied_ids[:num_tied]
+            scores[num_above:topk] = kth_score
+        ids[:num_above] = above_ids
+        scores[:num_above] = above_scores
+        return num_above + num_tied
+
+    def process_query_impact(self, words_list, topk, max_postings=None):
+        """
+        Returns the approximate topk results of process_query, computed
+        score at a time on the ImpactOrderedLists of the index (built on
+        the first call): the tiers of all query words are processed by
+        descending impact, adding their impacts into an accumulator, and
+        stops as soon as the remaining tiers can't change which records
+        are in the top k by impact. Tiers with impact 0 are never read, only
+        the first records of them are taken if there are fewer than k other
+        records. With max_postings, at most that many postings are read, so
+        the time per query is bounded even for very long lists. The records
+        closest to the top k by impact are rescored with their BM25 scores
+        to select the top k, ties are broken by record id. The number of
+        postings read is stored in num_scored.
+        >>> ii=InvertedIndex()
+        >>> ii.read_from_file("example.txt", 1.75, 0.75)
+        >>> ii.process_query_impact(["docum", "third"], 3)
+        [[3, 2.521], [1, 0.0], [2, 0.0]]
+        >>> ii.num_scored
+        1
+        >>> ii.process_query_impact(["third", "second", "first"], 2)
+        [[3, 2.521], [2, 2.325]]
+        >>> ii.num_scored
+        2
+        >>> ii.process_query_impact(["third", "second", "first"], 2, 1)
+        [[3, 2.521]]
+        """
+        if self.impact_lists is None:
+            self.impact_lists = ImpactOrderedLists(self.inverted_lists)
+        if self.impact_accumulator is None or \
+                len(self.impact_accumulator) != self.N + 1:
+            self.impact_accumulator = np.zeros(self.N + 1, dtype=np.int32)
+        lists = self.impact_lists
+        accumulator = self.impact_accumulator
+        counts = {}
+        for word in words_list:
+            if word in lists:
+                counts[word] = counts.get(word, 0) + 1
+        # Heap of [-contribution, tier, last tier, count] of the next tier
+        # of each word; bound is the sum of their contributions, which no
+        # record can gain anymore.
+        heap = []
+        bound = 0
+        for word, count in counts.items():
+            tiers = lists.tier_range(word)
+            contribution = int(lists.tier_impacts[tiers[0]]) * count
+            heap.append([-contribution, tiers[0], tiers[-1], count])
+            bound += contribution
+        heapq.heapify(heap)
+        self.num_scored = 0
+        touched = []
+        num_touched = 0
+        next_check = 0
+        while len(heap) > 0 and heap[0][0] < 0:
+            contribution, t, last, count = heap[0]
+            record_ids = lists.tier(t)[1]
+            if max_postings is not None:
+                record_ids = record_ids[:max_postings - self.num_scored]
+            new = record_ids[accumulator[record_ids] == 0]
+            touched.append(new)
+            num_touched += len(new)
+            # Record ids are unique within a tier, so no np.add.at.
+            accumulator[record_ids] -= contribution
+            self.num_scored += len(record_ids)
+            if max_postings is not None and self.num_scored >= max_postings:
+                break
+            bound += contribution
+            if t < last:
+                heap[0][0] = -int(lists.tier_impacts[t + 1]) * count
+                heap[0][1] = t + 1
+                bound -= heap[0][0]
+                heapq.heapreplace(heap, heap[0])
+            else:
+                heapq.heappop(heap)
+            # Check for early termination after reading as many postings as
+            # there are records hit, so the checks take linear time.
+            if num_touched >= topk and self.num_scored >= next_check:
+                next_check = self.num_scored + num_touched
+                touched = [np.concatenate(touched)]
+                hit_scores = np.partition(
+                    accumulator[touched[0]],
+                    [max(num_touched - topk - 1, 0), num_touched - topk])
+                kth_score = hit_scores[num_touched - topk]
+                next_score = hit_scores[num_touched - topk - 1] \
+                    if num_touched > topk else 0
+                if kth_score > next_score + bound:
+                    break
+        hits = np.concatenate(touched or [[]]).astype(np.uint32)
+        hit_scores = accumulator[hits]
+        accumulator[hits] = 0
+        order = np.lexsort((hits, -hit_scores))
+        if len(order) > topk:
+            # The quantization error of a record is less than half an
+            # impact per query word, so rescore all records within the sum
+            # of the counts of the k-th impact (at most 4k of them).
+            margin = sum(counts.values())
+            kth_score = hit_scores[order[topk - 1]]
+            order = order[:4 * topk][
+                hit_scores[order[:4 * topk]] >= kth_score - margin]
+        result = [record_id for record_id, _ in self.score_records(
+                    hits[order].tolist(), counts)[:topk]]
+        if len(result) < topk and len(heap) > 0 and heap[0][0] == 0 and \
+                (max_postings is None or self.num_scored < max_postings):
+            # Only tiers with impact 0 are left, fill up with their smallest
+            # record ids.
+            found = set(result)
+            zero_tiers = [iter(lists.tier(t)[1]) for _, t, _, _ in heap]
+            for record_id in heapq.merge(*zero_tiers):
+                if len(result) == topk:
+                    break
+                if int(record_id) not in found:
+                    found.add(int(record_id))
+                    result.append(int(record_id))
+        return self.score_records(result, counts)
+
+    def score_records(self, record_ids, counts):
+        """
+        Returns the given records with their BM25 score for the query words
+        counted in counts, sorted by descending score and record id.
+        >>> ii=InvertedIndex()
+        >>> ii.read_from_file("example.txt", 1.75, 0.75)
+        >>> ii.score_records([2, 3], {"third": 2, "docum": 1})
+        [[3, 5.042], [2, 0.0]]
+        """
+        scores = [0] * len(record_ids)
+        query_ids = np.array(record_ids, dtype=np.intp)
+        for word, count in counts.items():
+            ids, word_scores = self.get_posting_arrays(word)
+            positions = np.searchsorted(ids, query_ids)
+            for i, position in enumerate(positions.tolist()):
+                if position < len(ids) and ids[position] == record_ids[i]:
+                    for _ in range(count):
+                        scores[i] += float(word_scores[position])
+        return [[record_id, score] for score, record_id in sorted(
+            zip(scores, record_ids), key=lambda r: (-r[0], r[1]))]
+
+
+def init_worker(evaluator, private_scores=False):
+    """
+    Initializer of the worker processes of EvaluateBenchmark.grid_search and
+    EvaluateBenchmark.run_queries, which gets the evaluator from the forking
+    process. With private_scores, the index gets its own (uninitialized)
+    array of scores for rescore to write to, so that the arrays shared with
+    the forking process are only read and never copied on write.
+    """
+    global worker_evaluator
+    worker_evaluator = evaluator
+    if private_scores:
+        packed = evaluator.inverted_index.inverted_lists
+        packed.scores = np.empty(len(packed.scores))
+
+
+def evaluate_parameters(args):
+    """
+    Evaluate the benchmark file for (k, b) with the evaluator of the worker.
+    Returns (k, b, MP@3, MP@R, MAP).
+    """
+    return worker_evaluator.evaluate_parameters(*args)
+
+
+def evaluate_queries(queries):
+    """
+    Run the given (query, relevant_ids) pairs with the evaluator of the
+    worker. Returns a (P@3, P@R, AP, latency) tuple for each query.
+    """
+    return worker_evaluator.evaluate_queries(queries)
+
 
 class EvaluateBenchmark:
     """ Class for evaluating a given benchmark """
@@ -174,56 +1295,190 @@ class EvaluateBenchmark:
         >>> EB.average_precision([582,17,5666,10003,10],[10,582,877,10003])
         0.525
         """
-        i = 0
+        return self.evaluate_result(result_ids, relevant_ids)[2]
+
+    def evaluate_result(self, result_ids, relevant_ids):
+        """
+        Given result_ids and relevant_ids returns P@3, P@R and the average
+        precision, in one pass over result_ids.
+        >>> inverted_index = InvertedIndex()
+        >>> EB = EvaluateBenchmark(inverted_index)
+        >>> EB.evaluate_result([582,17,5666,10003,10],[10,582,877,10003])
+        (0.3333333333333333, 0.5, 0.525)
+        >>> EB.evaluate_result([4], [4, 5])
+        (0.3333333333333333, 0.5, 0.5)
+        """
+        relevant = set(relevant_ids)
+        R = len(relevant_ids)
+        hits = 0
+        hits_at_3 = None
+        hits_at_R = None
         ap = 0
-        intersection = 0
-        while i < len(result_ids):
-            j = 0
-            while j < len(relevant_ids):
-                if result_ids[i] == relevant_ids[j]:
-                    ap += self.precision_at_k(result_ids, relevant_ids, i + 1)
-                    intersection += 1
-                j += 1
-            i += 1
-        return ap / len(relevant_ids)
+        for i, result_id in enumerate(result_ids):
+            if i == 3:
+                hits_at_3 = hits
+            if i == R:
+                hits_at_R = hits
+            if result_id in relevant:
+                hits += 1
+                ap += hits / (i + 1)
+        if hits_at_3 is None:
+            hits_at_3 = hits
+        if hits_at_R is None:
+            hits_at_R = hits
+        return hits_at_3 / 3, hits_at_R / R, ap / R
 
-    def evaluate_benchmark(self, file_name):
+    def read_benchmark(self, file_name):
         """
-        Given the name of the benchmark file the method
-        calculates MP@3, MP@R and MAP
+        Returns the (query, relevant_ids) pairs of the given benchmark file.
+        >>> import tempfile
+        >>> file_name = os.path.join(tempfile.mkdtemp(), "benchmark.txt")
+        >>> with open(file_name, "w") as file:
+        ...     _ = file.write("second docum\\t2\\nthird docum\\t1 3\\n")
+        >>> EvaluateBenchmark(InvertedIndex()).read_benchmark(file_name)
+        [(['second', 'docum'], [2]), (['third', 'docum'], [1, 3])]
         """
-        map = 0
-        numberOfLines = 0
-        numberOfRelevant = 0
-        p3 = 0
-        pr = 0
+        queries = []
         with open(file_name, encoding='utf8') as file:
             for line in file:
                 word = line.split("\t")
-                query = re.split("\W+", word[0])
+                query = re.split(r"\W+", word[0])
                 relevant = [int(n) for n in word[1].split()]
-                numberOfRelevant = len(relevant)
-                result = self.inverted_index.process_query(
-                                    query, numberOfRelevant)
-                result = [row[0] for row in result]
-                map += self.average_precision(result, relevant)
-                p3 += self.precision_at_k(result, relevant, 3)
-                pr += self.precision_at_k(result, relevant, numberOfRelevant)
-                numberOfLines += 1
-        return p3 / numberOfLines, pr / numberOfLines, map / numberOfLines
+                queries.append((query, relevant))
+        return queries
+
+    def evaluate_queries(self, queries):
+        """
+        Run the given (query, relevant_ids) pairs with process_query, with
+        as many results as there are relevant ids. Returns a (P@3, P@R, AP,
+        latency) tuple for each query, with the latency of process_query in
+        seconds.
+        """
+        evaluation = []
+        for query, relevant in queries:
+            start = time.perf_counter()
+            result = self.inverted_index.process_query(query, len(relevant))
+            latency = time.perf_counter() - start
+            result = [row[0] for row in result]
+            evaluation.append(self.evaluate_result(result, relevant) +
+                              (latency,))
+        return evaluation
+
+    def run_queries(self, queries, num_processes=1):
+        """
+        Like evaluate_queries, but with num_processes > 1 the queries are
+        split into chunks that are evaluated in a pool of forked processes,
+        which share the index with this process.
+        """
+        if num_processes <= 1:
+            return self.evaluate_queries(queries)
+        chunk_size = max(1, len(queries) // (4 * num_processes))
+        chunks = [queries[i:i + chunk_size]
+                  for i in range(0, len(queries), chunk_size)]
+        with multiprocessing.get_context("fork").Pool(
+                num_processes, init_worker, (self,)) as pool:
+            return [row for chunk in pool.map(evaluate_queries, chunks)
+                    for row in chunk]
+
+    def evaluate_benchmark(self, file_name, num_processes=1):
+        """
+        Given the name of the benchmark file the method
+        calculates MP@3, MP@R and MAP
+        >>> import tempfile
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example.txt", 1.75, 0.75)
+        >>> file_name = os.path.join(tempfile.mkdtemp(), "benchmark.txt")
+        >>> with open(file_name, "w") as file:
+        ...     _ = file.write("second docum\\t2\\nthird\\t1 3\\n")
+        >>> EvaluateBenchmark(ii).evaluate_benchmark(file_name)
+        (0.3333333333333333, 0.75, 0.75)
+        """
+        return self.benchmark_report(file_name, num_processes)[:3]
+
+    def benchmark_report(self, file_name, num_processes=1):
+        """
+        Evaluate the benchmark file with num_processes processes. Returns
+        MP@3, MP@R, MAP, the throughput in queries per second and the p50,
+        p95 and p99 latency of a query in milliseconds.
+        >>> import tempfile
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example.txt", 1.75, 0.75)
+        >>> file_name = os.path.join(tempfile.mkdtemp(), "benchmark.txt")
+        >>> with open(file_name, "w") as file:
+        ...     _ = file.write("second docum\\t2\\nthird\\t1 3\\n" * 4)
+        >>> report = EvaluateBenchmark(ii).benchmark_report(file_name, 2)
+        >>> report[:3]
+        (0.3333333333333333, 0.75, 0.75)
+        >>> report[3] > 0, report[4] <= report[5] <= report[6]
+        (True, True)
+        """
+        queries = self.read_benchmark(file_name)
+        start = time.perf_counter()
+        evaluation = self.run_queries(queries, num_processes)
+        elapsed = time.perf_counter() - start
+        p3, pr, ap, latencies = zip(*evaluation)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+        return (sum(p3) / len(queries), sum(pr) / len(queries),
+                sum(ap) / len(queries), len(queries) / elapsed,
+                float(p50), float(p95), float(p99))
+
+    def evaluate_parameters(self, k, b, file_name):
+        """
+        Rescore the index with the parameters k and b and evaluate the
+        benchmark file. Returns (k, b, MP@3, MP@R, MAP).
+        """
+        self.inverted_index.rescore(k, b)
+        return (k, b) + self.evaluate_benchmark(file_name)
+
+    def grid_search(self, file_name, ks, bs, num_processes=1):
+        """
+        Evaluate the benchmark for all pairs of parameters k in ks and b in
+        bs, using rescore. Returns a list of (k, b, MP@3, MP@R, MAP). With
+        num_processes > 1, the pairs are evaluated in forked processes,
+        which share the record ids, term frequencies and document lengths
+        of the index with this process and rescore into their own array of
+        scores, so the index is not changed. Otherwise the index keeps the
+        scores of the last pair.
+        >>> import tempfile
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example.txt", 1.75, 0.75)
+        >>> file_name = os.path.join(tempfile.mkdtemp(), "benchmark.txt")
+        >>> with open(file_name, "w") as file:
+        ...     _ = file.write("second docum\\t2\\nthird docum\\t1 3\\n")
+        >>> EB = EvaluateBenchmark(ii)
+        >>> EB.grid_search(file_name, [1.75], [0.0, 0.75], 2)
+        [(1.75, 0.0, 0.5, 1.0, 1.0), (1.75, 0.75, 0.5, 1.0, 1.0)]
+        >>> ii.process_query(["third"], 1)
+        [[3, 2.521]]
+        """
+        parameters = [(k, b, file_name) for k in ks for b in bs]
+        if num_processes > 1:
+            with multiprocessing.get_context("fork").Pool(
+                    num_processes, init_worker, (self, True)) as pool:
+                return pool.map(evaluate_parameters, parameters)
+        return [self.evaluate_parameters(*kb) for kb in parameters]
+
 
 if __name__ == "__main__":
-    """ Output the lenghts of the inverted lists (= frequencies of the words) of
-    the given file. """
+    """ Evaluate the benchmark on the index of the given file. If an index
+    file is given, the index is loaded from it, or built and written to it if
+    it doesn't exist yet. """
     # Parse command line arguments.
-    if len(sys.argv) != 2:
-        print("Usage: python3 inverted_index.py <file>")
+    if len(sys.argv) not in [2, 3]:
+        print("Usage: python3 inverted_index.py <file> [<index file>]")
         sys.exit()
     file_name = sys.argv[1]
-    # Output the lengths.
-    ii = InvertedIndex()
-    k = 0.85
-    b = 0.05
-    ii.read_from_file(file_name, k, b)
+    if len(sys.argv) == 3 and os.path.exists(sys.argv[2]):
+        ii = InvertedIndex.load(sys.argv[2])
+    else:
+        ii = InvertedIndex()
+        k = 0.85
+        b = 0.05
+        ii.read_from_file(file_name, k, b, os.cpu_count())
+        if len(sys.argv) == 3:
+            ii.save(sys.argv[2])
     EB = EvaluateBenchmark(ii)
-    print(EB.evaluate_benchmark('movies-benchmark.txt'))
+    report = EB.benchmark_report('movies-benchmark.txt', os.cpu_count())
+    print("MP@3 %.3f, MP@R %.3f, MAP %.3f" % report[:3])
+    print("%.1f queries/s, latency p50 %.2fms, p95 %.2fms, p99 %.2fms"
+          % report[3:])
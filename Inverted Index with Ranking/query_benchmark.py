@@ -0,0 +1,110 @@
+"""
+Benchmark for the top-k query methods of the ranking index.
+
+Runs the queries of a benchmark file (or random queries taken from the lines
+of the indexed file) with process_query, process_query_wand,
+process_query_taat and process_query_impact (also with a budget of postings),
+checks that the exact methods return the same top-k scores and prints the
+number of postings scored, the time and the memory allocated per query, and
+the recall of the approximate methods.
+"""
+
+import random
+import re
+import sys
+import time
+import tracemalloc
+
+from inverted_index import InvertedIndex
+
+
+def read_queries(file_name):
+    """ Returns the query words of each line of a benchmark file. """
+    queries = []
+    with open(file_name, encoding='utf8') as file:
+        for line in file:
+            queries.append(re.split(r"\W+", line.split("\t")[0]))
+    return queries
+
+
+def random_queries(file_name, num_queries):
+    """ Returns num_queries queries of 2 to 4 words from random lines of the
+    given file. """
+    with open(file_name, encoding='utf8') as file:
+        lines = [[w.lower() for w in re.split(r"\W+", line) if len(w) > 2]
+                 for line in file]
+    lines = [words for words in lines if len(words) >= 2]
+    queries = []
+    for _ in range(num_queries):
+        words = random.choice(lines)
+        queries.append(random.sample(words, min(len(words),
+                                                random.randint(2, 4))))
+    return queries
+
+
+def run_benchmark(ii, queries, topk, max_postings):
+    """ Print the postings scored, the time and the peak memory allocated
+    per query for each query method. """
+    methods = [("exhaustive", ii.process_query),
+               ("WAND", ii.process_query_wand),
+               ("TAAT", ii.process_query_taat),
+               ("impact", ii.process_query_impact),
+               ("budget", lambda query, topk: ii.process_query_impact(
+                                            query, topk, max_postings))]
+    # Build the arrays of the term at a time and the impact ordered methods
+    # beforehand.
+    for query in queries:
+        ii.process_query_taat(query, topk)
+        ii.process_query_impact(query, topk)
+    print("Top-%d, %d queries" % (topk, len(queries)))
+    expected = [ii.process_query(query, topk) for query in queries]
+    for name, method in methods:
+        num_postings = 0
+        total_time = 0
+        total_memory = 0
+        recall = 0
+        for query, expected_result in zip(queries, expected):
+            start = time.perf_counter()
+            result = method(query, topk)
+            total_time += time.perf_counter() - start
+            if name in ["WAND", "impact", "budget"]:
+                num_postings += ii.num_scored
+            else:
+                num_postings += sum(len(ii.inverted_lists[word])
+                                    for word in query
+                                    if word in ii.inverted_lists)
+            if name in ["impact", "budget"]:
+                # The records with the k-th best score are interchangeable.
+                kth_score = min((e[1] for e in expected_result), default=0)
+                recall += len([r for r in result if r[1] >= kth_score]) / \
+                    max(1, len(expected_result))
+            elif sorted(r[1] for r in result) != sorted(
+                    e[1] for e in expected_result):
+                print("Different results for query", query)
+            tracemalloc.start()
+            method(query, topk)
+            total_memory += tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        n = len(queries)
+        print("%-10s %10.1f postings/query, %8.3fms/query, %10.0f bytes/query"
+              % (name + ":", num_postings / n, total_time * 1000 / n,
+                 total_memory / n), end="")
+        if name in ["impact", "budget"]:
+            print(", recall %.3f" % (recall / n), end="")
+        print()
+
+
+if __name__ == "__main__":
+    """ Build the index of the given file and run the benchmark. """
+    if len(sys.argv) not in [2, 3]:
+        print("Usage: python3 query_benchmark.py <file> [<benchmark>]")
+        sys.exit()
+    random.seed(42)
+    ii = InvertedIndex()
+    ii.read_from_file(sys.argv[1], 0.85, 0.05)
+    if len(sys.argv) == 3:
+        queries = read_queries(sys.argv[2])
+    else:
+        queries = random_queries(sys.argv[1], 200)
+    for topk in [10, 100]:
+        run_benchmark(ii, queries, topk, 10 * topk)
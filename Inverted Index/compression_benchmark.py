@@ -0,0 +1,69 @@
+"""
+Memory report for compressed posting lists.
+
+Builds an InvertedIndex over a synthetic corpus with Zipf-distributed words,
+and prints the bytes per posting of the plain Python lists and of the
+compressed PostingLists, as well as the time of a few queries on both.
+"""
+
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+from inverted_index import InvertedIndex
+
+
+def write_synthetic_corpus(file_name, num_docs, num_words, doc_length):
+    """ Write num_docs lines of doc_length words drawn from a Zipf
+    distribution over num_words words. """
+    words = ["w%d" % i for i in range(num_words)]
+    cum_weights = list(itertools.accumulate(1 / (i + 1)
+                                            for i in range(num_words)))
+    with open(file_name, "w") as file:
+        for _ in range(num_docs):
+            file.write(" ".join(random.choices(
+                words, cum_weights=cum_weights, k=doc_length)) + "\n")
+
+
+def list_memory_size(inverted_list):
+    """ Returns the number of bytes used by a list of Python ints. """
+    return sys.getsizeof(inverted_list) + sum(sys.getsizeof(doc_id)
+                                              for doc_id in inverted_list)
+
+
+def time_queries(ii, queries):
+    """ Returns the average time in ms of one query. """
+    start = time.perf_counter()
+    for query in queries:
+        ii.search(query)
+    return (time.perf_counter() - start) * 1000 / len(queries)
+
+
+if __name__ == "__main__":
+    """ Build the synthetic corpus and print the report. """
+    num_docs = 100000
+    if len(sys.argv) > 1:
+        num_docs = int(sys.argv[1])
+    random.seed(42)
+    file_name = os.path.join(tempfile.mkdtemp(), "synthetic.txt")
+    write_synthetic_corpus(file_name, num_docs, 20000, 20)
+    ii = InvertedIndex()
+    ii.read_from_file(file_name)
+    os.remove(file_name)
+    queries = [["w0", "w%d" % random.randrange(1, 2000)] for _ in range(200)]
+
+    num_postings = sum(len(il) for il in ii.inverted_lists.values())
+    before = sum(list_memory_size(il) for il in ii.inverted_lists.values())
+    time_before = time_queries(ii, queries)
+    ii.compress()
+    after = sum(il.memory_size() for il in ii.inverted_lists.values())
+    time_after = time_queries(ii, queries)
+
+    print("Postings: %d" % num_postings)
+    print("list:        %6.2f bytes/posting, %.3fms/query"
+          % (before / num_postings, time_before))
+    print("PostingList: %6.2f bytes/posting, %.3fms/query"
+          % (after / num_postings, time_after))
@@ -0,0 +1,53 @@
+"""
+Micro-benchmark for the intersection strategies of InvertedIndex.
+
+Intersects a short random list with a long random list for several length
+ratios and prints the time per intersection of each strategy.
+"""
+
+import random
+import sys
+import time
+
+from inverted_index import InvertedIndex
+
+
+def random_list(length, universe):
+    """ Returns a sorted list of length distinct ids from 1..universe.
+
+    >>> l = random_list(5, 10)
+    >>> len(l), l == sorted(set(l))
+    (5, True)
+    """
+    return sorted(random.sample(range(1, universe + 1), length))
+
+
+def time_strategy(ii, strategy, list1, list2, repeats):
+    """ Returns the average time in ms of one intersection. """
+    start = time.perf_counter()
+    for _ in range(repeats):
+        ii.intersect_lists(list1, list2, strategy)
+    return (time.perf_counter() - start) * 1000 / repeats
+
+
+def run_benchmark(long_length, ratios, repeats):
+    """ Print a table with the time per strategy for each length ratio. """
+    ii = InvertedIndex()
+    strategies = ["linear", "galloping", "skip", "auto"]
+    universe = 4 * long_length
+    print("%8s" % "ratio" + "".join("%12s" % s for s in strategies))
+    for ratio in ratios:
+        list1 = random_list(max(1, long_length // ratio), universe)
+        list2 = random_list(long_length, universe)
+        times = [time_strategy(ii, s, list1, list2, repeats)
+                 for s in strategies]
+        print("%8d" % ratio + "".join("%10.3fms" % t for t in times))
+
+
+if __name__ == "__main__":
+    """ Run the benchmark with an optional length of the long list. """
+    long_length = 100000
+    if len(sys.argv) > 1:
+        long_length = int(sys.argv[1])
+    random.seed(42)
+    run_benchmark(long_length, [1, 2, 4, 8, 16, 64, 256, 1024], 5)
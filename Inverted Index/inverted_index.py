@@ -3,8 +3,509 @@ Copyright 2016 University of Freiburg
 Hannah Bast <bast@cs.uni-freiburg.de>
 """
 
+import bisect
+import heapq
+import io
+import math
+import mmap
+import os
 import re
+import shutil
+import struct
 import sys
+import tempfile
+import zlib
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
+
+# Use galloping search instead of the linear merge once the longer list is
+# at least this many times longer than the shorter one.
+GALLOP_RATIO = 8
+
+# Number of postings per block of a compressed posting list. The first doc id
+# and byte offset of each block are kept uncompressed for skipping.
+BLOCK_SIZE = 128
+
+# Header of an index file written by InvertedIndex.save: magic, format
+# version, number of words and whether the word positions are stored (0 or 1).
+INDEX_FILE_HEADER = "<4sIII"
+INDEX_FILE_MAGIC = b"IIBL"
+INDEX_FILE_VERSION = 2
+
+# Header of a document store file written by DocumentStore.build: magic,
+# format version, number of records and number of records per compressed
+# block (0 if not compressed).
+DOCUMENT_STORE_HEADER = "<4sIII"
+DOCUMENT_STORE_MAGIC = b"DOCS"
+DOCUMENT_STORE_VERSION = 1
+
+# Rough number of bytes used by a new word and by a posting of the in-memory
+# inverted lists, used to decide when to write a run in build_index_file.
+WORD_MEMORY = 150
+POSTING_MEMORY = 40
+
+# Number of postings of an inverted list read from a run file at a time by
+# merge_runs.
+MERGE_CHUNK_SIZE = 65536
+
+# Maximum total number of postings of the decoded inverted lists kept by
+# MappedInvertedLists. The least recently used lists are dropped first.
+MAPPED_CACHE_POSTINGS = 2 ** 20
+
+
+def decode_deltas(data):
+    """ Decode variable-byte encoded gaps and yield the running sums.
+
+    >>> list(decode_deltas(bytes([131, 132, 37, 130])))
+    [3, 7, 300]
+    """
+    doc_id = 0
+    delta = 0
+    shift = 0
+    for byte in data:
+        if byte < 128:
+            delta |= byte << shift
+            shift += 7
+        else:
+            doc_id += delta | ((byte & 127) << shift)
+            delta = 0
+            shift = 0
+            yield doc_id
+
+
+def encode_deltas(doc_ids, last_id=0):
+    """ Returns the variable-byte encoded gaps of the increasing doc ids,
+    the first one relative to last_id, as a bytearray.
+
+    >>> list(encode_deltas([3, 7, 300])), list(encode_deltas([7], 3))
+    ([131, 132, 37, 130], [132])
+    """
+    data = bytearray()
+    for doc_id in doc_ids:
+        delta = doc_id - last_id
+        while delta >= 128:
+            data.append(delta & 127)
+            delta >>= 7
+        data.append(delta | 128)
+        last_id = doc_id
+    return data
+
+
+class PostingList:
+    """ A compressed list of increasing doc ids. The ids are delta encoded
+    with variable-byte encoding into a bytearray, with a skip entry every
+    BLOCK_SIZE postings.
+
+    >>> pl = PostingList([3, 7, 300, 100000])
+    >>> len(pl), list(pl)
+    (4, [3, 7, 300, 100000])
+    >>> list(pl.data)
+    [131, 132, 37, 130, 116, 10, 134]
+    """
+
+    def __init__(self, doc_ids=()):
+        """ Create a compressed posting list from the given doc ids. """
+        self.data = bytearray()
+        # First doc id of each block and the byte offset right after it.
+        self.skip_ids = array('I')
+        self.skip_offsets = array('I')
+        self.size = 0
+        self.last_id = 0
+        for doc_id in doc_ids:
+            self.append(doc_id)
+
+    def append(self, doc_id):
+        """ Append a doc id larger than all doc ids in the list. """
+        delta = doc_id - self.last_id
+        # Lower 7 bits first, the last byte of each number has the high bit.
+        while delta >= 128:
+            self.data.append(delta & 127)
+            delta >>= 7
+        self.data.append(delta | 128)
+        if self.size % BLOCK_SIZE == 0:
+            self.skip_ids.append(doc_id)
+            self.skip_offsets.append(len(self.data))
+        self.size += 1
+        self.last_id = doc_id
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        """ Decode the doc ids one after the other. """
+        return decode_deltas(self.data)
+
+    def cursor(self):
+        """ Returns a new cursor at the start of the list. """
+        return PostingListCursor(self)
+
+    def memory_size(self):
+        """ Returns the number of bytes used by the list. """
+        return (sys.getsizeof(self) + sys.getsizeof(self.data) +
+                sys.getsizeof(self.skip_ids) +
+                sys.getsizeof(self.skip_offsets))
+
+
+class PositionLists:
+    """ The word positions in each record of one inverted list. The
+    positions of all records are delta encoded with variable-byte encoding
+    into one bytearray, with the start offset of each record in an array.
+
+    >>> pl = PositionLists()
+    >>> pl.append([0, 5, 130])
+    >>> pl.append([2])
+    >>> len(pl), pl[0], pl[1]
+    (2, [0, 5, 130], [2])
+    """
+
+    def __init__(self):
+        """ Create empty position lists. """
+        self.data = bytearray()
+        self.offsets = array('I', [0])
+
+    def append(self, positions):
+        """ Append the increasing positions of the next record. """
+        last = 0
+        for position in positions:
+            delta = position - last
+            while delta >= 128:
+                self.data.append(delta & 127)
+                delta >>= 7
+            self.data.append(delta | 128)
+            last = position
+        self.offsets.append(len(self.data))
+
+    def __getitem__(self, i):
+        """ Returns the positions of the i-th record of the list. """
+        return list(decode_deltas(
+                    self.data[self.offsets[i]:self.offsets[i + 1]]))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class PostingListCursor:
+    """ A cursor over a PostingList that only moves forward.
+
+    >>> pl = PostingList(range(1, 1000, 3))
+    >>> cursor = pl.cursor()
+    >>> cursor.next_geq(2), cursor.next_geq(4), cursor.next_geq(500)
+    (4, 4, 502)
+    >>> cursor.next_geq(997), cursor.next_geq(998)
+    (997, None)
+    """
+
+    def __init__(self, posting_list):
+        """ Create a cursor before the first posting. """
+        self.posting_list = posting_list
+        # Byte offset and index of the next posting to decode.
+        self.offset = 0
+        self.index = 0
+        self.current = 0
+
+    def next_geq(self, target):
+        """ Returns the smallest doc id >= target at or after the current
+        position, or None if there is no such doc id. """
+        if self.index > 0 and self.current >= target:
+            return self.current
+        pl = self.posting_list
+        # Jump to the last block starting at or before target, if it is
+        # ahead of the current position.
+        block = bisect.bisect_right(pl.skip_ids, target) - 1
+        if block >= 0 and block * BLOCK_SIZE + 1 > self.index:
+            self.current = pl.skip_ids[block]
+            self.offset = pl.skip_offsets[block]
+            self.index = block * BLOCK_SIZE + 1
+            if self.current >= target:
+                return self.current
+        data = pl.data
+        while self.index < pl.size:
+            delta = 0
+            shift = 0
+            byte = data[self.offset]
+            while byte < 128:
+                delta |= byte << shift
+                shift += 7
+                self.offset += 1
+                byte = data[self.offset]
+            self.offset += 1
+            self.current += delta | ((byte & 127) << shift)
+            self.index += 1
+            if self.current >= target:
+                return self.current
+        return None
+
+
+def write_run(file_name, inverted_lists):
+    """ Write the inverted lists sorted by word to a temporary run file of
+    build_index_file. Each word is stored as its length and the length of
+    its list (uint32), the utf-8 encoded word and the doc ids (uint32). """
+    with open(file_name, "wb") as file:
+        for word in sorted(word.encode("utf8") for word in inverted_lists):
+            inverted_list = inverted_lists[word.decode("utf8")]
+            file.write(struct.pack("<II", len(word), len(inverted_list)))
+            file.write(word)
+            file.write(array("I", inverted_list).tobytes())
+
+
+def read_run(file, chunk_size=MERGE_CHUNK_SIZE):
+    """ Yield the (word, chunks) of an open run file written by write_run,
+    with the word as utf-8 bytes. chunks is a generator of the doc ids of
+    the inverted list, at most chunk_size at a time. Only the word is read
+    here, the doc ids are read by chunks, which can be used after later
+    words were read.
+
+    >>> file_name = os.path.join(tempfile.mkdtemp(), "run")
+    >>> write_run(file_name, {"b": [1, 4], "a": [3]})
+    >>> with open(file_name, "rb") as file:
+    ...     runs = list(read_run(file, 1))
+    ...     [(word, [list(doc_ids) for doc_ids in chunks])
+    ...      for word, chunks in runs]
+    [(b'a', [[3]]), (b'b', [[1], [4]])]
+    """
+    while True:
+        header = file.read(8)
+        if len(header) == 0:
+            break
+        word_length, list_length = struct.unpack("<II", header)
+        word = file.read(word_length)
+        yield word, read_run_postings(file, file.tell(), list_length,
+                                      chunk_size)
+        file.seek(4 * list_length, os.SEEK_CUR)
+
+
+def read_run_postings(file, offset, list_length, chunk_size):
+    """ Yield the doc ids of the inverted list at the given offset of a run
+    file in chunks of at most chunk_size. Uses os.pread, so the position
+    of the file is not changed. """
+    for start in range(0, list_length, chunk_size):
+        doc_ids = array("I")
+        doc_ids.frombytes(os.pread(
+            file.fileno(), 4 * min(chunk_size, list_length - start),
+            offset + 4 * start))
+        yield doc_ids
+
+
+class MappedInvertedLists(Mapping):
+    """ Read-only mapping from word to inverted list, backed by a memory
+    mapped index file written by InvertedIndex.save. Words are found by
+    binary search in the sorted vocabulary, and an inverted list is only
+    read and decoded on access. The decoded lists are cached, up to a total
+    of cache_size postings. """
+
+    def __init__(self, file_name, cache_size=MAPPED_CACHE_POSTINGS):
+        """ Memory map the given index file. """
+        with open(file_name, "rb") as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.num_words, self.has_positions = \
+            struct.unpack_from(INDEX_FILE_HEADER, self.mmap)
+        if magic != INDEX_FILE_MAGIC or version != INDEX_FILE_VERSION:
+            raise ValueError("Not an index file: %s" % file_name)
+        view = memoryview(self.mmap)
+        pos = struct.calcsize(INDEX_FILE_HEADER)
+        table_size = 8 * (self.num_words + 1)
+        self.word_offsets = view[pos:pos + table_size].cast("Q")
+        pos += table_size
+        self.list_offsets = view[pos:pos + table_size].cast("Q")
+        pos += table_size
+        if self.has_positions:
+            self.position_offsets = view[pos:pos + table_size].cast("Q")
+            pos += table_size
+        self.words_start = pos
+        self.lists_start = pos + self.word_offsets[self.num_words]
+        self.positions_start = self.lists_start + self.list_offsets[
+                                                        self.num_words]
+        # The decoded inverted lists, least recently used first.
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cached_postings = 0
+
+    def word_at(self, i):
+        """ Returns the i-th word (as utf-8 bytes) of the vocabulary. """
+        return self.mmap[self.words_start + self.word_offsets[i]:
+                         self.words_start + self.word_offsets[i + 1]]
+
+    def find(self, word):
+        """ Returns the position of word in the vocabulary or -1. """
+        key = word.encode("utf8")
+        lo = 0
+        hi = self.num_words
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.word_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_words and self.word_at(lo) == key:
+            return lo
+        return -1
+
+    def __getitem__(self, word):
+        """ Returns the inverted list of word.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example.txt")
+        >>> file_name = os.path.join(tempfile.mkdtemp(), "example.idx")
+        >>> ii.save(file_name)
+        >>> lists = MappedInvertedLists(file_name, cache_size=4)
+        >>> lists["doc"], lists["first"], lists["third"]
+        ([1, 2, 3], [1], [3])
+        >>> list(lists.cache), lists.cached_postings
+        (['first', 'third'], 2)
+        """
+        if word in self.cache:
+            self.cache.move_to_end(word)
+            return self.cache[word]
+        i = self.find(word)
+        if i < 0:
+            raise KeyError(word)
+        data = self.mmap[self.lists_start + self.list_offsets[i]:
+                         self.lists_start + self.list_offsets[i + 1]]
+        inverted_list = list(decode_deltas(data))
+        if len(inverted_list) <= self.cache_size:
+            self.cache[word] = inverted_list
+            self.cached_postings += len(inverted_list)
+            while self.cached_postings > self.cache_size:
+                _, dropped = self.cache.popitem(last=False)
+                self.cached_postings -= len(dropped)
+        return inverted_list
+
+    def __contains__(self, word):
+        return word in self.cache or self.find(word) >= 0
+
+    def __iter__(self):
+        for i in range(self.num_words):
+            yield self.word_at(i).decode("utf8")
+
+    def __len__(self):
+        return self.num_words
+
+
+class MappedPositionLists(Mapping):
+    """ Read-only mapping from word to its PositionLists, backed by the
+    positions stored in the index file of the given MappedInvertedLists.
+    The PositionLists of a word are read from the file on each access. """
+
+    def __init__(self, inverted_lists):
+        """ Use the positions of the given MappedInvertedLists. """
+        self.inverted_lists = inverted_lists
+
+    def __getitem__(self, word):
+        lists = self.inverted_lists
+        i = lists.find(word)
+        if i < 0:
+            raise KeyError(word)
+        # The number of records, their offsets and the encoded positions.
+        block = lists.mmap[lists.positions_start + lists.position_offsets[i]:
+                           lists.positions_start +
+                           lists.position_offsets[i + 1]]
+        num_records = array("I", block[:4])[0]
+        position_lists = PositionLists()
+        position_lists.offsets = array("I", block[4:4 * num_records + 8])
+        position_lists.data = block[4 * num_records + 8:]
+        return position_lists
+
+    def __iter__(self):
+        return iter(self.inverted_lists)
+
+    def __len__(self):
+        return len(self.inverted_lists)
+
+
+class DocumentStore:
+    """ Random access to the records (lines) of a file by record id, without
+    keeping the file in memory. The store file has a header, a table of
+    byte offsets (uint64, native byte order) and the records, either as they
+    are or compressed with zlib in blocks of block_size records. In the
+    first case the table has the offset of each record, in the second case
+    the offset of each block.
+
+    >>> store_file_name = os.path.join(tempfile.mkdtemp(), "example.docs")
+    >>> DocumentStore.build("example.txt", store_file_name)
+    >>> store = DocumentStore(store_file_name)
+    >>> len(store), store[2], store[3]
+    (3, 'Second doc.\\n', 'Third doc.\\n')
+    >>> DocumentStore.build("example.txt", store_file_name, block_size=2)
+    >>> store = DocumentStore(store_file_name)
+    >>> store[3], store[1], store[2]
+    ('Third doc.\\n', 'First doc.\\n', 'Second doc.\\n')
+    """
+
+    def __init__(self, file_name):
+        """ Memory map the given document store file. """
+        with open(file_name, "rb") as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.num_records, self.block_size = \
+            struct.unpack_from(DOCUMENT_STORE_HEADER, self.mmap)
+        if magic != DOCUMENT_STORE_MAGIC or version != DOCUMENT_STORE_VERSION:
+            raise ValueError("Not a document store file: %s" % file_name)
+        if self.block_size > 0:
+            num_entries = (self.num_records + self.block_size - 1) // \
+                self.block_size
+        else:
+            num_entries = self.num_records
+        pos = struct.calcsize(DOCUMENT_STORE_HEADER)
+        self.offsets = memoryview(self.mmap)[
+                        pos:pos + 8 * (num_entries + 1)].cast("Q")
+        self.data_start = pos + 8 * (num_entries + 1)
+        # The last decompressed block and its number.
+        self.block = None
+        self.block_id = -1
+
+    @staticmethod
+    def build(file_name, store_file_name, block_size=0):
+        """ Write the document store of the given file. If block_size > 0,
+        the records are compressed in blocks of that many records. """
+        offsets = array("Q", [0])
+        num_records = 0
+        with open(file_name, "rb") as file, \
+                tempfile.TemporaryFile(dir=os.path.dirname(
+                    os.path.abspath(store_file_name))) as data_file:
+            block = []
+            for line in file:
+                num_records += 1
+                if block_size == 0:
+                    data_file.write(line)
+                    offsets.append(offsets[-1] + len(line))
+                    continue
+                block.append(line)
+                if len(block) == block_size:
+                    data = zlib.compress(b"".join(block))
+                    data_file.write(data)
+                    offsets.append(offsets[-1] + len(data))
+                    block = []
+            if len(block) > 0:
+                data = zlib.compress(b"".join(block))
+                data_file.write(data)
+                offsets.append(offsets[-1] + len(data))
+            data_file.seek(0)
+            with open(store_file_name, "wb") as store_file:
+                store_file.write(struct.pack(
+                    DOCUMENT_STORE_HEADER, DOCUMENT_STORE_MAGIC,
+                    DOCUMENT_STORE_VERSION, num_records, block_size))
+                store_file.write(offsets.tobytes())
+                shutil.copyfileobj(data_file, store_file)
+
+    def __getitem__(self, record_id):
+        """ Returns the record with the given id (starting at 1). """
+        if record_id < 1 or record_id > self.num_records:
+            raise IndexError(record_id)
+        i = record_id - 1
+        if self.block_size == 0:
+            return self.mmap[self.data_start + self.offsets[i]:
+                             self.data_start + self.offsets[i + 1]].decode(
+                                                                    "utf8")
+        block_id = i // self.block_size
+        if block_id != self.block_id:
+            data = self.mmap[self.data_start + self.offsets[block_id]:
+                             self.data_start + self.offsets[block_id + 1]]
+            self.block = io.BytesIO(zlib.decompress(data)).readlines()
+            self.block_id = block_id
+        return self.block[i % self.block_size].decode("utf8")
+
+    def __len__(self):
+        return self.num_records
 
 
 class InvertedIndex:
@@ -14,30 +515,70 @@ class InvertedIndex:
         """ Create an empty inverted index. """
 
         self.inverted_lists = {}
+        # The PositionLists of each word, parallel to its inverted list, or
+        # None if positions are not stored.
+        self.positions = None
 
-    def read_from_file(self, file_name):
-        """ Construct from given file (one record per line).
+    def read_from_file(self, file_name, positional=False):
+        """ Construct from given file (one record per line). If positional is
+        True, also store the positions of the words in each record, which
+        are needed for phrase_search and proximity_search.
 
         >>> ii = InvertedIndex()
         >>> ii.read_from_file("example.txt")
         >>> sorted(ii.inverted_lists.items())
         [('doc', [1, 2, 3]), ('first', [1]), ('second', [2]), ('third', [3])]
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example.txt", positional=True)
+        >>> ii.positions["doc"][2]
+        [1]
         """
 
+        if positional:
+            self.positions = {}
         record_id = 0
         with open(file_name) as file:
             for line in file:
                 record_id += 1
-                for word in re.split("\W+", line):
-                    word = word.lower()
-                    if len(word) > 0:
-                        # If word seen first time, create inverted list.
-                        if word not in self.inverted_lists:
-                            self.inverted_lists[word] = []
-                            self.inverted_lists[word].append(record_id)
-                        elif record_id != self.inverted_lists[word][len(
-                                            self.inverted_lists[word]) - 1]:
-                            self.inverted_lists[word].append(record_id)
+                self.add_record(record_id, line)
+
+    def add_record(self, record_id, line):
+        """ Add the words of line to the inverted lists as record record_id,
+        which must be larger than all record ids added before. Returns the
+        number of postings added, that is the number of distinct words in
+        the line.
+
+        >>> ii = InvertedIndex()
+        >>> ii.add_record(1, "a doc, another doc, a doc")
+        3
+        """
+
+        num_words = 0
+        num_postings = 0
+        positions = {}
+        for word in re.split("\W+", line):
+            word = word.lower()
+            if len(word) > 0:
+                if self.positions is not None:
+                    if word not in positions:
+                        positions[word] = []
+                    positions[word].append(num_words)
+                num_words += 1
+                # If word seen first time, create inverted list.
+                if word not in self.inverted_lists:
+                    self.inverted_lists[word] = []
+                    self.inverted_lists[word].append(record_id)
+                    num_postings += 1
+                elif record_id != self.inverted_lists[word][len(
+                                    self.inverted_lists[word]) - 1]:
+                    self.inverted_lists[word].append(record_id)
+                    num_postings += 1
+        # Each distinct word of the line got exactly one new posting above.
+        for word, word_positions in positions.items():
+            if word not in self.positions:
+                self.positions[word] = PositionLists()
+            self.positions[word].append(word_positions)
+        return num_postings
 
     def intersect(self, list1, list2):
         """ Returns the intersection of two lists
@@ -61,42 +602,461 @@ class InvertedIndex:
                 i += 1
         return intersected_list
 
-    def search(self, words_list):
-        """ Returns the indices of matching query """
+    def intersect_galloping(self, list1, list2):
+        """ Returns the intersection of two lists, where list1 is the shorter
+        one. For each element of list1, the position in list2 is found by
+        exponential (galloping) search followed by a binary search.
+        >>> ii=InvertedIndex()
+        >>> ii.intersect_galloping([3, 9, 40], [1, 2, 3, 5, 8, 9, 13, 21, 40])
+        [3, 9, 40]
+        >>> ii.intersect_galloping([4, 50], [1, 2, 3, 5, 8, 9, 13, 21, 40])
+        []
+        """
+        j = 0
+        n = len(list2)
+        intersected_list = []
+        for x in list1:
+            if j >= n:
+                break
+            # Double the step until we jump past x, then binary search.
+            step = 1
+            while j + step < n and list2[j + step] < x:
+                step *= 2
+            hi = min(j + step + 1, n)
+            j = bisect.bisect_left(list2, x, j + step // 2, hi)
+            if j < n and list2[j] == x:
+                intersected_list.append(x)
+                j += 1
+        return intersected_list
 
-        if words_list[0] not in self.inverted_lists:
-            return []
-        intersected_list = self.inverted_lists[words_list[0]]
-        i = 1
-        while i < len(words_list):
-            if words_list[i] not in self.inverted_lists:
+    def intersect_skip(self, list1, list2):
+        """ Returns the intersection of two lists, where list1 is the shorter
+        one. list2 is traversed with implicit skip pointers every
+        sqrt(len(list2)) elements.
+        >>> ii=InvertedIndex()
+        >>> ii.intersect_skip([3, 9, 40], [1, 2, 3, 5, 8, 9, 13, 21, 40])
+        [3, 9, 40]
+        >>> ii.intersect_skip([4, 50], [1, 2, 3, 5, 8, 9, 13, 21, 40])
+        []
+        """
+        j = 0
+        n = len(list2)
+        skip = max(1, int(math.sqrt(n)))
+        intersected_list = []
+        for x in list1:
+            # Follow skip pointers as long as they don't overshoot x.
+            while j + skip < n and list2[j + skip] <= x:
+                j += skip
+            while j < n and list2[j] < x:
+                j += 1
+            if j >= n:
+                break
+            if list2[j] == x:
+                intersected_list.append(x)
+                j += 1
+        return intersected_list
+
+    def intersect_cursor(self, list1, list2):
+        """ Returns the intersection of a list1 (list or PostingList) and a
+        PostingList list2, without decompressing list2 completely.
+        >>> ii=InvertedIndex()
+        >>> ii.intersect_cursor([3, 9, 40], PostingList(range(0, 500, 3)))
+        [3, 9]
+        """
+        cursor = list2.cursor()
+        intersected_list = []
+        for x in list1:
+            y = cursor.next_geq(x)
+            if y is None:
+                break
+            if y == x:
+                intersected_list.append(x)
+        return intersected_list
+
+    def intersect_lists(self, list1, list2, strategy="auto"):
+        """ Returns the intersection of two lists using the given strategy
+        ("linear", "galloping", "skip" or "auto"). With "auto", the linear
+        merge is used for lists of similar length and galloping search once
+        the lengths differ by at least GALLOP_RATIO.
+        >>> ii=InvertedIndex()
+        >>> ii.intersect_lists([1, 2, 3], [1, 2])
+        [1, 2]
+        >>> ii.intersect_lists(list(range(0, 100, 3)), [6, 7, 99], "skip")
+        [6, 99]
+        """
+        if len(list1) > len(list2):
+            list1, list2 = list2, list1
+        if isinstance(list2, PostingList):
+            return self.intersect_cursor(list1, list2)
+        if isinstance(list1, PostingList):
+            list1 = list(list1)
+        if strategy == "auto":
+            if len(list2) >= GALLOP_RATIO * len(list1):
+                strategy = "galloping"
+            else:
+                strategy = "linear"
+        if strategy == "linear":
+            return self.intersect(list1, list2)
+        elif strategy == "galloping":
+            return self.intersect_galloping(list1, list2)
+        elif strategy == "skip":
+            return self.intersect_skip(list1, list2)
+        raise ValueError("Unknown intersection strategy: %s" % strategy)
+
+    def search(self, words_list, strategy="auto"):
+        """ Returns the indices of matching query. The inverted lists are
+        intersected from the shortest to the longest.
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example.txt")
+        >>> ii.search(["doc", "second"])
+        [2]
+        >>> ii.search(["doc", "fourth"])
+        []
+        """
+
+        lists = []
+        for word in words_list:
+            if word not in self.inverted_lists:
                 return []
-            intersected_list = self.intersect(
-                                intersected_list,
-                                self.inverted_lists[words_list[i]])
-            i += 1
+            lists.append(self.inverted_lists[word])
+        if len(lists) == 0:
+            return []
+        lists.sort(key=len)
+        intersected_list = lists[0]
+        for inverted_list in lists[1:]:
+            if len(intersected_list) == 0:
+                break
+            intersected_list = self.intersect_lists(
+                                intersected_list, inverted_list, strategy)
+        if isinstance(intersected_list, PostingList):
+            intersected_list = list(intersected_list)
         return intersected_list
 
+    def record_positions(self, words_list, record_ids):
+        """ Returns for each of the given (increasing) record ids, which must
+        contain all words of words_list, the list of positions of each word.
+        """
+        inverted_lists = []
+        for word in words_list:
+            inverted_list = self.inverted_lists[word]
+            if isinstance(inverted_list, PostingList):
+                inverted_list = list(inverted_list)
+            inverted_lists.append(inverted_list)
+        position_lists = [self.positions[word] for word in words_list]
+        lows = [0] * len(words_list)
+        result = []
+        for record_id in record_ids:
+            record_positions = []
+            for i in range(len(words_list)):
+                lows[i] = bisect.bisect_left(inverted_lists[i], record_id,
+                                             lows[i])
+                record_positions.append(position_lists[i][lows[i]])
+            result.append(record_positions)
+        return result
+
+    def phrase_search(self, words_list):
+        """ Returns the indices of the records containing the words of
+        words_list as a phrase, that is, at consecutive positions. Needs an
+        index read with positional=True.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example2.txt", positional=True)
+        >>> ii.phrase_search(["web", "surfing"])
+        [1, 3, 4]
+        >>> ii.phrase_search(["surfing", "web"])
+        []
+        >>> ii.phrase_search(["surfing", "surfing", "beach"])
+        [4]
+        """
+
+        if self.positions is None:
+            raise ValueError("Phrase search needs a positional index")
+        record_ids = self.search(words_list)
+        result = []
+        for record_id, record_positions in zip(
+                record_ids, self.record_positions(words_list, record_ids)):
+            # Positions where the phrase would start, according to each word.
+            starts = set(record_positions[0])
+            for i in range(1, len(words_list)):
+                starts &= set(p - i for p in record_positions[i])
+                if len(starts) == 0:
+                    break
+            if len(starts) > 0:
+                result.append(record_id)
+        return result
+
+    def proximity_search(self, words_list, window):
+        """ Returns the indices of the records containing all words of
+        words_list, in any order, within window consecutive positions.
+        Needs an index read with positional=True.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example2.txt", positional=True)
+        >>> ii.proximity_search(["beach", "internet"], 5)
+        [4]
+        >>> ii.proximity_search(["beach", "internet"], 4)
+        []
+        >>> ii.proximity_search(["beach", "surfing"], 2)
+        [4, 5, 6]
+        """
+
+        if self.positions is None:
+            raise ValueError("Proximity search needs a positional index")
+        words_list = list(dict.fromkeys(words_list))
+        record_ids = self.search(words_list)
+        result = []
+        for record_id, record_positions in zip(
+                record_ids, self.record_positions(words_list, record_ids)):
+            if self.min_window(record_positions) <= window:
+                result.append(record_id)
+        return result
+
+    def min_window(self, position_lists):
+        """ Returns the length of the shortest window that contains at least
+        one position of each of the given sorted position lists.
+
+        >>> ii = InvertedIndex()
+        >>> ii.min_window([[1, 9, 20], [4, 15], [12, 30]])
+        7
+        """
+
+        heap = [(positions[0], i, 0)
+                for i, positions in enumerate(position_lists)]
+        heapq.heapify(heap)
+        end = max(positions[0] for positions in position_lists)
+        best = end + 1
+        while True:
+            # Move the window start past the smallest position.
+            start, i, j = heapq.heappop(heap)
+            best = min(best, end - start + 1)
+            if j + 1 == len(position_lists[i]):
+                return best
+            position = position_lists[i][j + 1]
+            end = max(end, position)
+            heapq.heappush(heap, (position, i, j + 1))
+
+    def compress(self):
+        """ Replace all inverted lists by compressed PostingLists.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example.txt")
+        >>> ii.compress()
+        >>> ii.search(["doc", "second"]), ii.search(["doc"])
+        ([2], [1, 2, 3])
+        """
+        for word in self.inverted_lists:
+            self.inverted_lists[word] = PostingList(self.inverted_lists[word])
+
+    def save(self, file_name):
+        """ Write the index to a binary file that can be read with load. The
+        file consists of a header, the offsets of the words, of the inverted
+        lists and, for a positional index, of the positions (num_words + 1
+        uint64 each, native byte order), the sorted utf-8 encoded words and
+        the variable-byte encoded inverted lists. For a positional index,
+        they are followed by the PositionLists of each word: the number of
+        records and the offsets (uint32) and the encoded positions.
+
+        >>> import tempfile
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example.txt")
+        >>> file_name = os.path.join(tempfile.mkdtemp(), "example.idx")
+        >>> ii.save(file_name)
+        >>> ii = InvertedIndex.load(file_name)
+        >>> len(ii.inverted_lists), "doc" in ii.inverted_lists
+        (4, True)
+        >>> sorted(ii.inverted_lists.items())
+        [('doc', [1, 2, 3]), ('first', [1]), ('second', [2]), ('third', [3])]
+        >>> ii.search(["doc", "third"])
+        [3]
+        >>> ii.positions is None
+        True
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example2.txt", positional=True)
+        >>> ii.save(file_name)
+        >>> ii = InvertedIndex.load(file_name)
+        >>> ii.positions["surfing"][3]
+        [2, 3]
+        >>> ii.phrase_search(["web", "surfing"])
+        [1, 3, 4]
+        """
+        words = sorted(word.encode("utf8") for word in self.inverted_lists)
+        word_offsets = array("Q", [0])
+        list_offsets = array("Q", [0])
+        position_offsets = array("Q", [0])
+        lists = []
+        positions = []
+        for word in words:
+            inverted_list = self.inverted_lists[word.decode("utf8")]
+            if not isinstance(inverted_list, PostingList):
+                inverted_list = PostingList(inverted_list)
+            lists.append(inverted_list.data)
+            word_offsets.append(word_offsets[-1] + len(word))
+            list_offsets.append(list_offsets[-1] + len(inverted_list.data))
+            if self.positions is not None:
+                position_lists = self.positions[word.decode("utf8")]
+                positions.append(array("I", [len(position_lists)]).tobytes() +
+                                 position_lists.offsets.tobytes() +
+                                 position_lists.data)
+                position_offsets.append(position_offsets[-1] +
+                                        len(positions[-1]))
+        with open(file_name, "wb") as file:
+            file.write(struct.pack(INDEX_FILE_HEADER, INDEX_FILE_MAGIC,
+                                   INDEX_FILE_VERSION, len(words),
+                                   self.positions is not None))
+            file.write(word_offsets.tobytes())
+            file.write(list_offsets.tobytes())
+            if self.positions is not None:
+                file.write(position_offsets.tobytes())
+            file.write(b"".join(words))
+            for data in lists:
+                file.write(data)
+            for data in positions:
+                file.write(data)
+
+    @classmethod
+    def load(cls, file_name):
+        """ Returns an index for the file written by save. The file is memory
+        mapped, so only the inverted lists accessed are read from disk. If
+        the file has the word positions, they are available as well. """
+        ii = cls()
+        ii.inverted_lists = MappedInvertedLists(file_name)
+        if ii.inverted_lists.has_positions:
+            ii.positions = MappedPositionLists(ii.inverted_lists)
+        return ii
+
+    def build_index_file(self, file_name, index_file_name,
+                         memory_limit=2 ** 28):
+        """ Build the index of file_name in the format of save with bounded
+        memory and open it. Whenever the inverted lists in memory exceed
+        about memory_limit bytes, they are written to a sorted run file. The
+        runs are then merged word by word into the index file. The merge
+        reads the inverted lists of the runs in chunks, so besides
+        memory_limit it only needs memory for one chunk of doc ids.
+
+        >>> index_file_name = os.path.join(tempfile.mkdtemp(), "example.idx")
+        >>> ii = InvertedIndex()
+        >>> ii.build_index_file("example.txt", index_file_name, 300)
+        >>> sorted(ii.inverted_lists.items())
+        [('doc', [1, 2, 3]), ('first', [1]), ('second', [2]), ('third', [3])]
+        """
+        temp_dir = tempfile.mkdtemp(
+                        dir=os.path.dirname(os.path.abspath(index_file_name)))
+        run_file_names = []
+        memory = 0
+        record_id = 0
+        with open(file_name) as file:
+            for line in file:
+                record_id += 1
+                num_words = len(self.inverted_lists)
+                num_postings = self.add_record(record_id, line)
+                memory += (WORD_MEMORY * (len(self.inverted_lists) -
+                                          num_words) +
+                           POSTING_MEMORY * num_postings)
+                if memory > memory_limit:
+                    run_file_names.append(os.path.join(
+                        temp_dir, "run-%d" % len(run_file_names)))
+                    write_run(run_file_names[-1], self.inverted_lists)
+                    self.inverted_lists = {}
+                    memory = 0
+        if len(self.inverted_lists) > 0:
+            run_file_names.append(os.path.join(
+                temp_dir, "run-%d" % len(run_file_names)))
+            write_run(run_file_names[-1], self.inverted_lists)
+        self.merge_runs(run_file_names, temp_dir, index_file_name)
+        shutil.rmtree(temp_dir)
+        self.inverted_lists = MappedInvertedLists(index_file_name)
+
+    def merge_runs(self, run_file_names, temp_dir, index_file_name):
+        """ Merge the run files with a k-way merge and write the index file
+        (same format as save). The parts of the file are first written to
+        separate temporary files in temp_dir and concatenated at the end.
+        The doc ids are streamed from the runs to the parts in chunks of
+        MERGE_CHUNK_SIZE. """
+        parts = ["word_offsets", "list_offsets", "words", "lists"]
+        part_files = dict((part, open(os.path.join(temp_dir, part), "wb"))
+                          for part in parts)
+        runs = [open(run_file_name, "rb") for run_file_name in run_file_names]
+        num_words = 0
+        word_offset = 0
+        list_offset = 0
+        part_files["word_offsets"].write(array("Q", [0]).tobytes())
+        part_files["list_offsets"].write(array("Q", [0]).tobytes())
+        # Runs are ordered by record id, and heapq.merge is stable, so the
+        # parts of an inverted list are merged in the right order.
+        merged = heapq.merge(*[read_run(run) for run in runs],
+                             key=lambda entry: entry[0])
+        word = None
+        last_id = 0
+        for next_word, chunks in merged:
+            if next_word != word and word is not None:
+                num_words += 1
+                word_offset += len(word)
+                part_files["word_offsets"].write(
+                    array("Q", [word_offset]).tobytes())
+                part_files["list_offsets"].write(
+                    array("Q", [list_offset]).tobytes())
+                last_id = 0
+            if next_word != word:
+                part_files["words"].write(next_word)
+            word = next_word
+            for doc_ids in chunks:
+                data = encode_deltas(doc_ids, last_id)
+                part_files["lists"].write(data)
+                list_offset += len(data)
+                last_id = doc_ids[-1]
+        if word is not None:
+            num_words += 1
+            part_files["word_offsets"].write(
+                array("Q", [word_offset + len(word)]).tobytes())
+            part_files["list_offsets"].write(
+                array("Q", [list_offset]).tobytes())
+        for file in list(part_files.values()) + runs:
+            file.close()
+        with open(index_file_name, "wb") as file:
+            file.write(struct.pack(INDEX_FILE_HEADER, INDEX_FILE_MAGIC,
+                                   INDEX_FILE_VERSION, num_words, False))
+            for part in parts:
+                with open(os.path.join(temp_dir, part), "rb") as part_file:
+                    shutil.copyfileobj(part_file, file)
+
+
 if __name__ == "__main__":
-    """ Output the lenghts of the inverted lists (= frequencies of the words) of
-    the given file. """
+    """ Answer queries for the given file. If an index file is given, the
+    index and the document store are loaded from it, or built and written
+    to it if it doesn't exist yet. """
     # Parse command line arguments.
-    if len(sys.argv) != 2:
-        print("Usage: python3 inverted_index.py <file>")
+    if len(sys.argv) not in [2, 3]:
+        print("Usage: python3 inverted_index.py <file> [<index file>]")
         sys.exit()
     file_name = sys.argv[1]
-    # Output the lengths.
-    ii = InvertedIndex()
-    ii.read_from_file(file_name)
-    file = open(file_name)
-    lines = file.readlines()
+    if len(sys.argv) == 3:
+        store_file_name = sys.argv[2] + ".docs"
+    else:
+        store_file_name = os.path.join(tempfile.mkdtemp(), "docs")
+    if len(sys.argv) == 3 and os.path.exists(sys.argv[2]):
+        ii = InvertedIndex.load(sys.argv[2])
+    else:
+        ii = InvertedIndex()
+        ii.read_from_file(file_name, positional=True)
+        if len(sys.argv) == 3:
+            ii.save(sys.argv[2])
+    if not os.path.exists(store_file_name):
+        DocumentStore.build(file_name, store_file_name)
+    documents = DocumentStore(store_file_name)
     while True:
         query = input("Enter your query: ")
         keyWords = re.split("\W+", query)
-        results = ii.search(keyWords)
+        # A query in quotes is a phrase query.
+        if query.startswith('"') and query.endswith('"'):
+            if ii.positions is None:
+                print("Phrase queries need an index with positions")
+                continue
+            results = ii.phrase_search([w for w in keyWords if len(w) > 0])
+        else:
+            results = ii.search(keyWords)
         results = results[:3]
         if len(results) == 0:
             print("                     ", query, " not found in file")
         else:
             for i in results:
-                print(lines[i - 1])
+                print(documents[i])
@@ -0,0 +1,94 @@
+"""
+Recall and throughput of the approximate LSI search.
+
+Computes the LSI factorization of a file, builds the IVF index of
+build_ann_index and runs random queries taken from the lines of the file
+with process_query_lsi (all scores, as strings), with the exact numeric
+top-k of process_query_lsi_topk and with process_query_ann for an increasing
+number of probed lists. Prints the queries per second of each, and the
+recall@k of process_query_ann with respect to the exact top-k.
+"""
+
+import random
+import re
+import sys
+import time
+
+import numpy as np
+
+from inverted_index import InvertedIndex
+
+
+def random_queries(file_name, num_queries):
+    """ Returns num_queries queries of 2 to 4 words from random lines of the
+    given file. """
+    with open(file_name) as file:
+        lines = [[w.lower() for w in re.split(r"\W+", line) if len(w) > 2]
+                 for line in file]
+    lines = [words for words in lines if len(words) >= 2]
+    queries = []
+    for _ in range(num_queries):
+        words = random.choice(lines)
+        queries.append(random.sample(words, min(len(words),
+                                                random.randint(2, 4))))
+    return queries
+
+
+def recall(expected, result):
+    """ Returns the fraction of the doc ids of expected that are in result.
+
+    >>> recall(np.array([1, 4]), np.array([1, 2]))
+    0.5
+    """
+    return len(np.intersect1d(expected, result)) / len(expected)
+
+
+def time_queries(method, queries):
+    """ Returns the results of method for each query and the number of
+    queries per second. """
+    start = time.perf_counter()
+    results = [method(query) for query in queries]
+    return results, len(queries) / (time.perf_counter() - start)
+
+
+def run_benchmark(ii, queries, topk, n_probes):
+    """ Print the queries per second of the exact methods, and the recall
+    and the queries per second of process_query_ann for each n_probe. """
+    _, qps = time_queries(ii.process_query_lsi, queries)
+    print("Top-%d, %d queries, %d documents, %d lists"
+          % (topk, len(queries), ii.Vk.shape[1], len(ii.ann_centroids)))
+    print("%12s%10s%10s" % ("method", "recall", "QPS"))
+    print("%12s%10s%10.0f" % ("all scores", "", qps))
+    expected, qps = time_queries(
+        lambda query: ii.process_query_lsi_topk(query, topk)[0], queries)
+    print("%12s%10.3f%10.0f" % ("exact", 1, qps))
+    for n_probe in n_probes:
+        results, qps = time_queries(
+            lambda query: ii.process_query_ann(query, topk, n_probe)[0],
+            queries)
+        mean_recall = np.mean([recall(e, r)
+                               for e, r in zip(expected, results)])
+        print("%12s%10.3f%10.0f" % ("n_probe=%d" % n_probe, mean_recall,
+                                    qps))
+
+
+if __name__ == "__main__":
+    """ Build the index of the given file and print the report. """
+    if len(sys.argv) not in [4, 5]:
+        print("Usage: python3 ann_benchmark.py <file> <k> <m> "
+              "[<num queries>]")
+        sys.exit()
+    num_queries = 200
+    if len(sys.argv) == 5:
+        num_queries = int(sys.argv[4])
+    random.seed(42)
+    ii = InvertedIndex()
+    ii.read_from_file(sys.argv[1])
+    ii.preprocess_vsm(int(sys.argv[3]))
+    start = time.perf_counter()
+    ii.preprocess_lsi(int(sys.argv[2]), svd="randomized")
+    ii.build_ann_index()
+    print("Factorization and index built in %.1fs"
+          % (time.perf_counter() - start))
+    run_benchmark(ii, random_queries(sys.argv[1], num_queries), 10,
+                  [1, 2, 4, 8, 16, 32])
@@ -9,13 +9,155 @@ Co-Author: Louay Abdelgawad <lo2aayyguc@gmail.com>,
             Omar Kassem <omar.kassem67@gmail.com>
 """
 
+import heapq
+import io
 import re
 import sys
 import math
+import mmap
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+import zlib
 import numpy as np
 import scipy.sparse.linalg
+from array import array
 from scipy.sparse import csr_matrix
 
+# Number of decimals of the scores compared by InvertedIndex.top_k.
+SCORE_DECIMALS = 6
+
+# The arrays of a model directory written by InvertedIndex.save_model, one
+# .npy file each. The ones from Uk on are optional.
+MODEL_ARRAYS = ["data", "indices", "indptr", "shape", "terms", "Uk", "Sk",
+                "Vk", "UkSk", "pq_codes", "pq_codebooks"]
+
+# Header of a document store file written by DocumentStore.build: magic,
+# format version, number of records and number of records per compressed
+# block (0 if not compressed).
+DOCUMENT_STORE_HEADER = "<4sIII"
+DOCUMENT_STORE_MAGIC = b"DOCS"
+DOCUMENT_STORE_VERSION = 1
+
+# The index of a worker process of InvertedIndex.term_similarities, set by
+# init_worker.
+worker_index = None
+
+
+def init_worker(index):
+    """
+    Initializer of the worker processes of InvertedIndex.term_similarities,
+    which gets the index from the forking process.
+    """
+    global worker_index
+    worker_index = index
+
+
+def term_similarity_block(args):
+    """
+    Compute the best term pairs and neighbours of one block of terms of
+    worker_index with the given arguments of
+    InvertedIndex.term_similarity_block.
+    """
+    return worker_index.term_similarity_block(*args)
+
+
+class DocumentStore:
+    """ Random access to the records (lines) of a file by record id, without
+    keeping the file in memory. The store file has a header, a table of
+    byte offsets (uint64, native byte order) and the records, either as they
+    are or compressed with zlib in blocks of block_size records. In the
+    first case the table has the offset of each record, in the second case
+    the offset of each block.
+
+    >>> store_file_name = os.path.join(tempfile.mkdtemp(), "example.docs")
+    >>> DocumentStore.build("example2.txt", store_file_name)
+    >>> store = DocumentStore(store_file_name)
+    >>> len(store), store[2], store[6]
+    (6, 'internet surfing\\n', 'surfing beach\\n')
+    >>> DocumentStore.build("example2.txt", store_file_name, block_size=4)
+    >>> store = DocumentStore(store_file_name)
+    >>> store[5], store[1]
+    ('surfing beach\\n', 'internet web surfing\\n')
+    """
+
+    def __init__(self, file_name):
+        """ Memory map the given document store file. """
+        with open(file_name, "rb") as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.num_records, self.block_size = \
+            struct.unpack_from(DOCUMENT_STORE_HEADER, self.mmap)
+        if magic != DOCUMENT_STORE_MAGIC or version != DOCUMENT_STORE_VERSION:
+            raise ValueError("Not a document store file: %s" % file_name)
+        if self.block_size > 0:
+            num_entries = (self.num_records + self.block_size - 1) // \
+                self.block_size
+        else:
+            num_entries = self.num_records
+        pos = struct.calcsize(DOCUMENT_STORE_HEADER)
+        self.offsets = memoryview(self.mmap)[
+                        pos:pos + 8 * (num_entries + 1)].cast("Q")
+        self.data_start = pos + 8 * (num_entries + 1)
+        # The last decompressed block and its number.
+        self.block = None
+        self.block_id = -1
+
+    @staticmethod
+    def build(file_name, store_file_name, block_size=0):
+        """ Write the document store of the given file. If block_size > 0,
+        the records are compressed in blocks of that many records. """
+        offsets = array("Q", [0])
+        num_records = 0
+        with open(file_name, "rb") as file, \
+                tempfile.TemporaryFile(dir=os.path.dirname(
+                    os.path.abspath(store_file_name))) as data_file:
+            block = []
+            for line in file:
+                num_records += 1
+                if block_size == 0:
+                    data_file.write(line)
+                    offsets.append(offsets[-1] + len(line))
+                    continue
+                block.append(line)
+                if len(block) == block_size:
+                    data = zlib.compress(b"".join(block))
+                    data_file.write(data)
+                    offsets.append(offsets[-1] + len(data))
+                    block = []
+            if len(block) > 0:
+                data = zlib.compress(b"".join(block))
+                data_file.write(data)
+                offsets.append(offsets[-1] + len(data))
+            data_file.seek(0)
+            with open(store_file_name, "wb") as store_file:
+                store_file.write(struct.pack(
+                    DOCUMENT_STORE_HEADER, DOCUMENT_STORE_MAGIC,
+                    DOCUMENT_STORE_VERSION, num_records, block_size))
+                store_file.write(offsets.tobytes())
+                shutil.copyfileobj(data_file, store_file)
+
+    def __getitem__(self, record_id):
+        """ Returns the record with the given id (starting at 1). """
+        if record_id < 1 or record_id > self.num_records:
+            raise IndexError(record_id)
+        i = record_id - 1
+        if self.block_size == 0:
+            return self.mmap[self.data_start + self.offsets[i]:
+                             self.data_start + self.offsets[i + 1]].decode(
+                                                                    "utf8")
+        block_id = i // self.block_size
+        if block_id != self.block_id:
+            data = self.mmap[self.data_start + self.offsets[block_id]:
+                             self.data_start + self.offsets[block_id + 1]]
+            self.block = io.BytesIO(zlib.decompress(data)).readlines()
+            self.block_id = block_id
+        return self.block[i % self.block_size].decode("utf8")
+
+    def __len__(self):
+        return self.num_records
+
 
 class InvertedIndex:
     """ A simple inverted index, as explained in the lecture.
@@ -33,6 +175,19 @@ class InvertedIndex:
         self.td_matrix = None
         # maps a term to the row index of the document matrix
         self.term_matrix_indices = dict()
+        # DocumentStore used by render_output, if any
+        self.document_store = None
+        # IVF index of the document vectors (see build_ann_index): the
+        # centroids of the lists, the documents sorted by list, their
+        # vectors in the same order and the start of each list
+        self.ann_centroids = None
+        self.ann_docs = None
+        self.ann_vectors = None
+        self.ann_starts = None
+        # product-quantized Vk (see compress_vk): the subspaces x documents
+        # uint8 codes and the subspaces x centroids x dimensions codebooks
+        self.pq_codes = None
+        self.pq_codebooks = None
 
     def read_from_file(self, file_name, bm25_k=1.75, bm25_b=0.75):
         """
@@ -131,9 +286,13 @@ class InvertedIndex:
         # use float values because of BM25 scores
         self.td_matrix = csr_matrix((vals, (rows, cols)), dtype=float)
 
-    def preprocess_lsi(self, k):
+    def preprocess_lsi(self, k, svd="arpack", oversampling=10,
+                       power_iterations=2, seed=0):
         """
-        Calculate SVD of the Td matrix
+        Calculate SVD of the Td matrix, with svds (ARPACK) or, with svd
+        "randomized", with randomized_svd and the given parameters. The
+        factorization is stored in Uk, Sk, Vk and UkSk and reused by
+        process_query_lsi, related_term_pairs and save_model.
 
         >>> ii = InvertedIndex()
         >>> ii.td_matrix = [[1.0, 1.0, 0.0, 1.0, 0.0, 0.0],\
@@ -155,8 +314,148 @@ class InvertedIndex:
         [[-0.529 -0.225 -0.225 0.027 0.556 0.556]
          [0.400 0.303 0.303 0.695 0.295 0.295]]
         """
-        self.Uk, self.Sk, self.Vk = scipy.sparse.linalg.svds(self.td_matrix, k)
+        if svd == "randomized":
+            self.Uk, self.Sk, self.Vk = self.randomized_svd(
+                k, oversampling, power_iterations, seed)
+        else:
+            self.Uk, self.Sk, self.Vk = scipy.sparse.linalg.svds(
+                self.td_matrix, k)
         self.UkSk = self.Uk * self.Sk
+        self.pq_codes = None
+        self.pq_codebooks = None
+
+    def randomized_svd(self, k, oversampling=10, power_iterations=2, seed=0):
+        """
+        Compute the k largest singular values and vectors of the td matrix
+        with a randomized range finder: multiply the matrix with
+        k + oversampling random Gaussian vectors, make the product more
+        dominated by the largest singular values with power_iterations
+        products with the matrix and its transpose (orthonormalized each
+        time), and take the exact SVD of the projection of the matrix on
+        the resulting basis. Only products of the sparse matrix with dense
+        blocks are needed. Returns Uk, Sk and Vk in the same form and
+        (ascending) order of the singular values as svds.
+
+        >>> ii = InvertedIndex()
+        >>> ii.td_matrix = csr_matrix([[1.0, 1.0, 0.0, 1.0, 0.0, 0.0],
+        ... [1.0, 0.0, 1.0, 1.0, 0.0, 0.0], [1.0, 1.0, 1.0, 2.0, 1.0, 1.0],
+        ... [0.0, 0.0, 0.0, 1.0, 1.0, 1.0]])
+        >>> Uk, Sk, Vk = ii.randomized_svd(2)
+        >>> print(Sk)
+        [1.546 3.803]
+        >>> print(np.linalg.svd(ii.td_matrix.toarray())[1][1::-1])
+        [1.546 3.803]
+        >>> Uk.shape, Vk.shape
+        ((4, 2), (2, 6))
+        >>> bool(np.allclose(Uk.T @ ii.td_matrix @ Vk.T, np.diag(Sk)))
+        True
+        """
+        matrix = self.td_matrix
+        rng = np.random.default_rng(seed)
+        num_vectors = min(k + oversampling, min(matrix.shape))
+        basis, _ = np.linalg.qr(
+            matrix @ rng.standard_normal((matrix.shape[1], num_vectors)))
+        for _ in range(power_iterations):
+            basis, _ = np.linalg.qr(matrix.T @ basis)
+            basis, _ = np.linalg.qr(matrix @ basis)
+        # The num_vectors x documents projection (basis^T * matrix).
+        projection = (matrix.T @ basis).T
+        U, S, Vt = np.linalg.svd(projection, full_matrices=False)
+        return (basis @ U[:, k - 1::-1], S[k - 1::-1],
+                np.ascontiguousarray(Vt[k - 1::-1]))
+
+    def save_model(self, dir_name):
+        """
+        Write the term-document matrix, its terms and, if preprocess_lsi was
+        called, Uk, Sk, Vk (or its codes, see compress_vk) and UkSk to the
+        directory dir_name (created if
+        needed), with one uncompressed .npy file per array, so that
+        load_model can map them into memory. The files of the arrays that
+        are not set are removed, so that a model saved again into the same
+        directory doesn't keep arrays of the old one.
+
+        >>> import tempfile
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example2.txt", 1.75, 0.75)
+        >>> ii.preprocess_vsm(4)
+        >>> ii.preprocess_lsi(2)
+        >>> ii.compress_vk("pq", subspace_dim=1)
+        >>> dir_name = tempfile.mkdtemp()
+        >>> ii.save_model(dir_name)
+        >>> sorted(name for name in os.listdir(dir_name)
+        ...        if name.startswith(("Vk", "pq")))
+        ['pq_codebooks.npy', 'pq_codes.npy']
+        >>> ii.preprocess_lsi(2)
+        >>> ii.save_model(dir_name)
+        >>> sorted(name for name in os.listdir(dir_name)
+        ...        if name.startswith(("Vk", "pq")))
+        ['Vk.npy']
+        >>> ii2 = InvertedIndex()
+        >>> ii2.load_model(dir_name)
+        >>> ii2.pq_codes is None, ii2.Vk.shape
+        (True, (2, 6))
+        """
+        os.makedirs(dir_name, exist_ok=True)
+        terms = [self.matrix_indices_terms[i]
+                 for i in range(self.td_matrix.shape[0])]
+        arrays = {"data": self.td_matrix.data,
+                  "indices": self.td_matrix.indices,
+                  "indptr": self.td_matrix.indptr,
+                  "shape": np.array(self.td_matrix.shape),
+                  "terms": np.array(terms)}
+        if getattr(self, "Uk", None) is not None:
+            arrays.update(Uk=self.Uk, Sk=self.Sk, Vk=self.Vk, UkSk=self.UkSk,
+                          pq_codes=self.pq_codes,
+                          pq_codebooks=self.pq_codebooks)
+        for name in MODEL_ARRAYS:
+            file_name = os.path.join(dir_name, name + ".npy")
+            if arrays.get(name) is not None:
+                np.save(file_name, arrays[name])
+            elif os.path.exists(file_name):
+                os.remove(file_name)
+
+    def load_model(self, dir_name, mmap_mode="r"):
+        """
+        Read a model written by save_model. By default, the arrays are
+        memory-mapped read-only, so processes that load the same model share
+        one copy of it, and svds is not computed again. The inverted lists
+        are not part of the model.
+
+        >>> import tempfile
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example2.txt", 1.75, 0.75)
+        >>> ii.preprocess_vsm(4)
+        >>> ii.preprocess_lsi(2)
+        >>> dir_name = tempfile.mkdtemp()
+        >>> ii.save_model(dir_name)
+        >>> ii2 = InvertedIndex()
+        >>> ii2.load_model(dir_name)
+        >>> ii2.Vk.flags.writeable, (ii2.td_matrix != ii.td_matrix).nnz
+        (False, 0)
+        >>> ii2.term_matrix_indices == ii.term_matrix_indices
+        True
+        >>> result = ii.process_query_lsi(['web', 'surfing'])
+        >>> ii2.process_query_lsi(['web', 'surfing']) == result
+        True
+        """
+        arrays = {}
+        for name in MODEL_ARRAYS:
+            file_name = os.path.join(dir_name, name + ".npy")
+            if os.path.exists(file_name):
+                arrays[name] = np.load(file_name, mmap_mode=mmap_mode)
+        self.td_matrix = csr_matrix((arrays["data"], arrays["indices"],
+                                     arrays["indptr"]),
+                                    shape=tuple(arrays["shape"].tolist()))
+        terms = arrays["terms"].tolist()
+        self.term_matrix_indices = {term: i for i, term in enumerate(terms)}
+        self.matrix_indices_terms = dict(enumerate(terms))
+        if "Uk" in arrays:
+            self.Uk = arrays["Uk"]
+            self.Sk = arrays["Sk"]
+            self.Vk = arrays.get("Vk")
+            self.UkSk = arrays["UkSk"]
+            self.pq_codes = arrays.get("pq_codes")
+            self.pq_codebooks = arrays.get("pq_codebooks")
 
     def process_query_vsm(self, keywords):
         """
@@ -238,7 +537,7 @@ class InvertedIndex:
                 continue
             query_vector[self.term_matrix_indices[kw]] += 1
         query_vector = np.dot(query_vector.T, self.UkSk)
-        res = np.dot(query_vector, self.Vk)
+        res = self.document_scores(query_vector)
         res = np.round(res, 3)
         ret = []
         for i in range(res.shape[0]):
@@ -246,6 +545,296 @@ class InvertedIndex:
                 ret.append(((i + 1), '%.3f' % (res[i] + 0)))
         return sorted(ret, key=lambda x: (x[1], x[0]), reverse=True)
 
+    def query_embedding(self, keywords):
+        """
+        Returns the query vector of the keywords (with the number of
+        occurrences of each keyword in the td matrix terms) projected by
+        UkSk, so that its dot products with the columns of Vk are the LSI
+        scores of the documents.
+        """
+        rows = [self.term_matrix_indices[kw] for kw in keywords
+                if kw in self.term_matrix_indices]
+        return np.sum(self.UkSk[rows], axis=0)
+
+    def top_k(self, docs, scores, k):
+        """
+        Returns the doc ids (docs are 0-based columns of Vk) and the scores
+        of the k best documents as numeric arrays, sorted by score, with
+        ties broken by doc id. Scores that are equal when rounded to
+        SCORE_DECIMALS decimals are ties, so that rounding errors don't
+        decide their order.
+
+        >>> ii = InvertedIndex()
+        >>> doc_ids, scores = ii.top_k(np.array([4, 0, 2, 3]),
+        ...                            np.array([0.5, 0.9, 0.5, 0.1]), 3)
+        >>> doc_ids.tolist()
+        [1, 3, 5]
+        >>> print(scores)
+        [0.900 0.500 0.500]
+        >>> doc_ids, _ = ii.top_k(np.array([4, 0, 2, 3]),
+        ...                       np.array([0.5 + 1e-12, 0.9, 0.5, 0.1]), 3)
+        >>> doc_ids.tolist()
+        [1, 3, 5]
+        >>> ii.top_k(np.array([4, 0]), np.array([0.5, 0.9]), 0)[0].tolist()
+        []
+        """
+        if k <= 0:
+            return docs[:0] + 1, scores[:0]
+        rounded = np.round(scores, SCORE_DECIMALS)
+        if len(docs) > k:
+            best = np.argpartition(-rounded, k - 1)[:k]
+            # Keep all documents with the (rounded) score of the k-th one,
+            # so that the ties are broken by doc id.
+            best = np.flatnonzero(rounded >= rounded[best].min())
+            docs = docs[best]
+            scores = scores[best]
+            rounded = rounded[best]
+        order = np.lexsort((docs, -rounded))[:k]
+        return docs[order] + 1, scores[order]
+
+    def process_query_lsi_topk(self, keywords, k=10):
+        """
+        Exact LSI search: returns the doc ids and scores of the k documents
+        with the highest LSI score, as numeric arrays (see top_k).
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example2.txt", 1.75, 0.75)
+        >>> ii.preprocess_vsm(4)
+        >>> ii.preprocess_lsi(2)
+        >>> doc_ids, scores = ii.process_query_lsi_topk(['web', 'surfing'], 3)
+        >>> doc_ids.tolist()
+        [1, 4, 2]
+        >>> print(scores)
+        [0.944 0.705 0.568]
+        """
+        scores = self.document_scores(self.query_embedding(keywords))
+        return self.top_k(np.arange(len(scores)), scores, k)
+
+    def build_ann_index(self, num_lists=None, iterations=10, seed=0):
+        """
+        Build an IVF (inverted file) index over the document vectors (the
+        columns of Vk): cluster their directions into num_lists lists (by
+        default the square root of the number of documents, at most the
+        number of documents) with iterations
+        of spherical k-means from random documents, and store the documents
+        of each list together, so that process_query_ann only scores the
+        documents of a few lists. The LSI scores are dot products, so
+        documents in the direction of the query score highest, whatever
+        their length. Needs Vk, so it must be called before compress_vk with
+        method "pq".
+
+        >>> ii = InvertedIndex()
+        >>> ii.Vk = np.array([[1.0, 0.9, 0.0, 0.1], [0.0, 0.1, 1.0, 0.9]])
+        >>> ii.build_ann_index(2)
+        >>> ii.ann_starts.tolist(), sorted(ii.ann_docs[:2].tolist())
+        ([0, 2, 4], [2, 3])
+        >>> ii.build_ann_index(10)
+        >>> ii.ann_centroids.shape
+        (4, 2)
+        """
+        vectors = np.ascontiguousarray(self.Vk.T, dtype=np.float32)
+        num_docs = len(vectors)
+        if num_lists is None:
+            num_lists = max(1, int(math.sqrt(num_docs)))
+        num_lists = min(num_lists, num_docs)
+        norms = np.linalg.norm(vectors, axis=1)
+        norms[norms == 0] = 1
+        directions = vectors / norms[:, None]
+        rng = np.random.default_rng(seed)
+        centroids = directions[rng.choice(num_docs, num_lists, replace=False)]
+        for _ in range(iterations + 1):
+            labels = np.argmax(directions @ centroids.T, axis=1)
+            counts = np.bincount(labels, minlength=num_lists)
+            sums = self.sum_clusters(labels, directions, num_lists)
+            sum_norms = np.linalg.norm(sums, axis=1)
+            nonempty = sum_norms > 0
+            centroids[nonempty] = sums[nonempty] / sum_norms[nonempty, None]
+        self.ann_centroids = centroids
+        self.ann_docs = np.argsort(labels, kind="stable")
+        self.ann_vectors = vectors[self.ann_docs]
+        self.ann_starts = np.concatenate(([0], np.cumsum(counts)))
+
+    def process_query_ann(self, keywords, k=10, n_probe=8):
+        """
+        Approximate LSI search with the index of build_ann_index: returns
+        the doc ids and scores of the k best documents (see top_k) among the
+        documents of the n_probe lists whose centroids have the highest
+        score for the query. More probes give results closer to
+        process_query_lsi_topk but are slower. A query without any term of
+        the index has no results.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example2.txt", 1.75, 0.75)
+        >>> ii.preprocess_vsm(4)
+        >>> ii.preprocess_lsi(2)
+        >>> ii.build_ann_index(3)
+        >>> result = ii.process_query_ann(['web', 'surfing'], 3, n_probe=3)
+        >>> doc_ids, scores = result
+        >>> doc_ids.tolist()
+        [1, 4, 2]
+        >>> print(scores)
+        [0.944 0.705 0.568]
+        >>> ii.process_query_ann(['unknown'], 3, n_probe=3)[0].tolist()
+        []
+        """
+        query = self.query_embedding(keywords).astype(np.float32)
+        if not query.any():
+            return self.top_k(self.ann_docs[:0], query[:0], k)
+        centroid_scores = self.ann_centroids @ query
+        n_probe = min(n_probe, len(centroid_scores))
+        probes = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+        docs = np.concatenate([self.ann_docs[self.ann_starts[probe]:
+                                             self.ann_starts[probe + 1]]
+                               for probe in probes])
+        scores = np.concatenate([self.ann_vectors[self.ann_starts[probe]:
+                                                  self.ann_starts[probe + 1]]
+                                 @ query for probe in probes])
+        return self.top_k(docs, scores, k)
+
+    def compress_vk(self, method="pq", subspace_dim=4, num_centroids=256,
+                    iterations=10, max_training=65536, seed=0):
+        """
+        Replace Vk by a compact representation, which document_scores (and
+        so process_query_lsi) scores directly. With method "float16", Vk is
+        stored as float16, a quarter of the memory of float64. With method
+        "pq", Vk is product-quantized: its k dimensions are split into
+        subspaces of subspace_dim dimensions, the parts of (at most
+        max_training random) document vectors in each subspace are clustered
+        into num_centroids (at most as many as there are training vectors)
+        centroids with iterations of k-means, and each
+        document is stored as the uint8 number of its closest centroid in
+        each subspace. Vk is then set to None, so only the codes
+        (k / subspace_dim bytes per document) and the codebooks are kept.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example2.txt", 1.75, 0.75)
+        >>> ii.preprocess_vsm(4)
+        >>> ii.preprocess_lsi(2)
+        >>> result = ii.process_query_lsi(['web', 'surfing'])
+        >>> ii.compress_vk("pq", subspace_dim=1)
+        >>> ii.Vk, ii.pq_codes.shape, ii.pq_codebooks.shape
+        (None, (2, 6), (2, 6, 1))
+        >>> ii.process_query_lsi(['web', 'surfing']) == result
+        True
+        >>> ii.compress_vk("pq", subspace_dim=3)
+        Traceback (most recent call last):
+        ...
+        ValueError: Vk is not available, call preprocess_lsi again
+        >>> ii.preprocess_lsi(2)
+        >>> ii.compress_vk("pq", subspace_dim=1, max_training=4)
+        >>> ii.pq_codebooks.shape
+        (2, 4, 1)
+        """
+        if self.Vk is None:
+            raise ValueError("Vk is not available, call preprocess_lsi again")
+        k, num_docs = self.Vk.shape
+        if method == "float16":
+            self.Vk = self.Vk.astype(np.float16)
+            return
+        if k % subspace_dim != 0:
+            raise ValueError("k = %d is not a multiple of subspace_dim = %d"
+                             % (k, subspace_dim))
+        if num_centroids > 256:
+            raise ValueError("At most 256 centroids fit into uint8 codes")
+        num_subspaces = k // subspace_dim
+        rng = np.random.default_rng(seed)
+        training = rng.choice(num_docs, min(max_training, num_docs),
+                              replace=False)
+        num_centroids = min(num_centroids, len(training))
+        self.pq_codebooks = np.zeros((num_subspaces, num_centroids,
+                                      subspace_dim), dtype=np.float32)
+        self.pq_codes = np.zeros((num_subspaces, num_docs), dtype=np.uint8)
+        for s in range(num_subspaces):
+            dims = slice(s * subspace_dim, (s + 1) * subspace_dim)
+            vectors = np.ascontiguousarray(self.Vk[dims, training].T,
+                                           dtype=np.float32)
+            centroids = vectors[rng.choice(len(vectors), num_centroids,
+                                           replace=False)]
+            for _ in range(iterations):
+                labels = self.closest_centroids(vectors, centroids)
+                counts = np.bincount(labels, minlength=num_centroids)
+                sums = self.sum_clusters(labels, vectors, num_centroids)
+                nonempty = counts > 0
+                centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+            self.pq_codebooks[s] = centroids
+            self.pq_codes[s] = self.closest_centroids(
+                np.ascontiguousarray(self.Vk[dims].T, dtype=np.float32),
+                centroids)
+        self.Vk = None
+
+    def sum_clusters(self, labels, vectors, k):
+        """
+        Returns the k sums of the rows of vectors with the same label, as
+        the product of a sparse k x rows indicator matrix with vectors.
+
+        >>> ii = InvertedIndex()
+        >>> vectors = np.array([[1.0, 0.0], [0.0, 2.0], [3.0, 0.0]])
+        >>> print(ii.sum_clusters(np.array([1, 0, 1]), vectors, 3))
+        [[0.000 2.000]
+         [4.000 0.000]
+         [0.000 0.000]]
+        """
+        indicator = csr_matrix((np.ones(len(labels), dtype=vectors.dtype),
+                                (labels, np.arange(len(labels)))),
+                               shape=(k, len(labels)))
+        return indicator @ vectors
+
+    def closest_centroids(self, vectors, centroids, block_size=65536):
+        """
+        Returns the index of the closest centroid (in Euclidean distance) of
+        each of the vectors, computed in blocks of block_size vectors.
+
+        >>> ii = InvertedIndex()
+        >>> vectors = np.array([[0.0, 0.1], [1.0, 0.9], [0.2, 0.0]])
+        >>> centroids = np.array([[1.0, 1.0], [0.0, 0.0]])
+        >>> ii.closest_centroids(vectors, centroids, 2).tolist()
+        [1, 0, 1]
+        """
+        squared_norms = np.sum(centroids ** 2, axis=1)
+        labels = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), block_size):
+            block = vectors[start:start + block_size]
+            labels[start:start + block_size] = np.argmin(
+                squared_norms - 2 * block @ centroids.T, axis=1)
+        return labels
+
+    def document_scores(self, query, block_size=65536):
+        """
+        Returns the LSI scores of all documents for the query embedding (see
+        query_embedding), the dot products with the columns of Vk. For a
+        float16 Vk, they are computed in blocks of block_size documents,
+        converted to float32. For product-quantized Vk (see compress_vk),
+        they are computed with asymmetric distance lookup tables: the dot
+        products of each part of the query with the centroids of its
+        subspace, summed over the codes of each document, without
+        decompressing the document vectors.
+
+        >>> ii = InvertedIndex()
+        >>> ii.Vk = np.array([[1.0, 0.5, 0.0], [0.0, 0.5, 2.0]])
+        >>> print(ii.document_scores(np.array([1.0, 2.0])))
+        [1.000 1.500 4.000]
+        >>> ii.compress_vk("float16")
+        >>> print(ii.document_scores(np.array([1.0, 2.0]), block_size=2))
+        [1.000 1.500 4.000]
+        """
+        if self.pq_codes is not None:
+            num_subspaces, num_centroids, subspace_dim = \
+                self.pq_codebooks.shape
+            tables = np.einsum("scd,sd->sc", self.pq_codebooks,
+                               query.reshape(num_subspaces, subspace_dim))
+            scores = np.zeros(self.pq_codes.shape[1], dtype=np.float32)
+            for s in range(num_subspaces):
+                scores += tables[s][self.pq_codes[s]]
+            return scores
+        if self.Vk.dtype == np.float16:
+            query = query.astype(np.float32)
+            scores = np.empty(self.Vk.shape[1], dtype=np.float32)
+            for start in range(0, len(scores), block_size):
+                scores[start:start + block_size] = query @ \
+                    self.Vk[:, start:start + block_size].astype(np.float32)
+            return scores
+        return np.dot(query, self.Vk)
+
     def transform_to_bm25(self, k=1.75, b=0.75):
         """
         Exercise 02.01
@@ -265,9 +854,18 @@ class InvertedIndex:
 
     def render_output(self, file_name, qry, qry_res, max_res):
         """
-        Output results. Load documents from HD to save memory.
+        Output results. Load documents from HD to save memory, from the
+        document store if there is one, otherwise by scanning the file.
         """
 
+        if self.document_store is not None:
+            for doc_id, score in qry_res[:max_res]:
+                print(re.sub('\\b(' + '|'.join(qry) + ')\\b',
+                             "\033[3;37;40m" + '\\1' + "\033[0;0m",
+                             self.document_store[doc_id],
+                             flags=re.IGNORECASE))
+            return
+
         outputted = 0
         doc_ids_res = [docs[0] for docs in qry_res]
 
@@ -314,7 +912,12 @@ class InvertedIndex:
 
         return acc_p / len(rel_ids)
 
-    def run_benchmark(self, file_name, l):
+    def run_benchmark(self, file_name, l, verbose=True):
+        """
+        Print the MP@3, MP@R and MAP of VSM (v), LSI (l) and their mix with
+        weight l (t) on the given benchmark file, and return the ones of
+        LSI. With verbose, each query is printed too.
+        """
         p_at_3_sumv = 0
         p_at_r_sumv = 0
         ap_sumv = 0
@@ -326,7 +929,8 @@ class InvertedIndex:
             for line in file:
                 c += 1
                 query, gt = line.strip().split('\t')
-                print("Eval for query ", query)
+                if verbose:
+                    print("Eval for query ", query)
 
                 query = re.split("\W+", query.lower())
                 gt = set([int(f_id) for f_id in gt.split(' ')])
@@ -362,10 +966,13 @@ class InvertedIndex:
         print("MP@3t: %.2f" % (p_at_3_sumtt / c))
         print("MP@Rt: %.2f" % (p_at_r_sumtt / c))
         print("MAPt: %.2f" % (ap_sumtt / c))
+        return p_at_3_suml / c, p_at_r_suml / c, ap_suml / c
 
     def related_term_pairs(self, k):
         """
-        Calculates the Term-Term matrix and gets the most related terms
+        Gets the k most related term pairs, by the similarity of their rows
+        of the Uk of preprocess_lsi (see term_similarities), as lists of the
+        similarity and the two terms
         >>> ii = InvertedIndex()
         >>> ii.inverted_lists = {"lirum": [(2, 0.1)], "larum": [(8, 0.8)], \
 "spoon": [(1, 0.2), (3, 0.6), (4, 0.1)], "handle": [(2, 0.4), \
@@ -379,28 +986,111 @@ class InvertedIndex:
         True
         >>> '0.285' in result[0]
         True
+        >>> ii.preprocess_lsi(2, svd="randomized")
+        >>> ii.related_term_pairs(1) == result
+        True
+        """
+        pairs, _, _ = self.term_similarities(k)
+        return [['%.3f' % score, self.matrix_indices_terms[j],
+                 self.matrix_indices_terms[i]] for score, i, j in pairs]
+
+    def term_similarities(self, num_pairs, num_neighbours=0,
+                          block_size=1024, num_processes=1):
+        """
+        Compute the similarities of the terms, the dot products of their
+        rows of Uk, in blocks of block_size terms (see
+        term_similarity_block), so that only a block_size x m part of the
+        term-term matrix is in memory at a time per process. With
+        num_processes > 1, the blocks are computed in a pool of forked
+        processes, which share Uk with this process. Returns the num_pairs
+        most similar pairs of different terms, as (similarity, i, j) with
+        term rows i < j, sorted by similarity (ties by i and j), kept in a
+        bounded heap while merging the blocks. Also returns the rows and the
+        similarities of the num_neighbours most similar other terms of each
+        term, as m x num_neighbours arrays sorted by similarity.
+
+        >>> ii = InvertedIndex()
+        >>> ii.Uk = np.array([[1.0, 0.0], [0.8, 0.6], [0.0, 1.0],
+        ...                   [0.6, 0.8]])
+        >>> pairs, neighbours, scores = ii.term_similarities(2, 1, 2)
+        >>> [(round(score, 3), i, j) for score, i, j in pairs]
+        [(0.96, 1, 3), (0.8, 0, 1)]
+        >>> neighbours.tolist()
+        [[1], [3], [3], [1]]
+        >>> print(scores.ravel())
+        [0.800 0.960 0.800 0.960]
+        >>> ii.term_similarities(2, 1, 2, num_processes=2)[0] == pairs
+        True
+        """
+        num_terms = self.Uk.shape[0]
+        args = [(start, min(start + block_size, num_terms), num_pairs,
+                 num_neighbours)
+                for start in range(0, num_terms, block_size)]
+        if num_processes > 1 and len(args) > 1:
+            with multiprocessing.get_context("fork").Pool(
+                    min(num_processes, len(args)), init_worker,
+                    (self,)) as pool:
+                results = pool.imap(term_similarity_block, args)
+                return self.merge_term_similarities(results, num_pairs)
+        results = (self.term_similarity_block(*arg) for arg in args)
+        return self.merge_term_similarities(results, num_pairs)
+
+    def merge_term_similarities(self, results, num_pairs):
+        """
+        Merge the results of term_similarity_block of all blocks, in order,
+        into the return values of term_similarities.
+        """
+        # Min-heap of the best pairs so far, on equal similarities the pair
+        # with the larger rows is removed first.
+        heap = []
+        neighbours = []
+        neighbour_scores = []
+        for pairs, block_neighbours, block_scores in results:
+            for score, i, j in pairs:
+                entry = (score, -i, -j)
+                if len(heap) < num_pairs:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+            neighbours.append(block_neighbours)
+            neighbour_scores.append(block_scores)
+        pairs = [(score, -i, -j) for score, i, j in sorted(heap)[::-1]]
+        return (pairs, np.concatenate(neighbours),
+                np.concatenate(neighbour_scores))
+
+    def term_similarity_block(self, start, end, num_pairs, num_neighbours):
+        """
+        Compute the similarities of the terms start to end - 1 with all terms
+        with one product of their rows of Uk with Uk. Returns the num_pairs
+        most similar pairs (i, j) with i in the block and i < j, as a list of
+        (similarity, i, j), and the rows and the similarities of the
+        num_neighbours most similar other terms of each term of the block,
+        as arrays (see term_similarities).
         """
-        Uk, Sk, Vk = scipy.sparse.linalg.svds(self.td_matrix, k)
-        Ukc = csr_matrix(Uk)
-        Tk = Ukc * Ukc.transpose()
-        Tt = np.sort(np.asarray(Tk.todense()), axis=None)
-        Tt = np.unique(Tt)[::-1][:200]
-        indices = []
-        for i in Tt:
-            indices.append(np.isclose(Tk.todense(), i).nonzero()[0])
-        found = 0
-        result = []
-        for i, index in enumerate(indices):
-            r = []
-            if found == k:
-                break
-            if len(index) == 2:
-                found += 1
-                r.append('%.3f' % Tt[i])
-                r.append(self.matrix_indices_terms[index[1]])
-                r.append(self.matrix_indices_terms[index[0]])
-                result.append(r)
-        return result
+        num_terms = self.Uk.shape[0]
+        block_rows = np.arange(start, end)
+        similarities = self.Uk[start:end] @ self.Uk.T
+        # The neighbours, without the term itself.
+        similarities[block_rows - start, block_rows] = -np.inf
+        num_neighbours = min(num_neighbours, num_terms - 1)
+        neighbours = np.zeros((end - start, 0), dtype=np.int64)
+        if num_neighbours > 0:
+            neighbours = np.argpartition(-similarities, num_neighbours - 1,
+                                         axis=1)[:, :num_neighbours]
+        neighbour_scores = np.take_along_axis(similarities, neighbours, 1)
+        order = np.lexsort((neighbours, -neighbour_scores))
+        neighbours = np.take_along_axis(neighbours, order, 1)
+        neighbour_scores = np.take_along_axis(neighbour_scores, order, 1)
+        # The pairs, only with the terms after each term.
+        similarities[np.arange(num_terms) <= block_rows[:, None]] = -np.inf
+        similarities = similarities.ravel()
+        best = np.arange(min(num_pairs, len(similarities)))
+        if 0 < num_pairs < len(similarities):
+            best = np.argpartition(-similarities, num_pairs - 1)[:num_pairs]
+        best = best[similarities[best] > -np.inf]
+        pairs = [(float(similarities[index]), start + index // num_terms,
+                  index % num_terms) for index in best.tolist()]
+        return pairs, neighbours, neighbour_scores
 
 
 if __name__ == "__main__":
@@ -426,6 +1116,14 @@ if __name__ == "__main__":
         ii.run_benchmark(bm_file_name, l)
         # ii.related_term_pairs(k)
     else:
+        # The document store is kept next to the input file and only rebuilt
+        # when the input file has changed since.
+        store_file_name = file_name + ".docs"
+        if not os.path.exists(store_file_name) or \
+                os.path.getmtime(store_file_name) < \
+                os.path.getmtime(file_name):
+            DocumentStore.build(file_name, store_file_name)
+        ii.document_store = DocumentStore(store_file_name)
         while (True):
             qry = input("Enter query: ")
             """ Use the same word matching approach (regex on "\W+") as above.
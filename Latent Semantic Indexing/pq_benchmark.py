@@ -0,0 +1,89 @@
+"""
+Quality, memory and speed of the compressed representations of Vk.
+
+Computes the LSI factorization of a file and runs the benchmark file with
+run_benchmark for the float64 Vk, for Vk as float16 and for product-quantized
+Vk with a few subspace dimensions (see compress_vk). Prints the MP@3, MP@R
+and MAP of LSI, the recall@10 with respect to the top-10 of the float64 Vk
+for the benchmark queries and for random queries taken from the lines of the
+file (like ann_benchmark.py), the bytes per document and the time per query
+of process_query_lsi for each.
+"""
+
+import random
+import re
+import sys
+import time
+
+import numpy as np
+
+from ann_benchmark import random_queries, recall
+from inverted_index import InvertedIndex
+
+
+def read_queries(file_name):
+    """ Returns the query words of each line of a benchmark file. """
+    with open(file_name) as file:
+        return [re.split(r"\W+", line.split("\t")[0].lower())
+                for line in file]
+
+
+def vk_memory_size(ii):
+    """ Returns the number of bytes of Vk or of its codes and codebooks. """
+    if ii.pq_codes is not None:
+        return ii.pq_codes.nbytes + ii.pq_codebooks.nbytes
+    return ii.Vk.nbytes
+
+
+def top_10(ii, queries):
+    """ Returns the doc ids of the top-10 of each query. """
+    return [ii.process_query_lsi_topk(query, 10)[0] for query in queries]
+
+
+def mean_recall(expected, results):
+    """ Returns the mean recall of the results of all queries. """
+    return np.mean([recall(e, r) for e, r in zip(expected, results)])
+
+
+def time_queries(ii, queries):
+    """ Returns the average time in ms of process_query_lsi. """
+    start = time.perf_counter()
+    for query in queries:
+        ii.process_query_lsi(query)
+    return (time.perf_counter() - start) * 1000 / len(queries)
+
+
+if __name__ == "__main__":
+    """ Run the benchmark for each representation of Vk. """
+    if len(sys.argv) != 5:
+        print("Usage: python3 pq_benchmark.py <file> <benchmark> <k> <m>")
+        sys.exit()
+    k = int(sys.argv[3])
+    ii = InvertedIndex()
+    ii.read_from_file(sys.argv[1])
+    ii.preprocess_vsm(int(sys.argv[4]))
+    queries = read_queries(sys.argv[2])
+    random.seed(42)
+    line_queries = random_queries(sys.argv[1], 200)
+    formats = [("float64", None), ("float16", {"method": "float16"})] + [
+        ("pq d=%d" % d, {"method": "pq", "subspace_dim": d})
+        for d in [2, 4, 8] if k % d == 0]
+    results = []
+    for name, kwargs in formats:
+        ii.preprocess_lsi(k, svd="randomized")
+        if kwargs is not None:
+            ii.compress_vk(**kwargs)
+        print("%s:" % name)
+        metrics = ii.run_benchmark(sys.argv[2], 0, verbose=False)
+        if kwargs is None:
+            expected = top_10(ii, queries), top_10(ii, line_queries)
+        recalls = (mean_recall(expected[0], top_10(ii, queries)),
+                   mean_recall(expected[1], top_10(ii, line_queries)))
+        bytes_per_doc = vk_memory_size(ii) / ii.td_matrix.shape[1]
+        results.append((name, bytes_per_doc) + metrics + recalls +
+                       (time_queries(ii, queries),))
+    print("%10s%12s%8s%8s%8s%8s%8s%12s" % ("Vk", "bytes/doc", "MP@3", "MP@R",
+                                           "MAP", "R@10 bm", "R@10 ln",
+                                           "ms/query"))
+    for result in results:
+        print("%10s%12.1f%8.3f%8.3f%8.3f%8.3f%8.3f%12.3f" % result)
@@ -0,0 +1,68 @@
+"""
+Comparison of the SVD backends of preprocess_lsi.
+
+Builds the term-document matrix of a file for several numbers of terms m,
+computes the rank-k factorization for several k with svds (ARPACK) and with
+randomized_svd for a few numbers of power iterations, and prints the time
+and the relative reconstruction error ||A - Uk Sk Vk||_F / ||A||_F of each.
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from inverted_index import InvertedIndex
+
+
+def reconstruction_error(ii):
+    """ Returns the relative reconstruction error of the factorization of
+    ii. Uk and Vk have orthonormal columns and rows and Uk Sk Vk is the
+    projection of A on the columns of Uk, so the squared error is
+    ||A||^2 - ||Sk||^2.
+
+    >>> from scipy.sparse import csr_matrix
+    >>> ii = InvertedIndex()
+    >>> ii.td_matrix = csr_matrix([[3.0, 0.0], [0.0, 4.0]])
+    >>> ii.preprocess_lsi(1, svd="randomized")
+    >>> '%.3f' % reconstruction_error(ii)
+    '0.600'
+    """
+    squared_norm = ii.td_matrix.multiply(ii.td_matrix).sum()
+    squared_error = max(0.0, squared_norm - np.sum(ii.Sk ** 2))
+    return float(np.sqrt(squared_error / squared_norm))
+
+
+def time_svd(ii, k, **kwargs):
+    """ Returns the seconds taken by preprocess_lsi and the reconstruction
+    error of the result. """
+    start = time.perf_counter()
+    ii.preprocess_lsi(k, **kwargs)
+    return time.perf_counter() - start, reconstruction_error(ii)
+
+
+def run_benchmark(ii, ms, ks, power_iterations):
+    """ Print the time and the error of each backend for each m and k. """
+    backends = [("arpack", {})] + [
+        ("rand q=%d" % q, {"svd": "randomized", "power_iterations": q})
+        for q in power_iterations]
+    print("%7s%5s" % ("m", "k") + "".join("%20s" % name
+                                          for name, _ in backends))
+    for m in ms:
+        ii.preprocess_vsm(m)
+        for k in ks:
+            if k >= min(ii.td_matrix.shape):
+                continue
+            results = [time_svd(ii, k, **kwargs) for _, kwargs in backends]
+            print("%7d%5d" % (ii.td_matrix.shape[0], k) + "".join(
+                "%9.2fs  err %.4f" % result for result in results))
+
+
+if __name__ == "__main__":
+    """ Run the benchmark on the given file. """
+    if len(sys.argv) != 2:
+        print("Usage: python3 svd_benchmark.py <file>")
+        sys.exit()
+    ii = InvertedIndex()
+    ii.read_from_file(sys.argv[1])
+    run_benchmark(ii, [1000, 5000, 20000], [25, 50, 100, 200], [0, 1, 2])
@@ -3,10 +3,12 @@ Copyright 2016 University of Freiburg
 Hannah Bast <bast@cs.uni-freiburg.de>
 """
 
+import os
 import re
 import sys
 import numpy as np
 import math
+from scipy.sparse import csr_matrix
 
 
 class InvertedIndex:
@@ -61,20 +63,29 @@ class InvertedIndex:
         self.avdl //= doc_id
 
     def preprocess_vsm(self):
-        """ Build the term-document matrix from the inverted index.
+        """ Build the sparse term-document matrix (CSR, one row per term)
+        from the inverted index.
 
         >>> ii = InvertedIndex()
         >>> ii.read_from_file("example2.txt")
-        >>> ii.preprocess_vsm()
-        array([[ 1.,  1.,  0.,  1.,  0.,  0.],
-               [ 1.,  0.,  1.,  1.,  0.,  0.],
-               [ 1.,  1.,  1.,  2.,  1.,  1.],
-               [ 0.,  0.,  0.,  1.,  1.,  1.]])
+        >>> A = ii.preprocess_vsm()
+        >>> A.nnz
+        15
+        >>> A.toarray()
+        array([[1., 1., 0., 1., 0., 0.],
+               [1., 0., 1., 1., 0., 0.],
+               [1., 1., 1., 2., 1., 1.],
+               [0., 0., 0., 1., 1., 1.]])
         """
-        A = np.zeros((self.num_terms, self.num_docs), dtype=float)
-        for term_id, term in enumerate(self.terms):
-            for doc_id in self.inverted_lists[term]:
-                A[term_id, doc_id - 1] += 1
+        # One entry per occurrence, the duplicates are summed up to the tf.
+        lengths = [len(self.inverted_lists[term]) for term in self.terms]
+        rows = np.repeat(np.arange(self.num_terms), lengths)
+        cols = np.fromiter((doc_id - 1 for term in self.terms
+                            for doc_id in self.inverted_lists[term]),
+                           dtype=np.int64, count=sum(lengths))
+        A = csr_matrix((np.ones(len(cols)), (rows, cols)),
+                       shape=(self.num_terms, self.num_docs))
+        A.sum_duplicates()
         return A
 
     def bm25(self, A, k, b):
@@ -83,15 +94,26 @@ class InvertedIndex:
         self.idf(A)
 
     def tfStar(self, A, k, b):
-        """ Replace tf values in the td matrix with td*. """
-        for col in range(A.shape[1]):
-            A[:, col] *= ((k + 1)/(k * (1 - b + b * self.dl[col] /
-                                        self.avdl) + A[:, col]))
+        """ Replace tf values in the td matrix with td*, in one vectorized
+        operation on the non-zero entries.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example2.txt")
+        >>> A = ii.preprocess_vsm()
+        >>> ii.tfStar(A, 1.75, 0.75)
+        >>> A[2].toarray()
+        array([[0.80733945, 1.        , 1.        , 0.96174863, 1.        ,
+                1.        ]])
+        """
+        dl = np.array(self.dl)[A.indices]
+        A.data *= ((k + 1)/(k * (1 - b + b * dl / self.avdl) + A.data))
 
     def idf(self, A):
         """ Multiplies each value in the td matix with idf. """
-        for row in range(A.shape[0]):
-            A[row] *= math.log(self.num_docs / np.count_nonzero(A[row]), 2)
+        # Same as math.log per row, to get exactly the same values.
+        df = np.diff(A.indptr)
+        idf = [math.log(self.num_docs / n, 2) for n in df.tolist()]
+        A.data *= np.repeat(idf, df)
 
     def process_query_vsm(self, A, query):
         """ Returns the best matches for the query from the td matrix.
@@ -101,12 +123,12 @@ class InvertedIndex:
         >>> A = ii.preprocess_vsm()
         >>> ii.bm25(A, 1.75, 0.75)
         >>> ii.process_query_vsm(A, "web surfing")
-        array([[ 3.        ,  1.        ],
-               [ 1.        ,  0.80733945],
-               [ 4.        ,  0.58278146],
-               [ 6.        ,  0.        ],
-               [ 5.        ,  0.        ],
-               [ 2.        ,  0.        ]])
+        array([[3.        , 1.        ],
+               [1.        , 0.80733945],
+               [4.        , 0.58278146],
+               [6.        , 0.        ],
+               [5.        , 0.        ],
+               [2.        , 0.        ]])
         """
         q = np.zeros(len(self.words))
         docs = np.linspace(1, self.num_docs, num=self.num_docs)
@@ -115,9 +137,138 @@ class InvertedIndex:
                     if self.words[term]:
                         q[self.words[term]] = 1
 
-        results = np.column_stack((docs, q.dot(A)))
+        results = np.column_stack((docs, A.T.dot(q)))
         return results[results[:, 1].argsort()[::-1]]
 
+    def process_queries_vsm(self, A, queries, k, batch_size=1024):
+        """ Returns the k best matches of each of the given queries from the
+        td matrix, as arrays of [doc id, score] like process_query_vsm, but
+        with only the k best. The queries are scored in batches of
+        batch_size, each with one product of a sparse query-term matrix with
+        the td matrix, and the top k of each query are selected with
+        argpartition. Ties are broken by doc id, so if less than k documents
+        have a positive score, the documents with score 0 and the smallest
+        ids make up the k results (all documents if there are less than k).
+        For k <= 0, the results are empty.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example2.txt")
+        >>> A = ii.preprocess_vsm()
+        >>> ii.bm25(A, 1.75, 0.75)
+        >>> results = ii.process_queries_vsm(A, ["web surfing", "beach",
+        ...                                      "internet web", "none"], 2)
+        >>> results[0]
+        array([[3.        , 1.        ],
+               [1.        , 0.80733945]])
+        >>> results[1]
+        array([[5., 1.],
+               [6., 1.]])
+        >>> results[2]
+        array([[1.        , 1.6146789 ],
+               [4.        , 1.16556291]])
+        >>> results[3]
+        array([[1., 0.],
+               [2., 0.]])
+        >>> ii.process_queries_vsm(A, ["internet"], 5)[0][:, 0]
+        array([2., 1., 4., 3., 5.])
+        >>> ii.process_queries_vsm(A, ["web surfing", "beach"], 0)[1].shape
+        (0, 2)
+        """
+        if k <= 0:
+            return [np.empty((0, 2)) for _ in queries]
+        results = []
+        for start in range(0, len(queries), batch_size):
+            batch = queries[start:start + batch_size]
+            # The query-term matrix, with a 1 for each term of a query.
+            rows = []
+            cols = []
+            for i, query in enumerate(batch):
+                terms = set(term.lower() for term in re.split(r"\W+", query))
+                for term in terms:
+                    if term in self.words:
+                        rows.append(i)
+                        cols.append(self.words[term])
+            Q = csr_matrix((np.ones(len(rows)), (rows, cols)),
+                           shape=(len(batch), self.num_terms))
+            S = Q.dot(A)
+            S.sort_indices()
+            for i in range(len(batch)):
+                docs = S.indices[S.indptr[i]:S.indptr[i + 1]]
+                scores = S.data[S.indptr[i]:S.indptr[i + 1]]
+                # Stored zeros are treated like the documents not hit.
+                positive = scores > 0
+                docs = docs[positive]
+                scores = scores[positive]
+                if len(scores) < k:
+                    # Fill up with the smallest ids of documents with score
+                    # 0, which are among the first len(docs) + num_zeros.
+                    num_zeros = min(k, self.num_docs) - len(scores)
+                    zeros = np.setdiff1d(np.arange(len(docs) + num_zeros),
+                                         docs)[:num_zeros]
+                    docs = np.concatenate((docs, zeros))
+                    scores = np.concatenate((scores, np.zeros(num_zeros)))
+                elif len(scores) > k:
+                    # All docs above the k-th best score, and the docs with
+                    # that score with the smallest ids.
+                    kth = -np.partition(-scores, k - 1)[k - 1]
+                    above = np.flatnonzero(scores > kth)
+                    tied = np.flatnonzero(scores == kth)[:k - len(above)]
+                    top = np.concatenate((above, tied))
+                    docs = docs[top]
+                    scores = scores[top]
+                order = np.lexsort((docs, -scores))
+                results.append(np.column_stack((docs[order] + 1.0,
+                                                scores[order])))
+        return results
+
+    def save_model(self, A, dir_name):
+        """ Write the td matrix A and the vocabulary to the directory
+        dir_name (created if needed), with one uncompressed .npy file per
+        array, so that load_model can map them into memory. """
+        os.makedirs(dir_name, exist_ok=True)
+        arrays = {"data": A.data, "indices": A.indices, "indptr": A.indptr,
+                  "shape": np.array(A.shape), "terms": np.array(self.terms),
+                  "dl": np.array(self.dl), "avdl": np.array(self.avdl)}
+        for name, values in arrays.items():
+            np.save(os.path.join(dir_name, name + ".npy"), values)
+
+    def load_model(self, dir_name, mmap_mode="r"):
+        """ Read a model written by save_model and return its td matrix. By
+        default, the arrays are memory-mapped read-only, so processes that
+        load the same model share one copy of it. The inverted lists are not
+        part of the model.
+
+        >>> import tempfile
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_file("example2.txt")
+        >>> A = ii.preprocess_vsm()
+        >>> ii.bm25(A, 1.75, 0.75)
+        >>> dir_name = tempfile.mkdtemp()
+        >>> ii.save_model(A, dir_name)
+        >>> ii2 = InvertedIndex()
+        >>> A2 = ii2.load_model(dir_name)
+        >>> A2.data.flags.writeable, (A2 != A).nnz
+        (False, 0)
+        >>> ii2.terms == ii.terms, ii2.words == ii.words, ii2.num_docs
+        (True, True, 6)
+        >>> ii2.process_query_vsm(A2, "web surfing")[:2]
+        array([[3.        , 1.        ],
+               [1.        , 0.80733945]])
+        """
+        arrays = {}
+        for name in ["data", "indices", "indptr", "shape", "terms", "dl",
+                     "avdl"]:
+            arrays[name] = np.load(os.path.join(dir_name, name + ".npy"),
+                                   mmap_mode=mmap_mode)
+        self.terms = arrays["terms"].tolist()
+        self.words = {term: word_id for word_id, term in enumerate(self.terms)}
+        self.num_terms, self.num_docs = arrays["shape"].tolist()
+        self.dl = arrays["dl"].tolist()
+        self.avdl = int(arrays["avdl"])
+        return csr_matrix((arrays["data"], arrays["indices"],
+                           arrays["indptr"]), shape=(self.num_terms,
+                                                     self.num_docs))
+
 if __name__ == "__main__":
     """ Gets input query from the user and prints the results. """
     # Parse command line arguments.